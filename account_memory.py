@@ -0,0 +1,105 @@
+# account_memory.py
+#
+# Memory benchmark for the bank's account store. Builds N registered users
+# the way handle_user_registration does, once as plain dicts (the old layout)
+# and once in an AccountStore of slotted records, and reports the bytes each
+# account costs. Every measurement runs in a fresh process so one layout
+# cannot inherit the other's heap.
+#
+# Run with: python account_memory.py [users ...] [--layout dict|slots]
+# (default: 1000000 and 2000000 users, both layouts at each size). Memory is
+# the growth of the process's peak resident size, so it includes allocator
+# overhead. The dict layout needs over 1 KB per user, so larger sizes want
+# several GB of RAM.
+
+import sys
+import json
+import time
+import hashlib
+import resource
+import subprocess
+
+from accounts import AccountStore, UserAccount
+from credentials import KDF_PREFIX, KDF_N, KDF_R, KDF_P, KDF_KEY_BYTES, SALT_BYTES
+
+DEFAULT_SIZES = [1_000_000, 2_000_000]
+LAYOUTS = ["dict", "slots"]
+IFSC_CODES = [f"BANK000{i}" for i in range(20)]
+
+
+def fake_hash(seed):
+    # Stands in for credentials.hash_secret: the same format and length, but
+    # without running scrypt millions of times
+    digest = hashlib.sha512(seed.encode()).hexdigest()
+    return (f"{KDF_PREFIX}${KDF_N}${KDF_R}${KDF_P}$"
+            f"{digest[:2 * SALT_BYTES]}${digest[-2 * KDF_KEY_BYTES:]}")
+
+
+def make_user(i, timestamp):
+    # Same fields and value types as a real registration, secrets hashed. IFSC
+    # codes arrive as new strings with every request, so they are not shared
+    # here either.
+    name = f"user{i}"
+    uid = hashlib.sha256(f"{name}{timestamp}pw{i}".encode()).hexdigest()[:16]
+    mmid = hashlib.sha256(f"{9000000000 + i}{uid}".encode()).hexdigest()[:16]
+    balance = float(i % 10000)
+    return mmid, {
+        "uid": uid,
+        "name": name,
+        "password": fake_hash(f"pw{i}"),
+        "ifsc_code": "".join(IFSC_CODES[i % len(IFSC_CODES)]),
+        "balance": balance,
+        "pin_code": fake_hash(f"pin{i}"),
+        "phone_number": str(9000000000 + i),
+        "timestamp": timestamp,
+        "opening_balance": balance
+    }
+
+
+def _peak_rss():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def measure(layout, users):
+    database = {} if layout == "dict" else AccountStore(UserAccount)
+    baseline = _peak_rss()
+    start = time.time()
+    for i in range(users):
+        mmid, account = make_user(i, start + i * 1e-3)
+        database[mmid] = account
+        del account
+    elapsed = time.time() - start
+    current = _peak_rss() - baseline
+    return {"layout": layout, "users": users, "bytes": current,
+            "bytes_per_account": current / users, "build_seconds": round(elapsed, 1)}
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == "--child":
+        print(json.dumps(measure(args[1], int(args[2]))))
+        return
+    layouts = LAYOUTS
+    if "--layout" in args:
+        position = args.index("--layout")
+        layouts = [args[position + 1]]
+        del args[position:position + 2]
+    sizes = [int(n) for n in args] or DEFAULT_SIZES
+
+    for users in sizes:
+        for layout in layouts:
+            child = subprocess.run([sys.executable, __file__, "--child", layout, str(users)],
+                                   capture_output=True, text=True)
+            if child.returncode != 0:
+                print(f"[MEMORY] {layout:5} {users:>10,} users: failed "
+                      f"(exit {child.returncode}; likely out of memory)")
+                continue
+            result = json.loads(child.stdout)
+            print(f"[MEMORY] {layout:5} {users:>10,} users: {result['bytes'] / 2**20:9.1f} MiB, "
+                  f"{result['bytes_per_account']:6.0f} B/account, built in {result['build_seconds']}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+# accounts.py
+#
+# Compact account storage for the bank.
+#
+# Accounts used to be plain dicts, each with its own hash table and a separate
+# string object per field. Here every account is a __slots__ record:
+#   - the short text fields that never change after registration (uid, name,
+#     password, PIN, phone number) are packed into one bytes object,
+#     NUL-separated, instead of five string objects;
+#   - IFSC codes are interned, so each distinct code is stored once;
+#   - balance and timestamp stay ordinary attributes, as they are read and
+#     updated on every payment;
+#   - opening_balance is the balance the account was registered with, for
+#     reconciliation (settlement.py). Accounts registered before it was kept
+#     have None.
+#
+# Records still behave like the dicts they replace (account['balance'],
+# account['balance'] -= amount, account.get(...), dict(account)), and
+# AccountStore is a dict keyed by MMID or merchant_id that turns incoming
+# account dicts into records, so the handlers keep their existing code.
+
+import sys
+
+SEPARATOR = "\x00"
+
+
+class Account:
+    __slots__ = ()
+    FIELDS = ()        # dict keys, in registration order
+    TEXT_FIELDS = ()   # fields packed into _text
+    OPTIONAL_FIELDS = ("opening_balance",)   # None when missing
+
+    @classmethod
+    def from_dict(cls, data):
+        account = cls()
+        account._text = _pack([data[field] for field in cls.TEXT_FIELDS])
+        for field in cls.FIELDS:
+            if field in cls.OPTIONAL_FIELDS:
+                setattr(account, field, data.get(field))
+            elif field not in cls.TEXT_FIELDS:
+                setattr(account, field, data[field])
+        if isinstance(account.ifsc_code, str):
+            account.ifsc_code = sys.intern(account.ifsc_code)
+        return account
+
+    def _text_values(self):
+        if isinstance(self._text, tuple):
+            return list(self._text)
+        return self._text.decode().split(SEPARATOR)
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def __setitem__(self, field, value):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        if field in self.TEXT_FIELDS:
+            values = self._text_values()
+            values[self.TEXT_FIELDS.index(field)] = value
+            self._text = _pack(values)
+        else:
+            setattr(self, field, value)
+
+    def __contains__(self, field):
+        return field in self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def get(self, field, default=None):
+        return getattr(self, field) if field in self.FIELDS else default
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.FIELDS]
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.as_dict()})"
+
+
+def _pack(values):
+    # Plain strings are packed into one bytes object; anything else (a PIN
+    # sent as a number, a name containing NUL) keeps its values as they are
+    if all(isinstance(value, str) and SEPARATOR not in value for value in values):
+        return SEPARATOR.join(values).encode()
+    return tuple(values)
+
+
+def _text_field(position):
+    def read(self):
+        text = self._text
+        if isinstance(text, tuple):
+            return text[position]
+        return text.split(b"\x00", position + 1)[position].decode()
+    return property(read)
+
+
+def _add_text_fields(cls):
+    for position, field in enumerate(cls.TEXT_FIELDS):
+        setattr(cls, field, _text_field(position))
+    return cls
+
+
+@_add_text_fields
+class UserAccount(Account):
+    __slots__ = ("_text", "ifsc_code", "balance", "timestamp", "opening_balance")
+    FIELDS = ("uid", "name", "password", "ifsc_code", "balance",
+              "pin_code", "phone_number", "timestamp", "opening_balance")
+    TEXT_FIELDS = ("uid", "name", "password", "pin_code", "phone_number")
+
+
+@_add_text_fields
+class MerchantAccount(Account):
+    __slots__ = ("_text", "ifsc_code", "balance", "timestamp", "opening_balance")
+    FIELDS = ("name", "password", "ifsc_code", "balance", "timestamp", "opening_balance")
+    TEXT_FIELDS = ("name", "password")
+
+
+class AccountStore(dict):
+    # ID -> account record. Assigning a dict stores it as a record.
+    def __init__(self, record_type):
+        super().__init__()
+        self.record_type = record_type
+
+    def __setitem__(self, key, account):
+        if not isinstance(account, self.record_type):
+            account = self.record_type.from_dict(account)
+        super().__setitem__(key, account)
+
+    def update(self, accounts=(), **more):
+        items = accounts.items() if hasattr(accounts, "items") else accounts
+        for key, account in items:
+            self[key] = account
+        for key, account in more.items():
+            self[key] = account
@@ -1,34 +1,332 @@
+import os
+import hmac
 import socket
-import json
 import hashlib
 import time
+import sys
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from wal import WriteAheadLog
+from snapshot import load_latest_snapshot, write_snapshot, prune_snapshots
+from ledger import AccountLocks, BlockSequencer, user_key, merchant_key
+from merkle import tx_leaf_hash, merkle_root, merkle_proof, compute_block_hash
+import chainverify
+from indexes import LedgerIndex
+from blockstore import BlockStore, BlockList
+from accounts import AccountStore, UserAccount, MerchantAccount
+from idempotency import IdempotencyCache
+from credentials import CredentialHasher
+from metrics import Metrics, serve_metrics
+from securechannel import ServerSession, unauthenticated_warning
+from subscriptions import Feed, Subscriber
+from replication import ReplicationStream, Follower
+from shards import ShardRouter, start_shards, shard_of, SHARD_BASE_PORT, SHARD_METRICS_BASE_PORT
+from settlement import Settlement, Accounts, day_bounds, mismatch_rows
+from deadlines import (AdmissionControl, deadline_from, expired, expired_response,
+                       overloaded_response)
+from protocol import (ProtocolError, read_frame, write_frame, read_frame_async,
+                      pack_frame, encode_json, decode_json, response_bodies)
 
 # Configuration
 BANK_HOST = '192.168.1.7'
 BANK_PORT = 9999
 
-# In-memory databases
-user_database = {}
-merchant_database = {}
-blockchain = []
+# Limits for the asyncio server
+MAX_CONNECTIONS = 10000
+
+# Most requests held at once, running or waiting for a handler (both
+# servers). Beyond that a request is answered at once with "overloaded" and a
+# retry_after_ms hint. A request's timeout_ms (see deadlines.py) is enforced
+# too: one that expired while waiting is dropped before it touches balances.
+MAX_INFLIGHT_REQUESTS = 1000
+
+# Prometheus scrape endpoint (GET /metrics); get_metrics serves the same data
+BANK_METRICS_PORT = 9100
+CLIENT_TIMEOUT = 30
+HANDLER_THREADS = 32
+
+# Durable storage
+WAL_DIR = 'bank_data'
+SNAPSHOT_INTERVAL = 300
+SNAPSHOTS_TO_KEEP = 2
+
+# Chain queries. A page of blocks also stops once it holds
+# MAX_PAGE_TRANSACTIONS transactions, since blocks vary in size.
+MAX_PAGE_SIZE = 1000
+MAX_PAGE_TRANSACTIONS = 20000
+
+# subscribe_blocks: each subscriber buffers at most SUBSCRIBER_BUFFER live
+# blocks, and a frame carries at most SUBSCRIPTION_PAGE blocks. An idle
+# subscription gets an empty frame every SUBSCRIPTION_HEARTBEAT seconds.
+SUBSCRIBER_BUFFER = 256
+SUBSCRIPTION_PAGE = 50
+SUBSCRIPTION_HEARTBEAT = 10
+
+# Read replicas (python bank.py --follow PRIMARY_HOST:PORT) serve read-only
+# actions on REPLICA_PORT. The primary buffers at most REPLICA_BUFFER log
+# commits per follower before catching it up from the log files instead.
+REPLICA_PORT = 9998
+REPLICA_METRICS_PORT = 9102
+REPLICA_BUFFER = 1024
+
+# Most payments one validate_transactions request may carry
+MAX_BATCH_SIZE = 1000
+
+# Responses to payments that carried an idempotency key are kept this many
+# seconds, for at most this many payments
+IDEMPOTENCY_TTL = 3600
+IDEMPOTENCY_CACHE_SIZE = 100000
+
+# Passwords and PINs are hashed with scrypt in this many worker processes.
+# A verified PIN is remembered for SESSION_TTL seconds, for at most
+# MAX_SESSIONS accounts, so repeat payments skip the KDF.
+KDF_WORKERS = os.cpu_count() or 1
+SESSION_TTL = 300
+MAX_SESSIONS = 100000
+
+# Blocks batch the payments made within BLOCK_INTERVAL seconds, up to
+# BLOCK_MAX_TRANSACTIONS each
+BLOCK_MAX_TRANSACTIONS = 500
+BLOCK_INTERVAL = 1.0
+
+# Chain verification checkpoints are signed with this key when it is set.
+# A full audit asked for by a client runs in at most VERIFY_WORKERS processes.
+CHECKPOINT_KEY = os.environ.get("BANK_CHECKPOINT_KEY")
+VERIFY_WORKERS = os.cpu_count() or 1
+
+# In-memory databases of compact account records (see accounts.py)
+user_database = AccountStore(UserAccount)
+merchant_database = AccountStore(MerchantAccount)
+
+# Sealed blocks. open_wal() swaps this for a memory-mapped BlockStore, so a
+# long chain does not live on the Python heap.
+blockchain = BlockList()
+
+# Secondary indexes over sealed transactions (tx_id, accounts, time), kept
+# up to date by add_block
+ledger_index = LedgerIndex()
+
+# Newly sealed blocks, pushed to subscribe_blocks clients
+block_feed = Feed(SUBSCRIBER_BUFFER)
+
+# Durable log records, pushed to read replicas by the log flusher
+change_feed = Feed(REPLICA_BUFFER)
+
+# Set when this process is a read replica of another bank
+follower = None
+
+# Sharded mode (shards.py): a shard process knows its (index, count); the
+# router in front of the shards holds the ShardRouter
+shard = None
+shard_router = None
+
+# Cross-shard payments this shard has voted to commit and not yet heard the
+# outcome of: tx_id -> {"side": "debit" | "credit", "tx": transaction}
+prepared_payments = {}
+
+# Handlers may run on many threads at once: transfers lock the accounts they
+# touch and blocks are appended through a single sequencer
+account_locks = AccountLocks()
+
+# Write-ahead log, opened by open_wal(); None keeps the bank purely in memory
+wal = None
+
+# scrypt hashing and verification, off the request threads
+credential_hasher = CredentialHasher(KDF_WORKERS, SESSION_TTL, MAX_SESSIONS)
+
+# Responses to keyed payments, so retries are answered without paying twice
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_TTL, IDEMPOTENCY_CACHE_SIZE)
+
+# Verified chain positions; kept in memory until open_wal() loads the file
+checkpoint_store = chainverify.CheckpointStore()
+
+# Bounds the requests held at once; see MAX_INFLIGHT_REQUESTS
+admission_control = AdmissionControl(MAX_INFLIGHT_REQUESTS)
+_verify_lock = threading.Lock()
+
+
+def add_block(transactions):
+    # Seals a batch of transactions into a block. Called by the sequencer,
+    # which holds its lock, so the tip cannot move underneath us.
+    prev_hash = blockchain.header(-1)['hash'] if blockchain else '0'*64
+    index = len(blockchain)
+    timestamp = time.time()
+    root = merkle_root([tx_leaf_hash(tx) for tx in transactions])
+    block = {
+        "index": index,
+        "timestamp": timestamp,
+        "prev_hash": prev_hash,
+        "merkle_root": root,
+        "tx_count": len(transactions),
+        "transactions": transactions,
+        "hash": compute_block_hash(index, prev_hash, root, timestamp)
+    }
+    blockchain.append(block)
+    ledger_index.add_block(block)
+    block_feed.publish(block)
+    print(f"[BANK][BLOCKCHAIN] Block {index} added with {len(transactions)} transactions")
+    return block
+
 
+block_sequencer = BlockSequencer(add_block, BLOCK_MAX_TRANSACTIONS, BLOCK_INTERVAL)
 
-def add_block(tx_id, mmid, merchant_id, amount, timestamp):
-    prev_hash = blockchain[-1]['hash'] if blockchain else '0'*64
-    block_content = f"{tx_id}{prev_hash}{timestamp}"
-    block_hash = hashlib.sha256(block_content.encode()).hexdigest()
-    blockchain.append({
+
+def new_transaction(tx_id, mmid, merchant_id, amount, timestamp):
+    # A transaction as it is stored in a block
+    return {
         "tx_id": tx_id,
         "mmid": mmid,
         "merchant_id": merchant_id,
         "amount": amount,
-        "timestamp": timestamp,
-        "prev_hash": prev_hash,
-        "hash": block_hash
+        "timestamp": timestamp
+    }
+
+
+# ---------- Durability ----------
+
+def apply_wal_record(record):
+    # Records carry after-images, so applying them rebuilds the exact state
+    kind = record["type"]
+    if kind == "register_user":
+        user_database[record["mmid"]] = record["account"]
+    elif kind == "register_merchant":
+        merchant_database[record["merchant_id"]] = record["account"]
+    elif kind == "transaction":
+        user_database[record["mmid"]]["balance"] = record["user_balance"]
+        merchant_database[record["merchant_id"]]["balance"] = record["merchant_balance"]
+        tx = record["tx"]
+        if ledger_index.locate(tx["tx_id"]) is None:
+            block_sequencer.restore(tx)
+    elif kind == "block":
+        # Only a block that extends the tip is new; anything else is already
+        # part of the chain loaded from the snapshot
+        block = record["block"]
+        tip_hash = blockchain.header(-1)['hash'] if blockchain else '0'*64
+        if block["prev_hash"] == tip_hash:
+            blockchain.append(block)
+            ledger_index.add_block(block)
+            block_feed.publish(block)
+        for tx in block["transactions"]:
+            block_sequencer.pending.pop(tx["tx_id"], None)
+    elif kind == "prepare":
+        tx = record["tx"]
+        prepared_payments[tx["tx_id"]] = {"side": record["side"], "tx": tx}
+        if "user_balance" in record:
+            user_database[tx["mmid"]]["balance"] = record["user_balance"]
+    elif kind == "commit":
+        tx = record["tx"]
+        prepared_payments.pop(tx["tx_id"], None)
+        if "merchant_balance" in record:
+            merchant_database[tx["merchant_id"]]["balance"] = record["merchant_balance"]
+        if ledger_index.locate(tx["tx_id"]) is None:
+            block_sequencer.restore(tx)
+    elif kind == "abort":
+        prepared_payments.pop(record["tx_id"], None)
+        if "user_balance" in record:
+            user_database[record["mmid"]]["balance"] = record["user_balance"]
+
+
+def open_wal(directory=WAL_DIR):
+    # Loads the latest snapshot, replays the log records written after it,
+    # then journals every later change
+    global wal, blockchain, checkpoint_store
+    os.makedirs(directory, exist_ok=True)
+    covered_lsn, state = load_latest_snapshot(directory)
+    # Blocks past the snapshot's height may not have reached the disk intact;
+    # they are dropped here and replayed from the log
+    blockchain = BlockStore(directory)
+    blockchain.truncate(state["chain_height"] if state else 0)
+    if state is not None:
+        user_database.update(state["users"])
+        merchant_database.update(state["merchants"])
+        tip_hash = blockchain.header(-1)['hash'] if blockchain else '0'*64
+        if tip_hash != state["chain_tip"]:
+            raise RuntimeError("Block store does not match the snapshot's chain tip")
+        for block in blockchain:
+            ledger_index.add_block(block)
+        for tx in state["pending"]:
+            if ledger_index.locate(tx["tx_id"]) is None:
+                block_sequencer.restore(tx)
+        for entry in state.get("prepared", []):
+            prepared_payments[entry["tx"]["tx_id"]] = entry
+
+    wal = WriteAheadLog(directory, apply=apply_wal_record, after_lsn=covered_lsn)
+    block_sequencer.journal = wal.append
+    wal.on_durable = lambda first_lsn, bodies: change_feed.publish((first_lsn, bodies))
+
+    # Refuse to serve a chain that has been tampered with on disk
+    checkpoint_store = chainverify.CheckpointStore(os.path.join(directory, "checkpoints.json"), CHECKPOINT_KEY)
+    result = verify_chain()
+    if result["status"] != "success":
+        raise RuntimeError(f"Chain verification failed: {result['message']}")
+    print(f"[BANK] Recovered {len(user_database)} users, {len(merchant_database)} merchants, "
+          f"{len(blockchain)} blocks and {len(block_sequencer.pending)} pending transactions "
+          f"from {directory} (snapshot at log position {covered_lsn})")
+    return wal
+
+
+def take_snapshot():
+    # Runs alongside request handling. The copy is fuzzy: it contains
+    # everything up to covered_lsn and possibly some later changes, which
+    # replaying the (after-image) records from covered_lsn onwards makes exact.
+    covered_lsn = wal.rotate() - 1
+    height = len(blockchain)
+    users = {mmid: account.as_dict() for mmid, account in list(user_database.items())}
+    merchants = {mid: account.as_dict() for mid, account in list(merchant_database.items())}
+    pending = block_sequencer.pending_transactions()
+    prepared = list(prepared_payments.values())
+    blockchain.flush()
+
+    write_snapshot(wal.directory, covered_lsn, {
+        "users": users,
+        "merchants": merchants,
+        "pending": pending,
+        "prepared": prepared,
+        "chain_height": height,
+        "chain_tip": blockchain.header(height - 1)['hash'] if height else '0'*64
     })
-    print(f"[BANK][BLOCKCHAIN] Block added: {tx_id}")
+    # Log segments are only needed back to the oldest snapshot we keep
+    wal.prune(prune_snapshots(wal.directory, SNAPSHOTS_TO_KEEP))
+    print(f"[BANK] Snapshot written at log position {covered_lsn} "
+          f"({len(users)} users, {len(merchants)} merchants, {height} blocks)")
+    return covered_lsn
+
+
+def start_snapshotter(interval=SNAPSHOT_INTERVAL):
+    def run():
+        last_snapshot_lsn = None
+        while True:
+            time.sleep(interval)
+            if wal.last_lsn == last_snapshot_lsn:
+                continue
+            try:
+                last_snapshot_lsn = take_snapshot()
+            except Exception as e:
+                print("[BANK] Snapshot failed:", str(e))
+
+    thread = threading.Thread(target=run, name="bank-snapshotter", daemon=True)
+    thread.start()
+    return thread
+
+# ---------- Chain Verification ----------
+
+def verify_chain(full=False, workers=None):
+    # Incremental unless full=True; see chainverify.verify_chain
+    with _verify_lock:
+        return chainverify.verify_chain(blockchain, checkpoint_store, full, workers)
 
 
+def handle_verify_chain(data):
+    workers = data.get('workers')
+    if workers is not None and (type(workers) is not int or workers < 1):
+        return {"status": "error", "message": "workers must be a positive integer"}
+    try:
+        return verify_chain(bool(data.get('full', False)), min(workers or VERIFY_WORKERS, VERIFY_WORKERS))
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
+
 # ---------- Utility Functions ----------
 
 def create_uid(name, password, timestamp):
@@ -43,6 +341,10 @@ def generate_merchant_id(name, password, timestamp):
     raw = f"{name}{timestamp}{password}"
     return hashlib.sha256(raw.encode()).hexdigest()[:16]
 
+def owns_account(account_id):
+    # A shard only holds (and only hands out) IDs that hash to it
+    return shard is None or shard_of(account_id, shard[1]) == shard[0]
+
 # ---------- User Registration ----------
 
 def handle_user_registration(data):
@@ -57,18 +359,28 @@ def handle_user_registration(data):
         timestamp = time.time()
         uid = create_uid(name, password, timestamp)
         mmid = create_mmid(phone_number, uid)
+        while not owns_account(mmid):
+            timestamp += 1e-6
+            uid = create_uid(name, password, timestamp)
+            mmid = create_mmid(phone_number, uid)
+        # Only salted scrypt hashes are kept, in memory and on disk
+        password_hash, pin_hash = credential_hasher.hash_many([password, pin_code])
 
-        # Store user
-        user_database[mmid] = {
+        account = {
             "uid": uid,
             "name": name,
-            "password": password,
+            "password": password_hash,
             "ifsc_code": ifsc_code,
             "balance": balance,
-            "pin_code": pin_code,
+            "pin_code": pin_hash,
             "phone_number": phone_number,
-            "timestamp": timestamp
+            "timestamp": timestamp,
+            "opening_balance": balance
         }
+        # Store user
+        user_database[mmid] = account
+        if wal is not None:
+            wal.log({"type": "register_user", "mmid": mmid, "account": account})
 
         print(f"[BANK] Registered user {name} | MMID: {mmid} | Balance: {balance}")
         return {"status": "success", "uid": uid, "mmid": mmid}
@@ -87,14 +399,21 @@ def handle_merchant_registration(data):
 
         timestamp = time.time()
         merchant_id = generate_merchant_id(name, password, timestamp)
+        while not owns_account(merchant_id):
+            timestamp += 1e-6
+            merchant_id = generate_merchant_id(name, password, timestamp)
 
-        merchant_database[merchant_id] = {
+        account = {
             "name": name,
-            "password": password,
+            "password": credential_hasher.hash(password),
             "ifsc_code": ifsc_code,
             "balance": balance, 
-            "timestamp": timestamp
+            "timestamp": timestamp,
+            "opening_balance": balance
         }
+        merchant_database[merchant_id] = account
+        if wal is not None:
+            wal.log({"type": "register_merchant", "merchant_id": merchant_id, "account": account})
 
         print(f"[BANK] Registered merchant {name} | MID: {merchant_id} | Balance: {balance}")
         return {"status": "success", "merchant_id": merchant_id}
@@ -104,97 +423,1147 @@ def handle_merchant_registration(data):
 
 # ---------- Transaction Validation ----------
 
-def handle_transaction_validation(data):
+def check_payment(data, pin_ok=None):
+    # The checks that need no locks. Returns (failure response, None) or
+    # (None, payment). pin_ok is the PIN check's result when the caller has
+    # already run it.
+    mmid = data['mmid']
+    pin = data['pin']
+    amount = float(data['amount'])
+    encrypted_merchant_id = data['encrypted_merchant_id']
+
+    if mmid not in user_database:
+        return {"status": "failure", "message": "MMID not found"}, None
+
+    user = user_database[mmid]
+
+    if pin_ok is None:
+        pin_ok = credential_hasher.verify(mmid, pin, user['pin_code'])
+    if not pin_ok:
+        return {"status": "failure", "message": "Incorrect PIN"}, None
+
+    if user['balance'] < amount:
+        return {"status": "failure", "message": "Insufficient balance"}, None
+
+    # Decrypt and validate merchant ID (Optional/Placeholder)
+    merchant_id = encrypted_merchant_id  # Simulated decryption
+    if merchant_id not in merchant_database:
+        return {"status": "failure", "message": "Invalid Merchant ID"}, None
+    merchant = merchant_database[merchant_id]
+    return None, (mmid, user, merchant_id, merchant, amount)
+
+
+def payment_timestamp(data):
+    # Behind a shard router, payments carry the router's timestamp, which
+    # orders the transactions of all shards (see shards.py)
+    if shard is not None and data.get('timestamp') is not None:
+        return float(data['timestamp'])
+    return time.time()
+
+
+def apply_payment(payment, timestamp):
+    # Moves the money; the caller holds both account locks. Returns the
+    # response plus the transaction and its WAL record to queue, or None for
+    # both when the payment is declined.
+    mmid, user, merchant_id, merchant, amount = payment
+    # Re-check under the lock; another payment may have spent the funds
+    if user['balance'] < amount:
+        return {"status": "failure", "message": "Insufficient balance"}, None, None
+
+    # Deduct amount
+    user['balance'] -= amount
+    merchant['balance'] += amount
+    remaining_balance = user['balance']
+
+    # Memory changes before the record is journaled, so a snapshot taken
+    # after a log position always contains the changes before it
+    tx_id = hashlib.sha256(f"{mmid}{merchant_id}{timestamp}{amount}".encode()).hexdigest()
+    tx = new_transaction(tx_id, mmid, merchant_id, amount, timestamp)
+    record = {
+        "type": "transaction",
+        "mmid": mmid,
+        "merchant_id": merchant_id,
+        "user_balance": user['balance'],
+        "merchant_balance": merchant['balance']
+    }
+    response = {
+        "status": "success",
+        "message": f"Transaction of {amount} successful",
+        "remaining_balance": remaining_balance,
+        "tx_id": tx_id
+    }
+    return response, tx, record
+
+
+# Fingerprints hold a keyed hash of the PIN, never the PIN itself
+_fingerprint_key = os.urandom(32)
+
+
+def idempotency_args(data):
+    # Keys are scoped to the paying MMID; the fingerprint catches a key
+    # reused for a different payment, or retried with a different PIN,
+    # which must not get the cached answer back unchecked
+    cache_key = (data.get('mmid'), data['idempotency_key'])
+    pin = hmac.new(_fingerprint_key, str(data.get('pin')).encode(), hashlib.sha256).digest()
+    fingerprint = (data.get('encrypted_merchant_id'), str(data.get('amount')), pin)
+    return cache_key, fingerprint
+
+
+def finish_idempotent(cache_key, response):
+    # Errors and payments that were never run (expired, shed) are not
+    # remembered, so the client can retry them
+    if response is not None and response.get("status") not in ("error", "expired", "overloaded"):
+        idempotency_cache.complete(cache_key, response)
+    else:
+        idempotency_cache.release(cache_key)
+
+
+def handle_transaction_validation(data, received=None):
     # def simple_permutation_decipher_json(encrypted_data):
     #         # Simple permutation decryption: reverse the string back to original
     #         decrypted_data = encrypted_data[::-1]  # Reverse the string
     #         return json.loads(decrypted_data)  # Convert back to dictionary
     # data = simple_permutation_decipher_json(data)
+    # received is when the request arrived, for its timeout_ms
+    if data.get('idempotency_key') is None:
+        return validate_payment(data, received)
+
+    # A retry of a payment we have already answered gets the same answer,
+    # without touching balances or the chain
+    cache_key, fingerprint = idempotency_args(data)
+    cached = idempotency_cache.claim(cache_key, fingerprint)
+    if cached is not None:
+        print(f"[BANK] Replayed response for idempotency key {data['idempotency_key']}")
+        return cached
+    response = None
     try:
-        mmid = data['mmid']
-        pin = data['pin']
-        amount = float(data['amount'])
-        encrypted_merchant_id = data['encrypted_merchant_id']
+        response = validate_payment(data, received)
+    finally:
+        finish_idempotent(cache_key, response)
+    return response
 
-        if mmid not in user_database:
-            return {"status": "failure", "message": "MMID not found"}
 
-        user = user_database[mmid]
+def validate_payment(data, received=None):
+    try:
+        deadline = deadline_from(data, received)
+        if shard_router is not None:
+            return shard_router.pay(data, deadline)
+        failure, payment = check_payment(data)
+        if failure is not None:
+            return failure
+        mmid, user, merchant_id, merchant, amount = payment
 
-        if pin != user['pin_code']:
-            return {"status": "failure", "message": "Incorrect PIN"}
+        # Balance check and update must not interleave with another transfer
+        # on the same user or merchant
+        with account_locks.hold(user_key(mmid), merchant_key(merchant_id)):
+            # Waiting for the PIN check and the locks may have used up the
+            # deadline; then nobody is waiting for this payment any more
+            if expired(deadline):
+                metrics.increment("deadline_expired")
+                return expired_response()
+            response, tx, record = apply_payment(payment, payment_timestamp(data))
+            if tx is None:
+                return response
+            lsn = block_sequencer.add(tx, record)
 
-        if user['balance'] < amount:
-            return {"status": "failure", "message": "Insufficient balance"}
+        # Only answer once the payment is on disk; waiting outside the locks
+        # lets other payments join the same group commit
+        if lsn is not None:
+            wal.wait_durable(lsn)
 
-        # Decrypt and validate merchant ID (Optional/Placeholder)
-        merchant_id = encrypted_merchant_id  # Simulated decryption
-        if merchant_id not in merchant_database:
-            return {"status": "failure", "message": "Invalid Merchant ID"}
-        merchant = merchant_database[merchant_id]
+        print(f"[BANK] Transaction of {amount} approved for {user['name']} (MMID: {mmid})")
+        return response
 
-        # Deduct amount
-        user['balance'] -= amount
-        merchant['balance'] += amount
+    except KeyError as e:
+        return {"status": "error", "message": f"Missing field: {str(e)}"}
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
 
 
-        timestamp = time.time()
-        tx_id = hashlib.sha256(f"{mmid}{merchant_id}{timestamp}{amount}".encode()).hexdigest()
-        add_block(tx_id, mmid, merchant_id, amount, timestamp)
+def handle_transactions_validation(data, received=None):
+    # A batch of validate_transaction requests, applied in order in one pass.
+    # All accounts in the batch are locked together, the approved payments
+    # are queued and journaled in one step, and the reply waits for a single
+    # durable point. Results come back in request order. Each payment may
+    # have its own timeout_ms, within the batch's.
+    try:
+        items = data['transactions']
+    except KeyError as e:
+        return {"status": "error", "message": f"Missing field: {str(e)}"}
+    if not isinstance(items, list):
+        return {"status": "error", "message": "'transactions' must be a list"}
+    if len(items) > MAX_BATCH_SIZE:
+        return {"status": "error", "message": f"At most {MAX_BATCH_SIZE} transactions per batch"}
+    if shard_router is not None:
+        return shard_router.pay_batch(items, lambda item: handle_transaction_validation(item, received), received)
 
-        print(f"[BANK] Transaction of {amount} approved for {user['name']} (MMID: {mmid})")
-        return {
-            "status": "success",
-            "message": f"Transaction of {amount} successful",
-            "remaining_balance": user['balance']
-        }
+    batch_deadline = deadline_from(data, received)
+    deadlines = []
+    for item in items:
+        item_deadline = deadline_from(item, received) if isinstance(item, dict) else None
+        deadlines.append(min(item_deadline, batch_deadline) if None not in (item_deadline, batch_deadline)
+                         else item_deadline or batch_deadline)
+
+    results = [None] * len(items)
+    claimed = []
+    for i, item in enumerate(items):
+        if isinstance(item, dict) and item.get('idempotency_key') is not None:
+            cache_key, fingerprint = idempotency_args(item)
+            # Never wait here: the first use of the key may be earlier in
+            # this same batch
+            cached = idempotency_cache.claim(cache_key, fingerprint, wait=False)
+            if cached is not None:
+                results[i] = cached
+            else:
+                claimed.append((i, cache_key))
+
+    try:
+        # The PIN checks of the whole batch run in parallel
+        pin_checks = {}
+        for i, item in enumerate(items):
+            if (results[i] is None and isinstance(item, dict) and 'pin' in item
+                    and isinstance(item.get('mmid'), str) and item['mmid'] in user_database):
+                pin_checks[i] = (item['mmid'], item['pin'], user_database[item['mmid']]['pin_code'])
+        pin_results = dict(zip(pin_checks, credential_hasher.verify_many(list(pin_checks.values()))))
+
+        payments = []
+        for i, item in enumerate(items):
+            if results[i] is not None:
+                continue
+            try:
+                failure, payment = check_payment(item, pin_results.get(i))
+            except KeyError as e:
+                failure = {"status": "error", "message": f"Missing field: {str(e)}"}
+            except Exception as e:
+                failure = {"status": "error", "message": str(e)}
+            if failure is not None:
+                results[i] = failure
+            else:
+                payments.append((i, payment))
+
+        keys = []
+        for _, payment in payments:
+            keys += [user_key(payment[0]), merchant_key(payment[2])]
+        entries = []
+        with account_locks.hold(*keys):
+            for i, payment in payments:
+                if expired(deadlines[i]):
+                    metrics.increment("deadline_expired")
+                    results[i] = expired_response()
+                    continue
+                results[i], tx, record = apply_payment(payment, payment_timestamp(items[i]))
+                if tx is not None:
+                    entries.append((tx, record))
+            lsn = block_sequencer.add_batch(entries)
+
+        if lsn is not None:
+            wal.wait_durable(lsn)
+    finally:
+        for i, cache_key in claimed:
+            finish_idempotent(cache_key, results[i])
+
+    print(f"[BANK] Batch of {len(items)} transactions, {len(entries)} approved")
+    return {"status": "success", "results": results}
+
+# ---------- Cross-Shard Payments ----------
+
+# The shard side of two-phase commit; the router coordinates (shards.py).
+# Every step is journaled before it is answered, and repeating a step is
+# harmless, so the router can retry after any failure.
+
+def handle_prepare_payment(data):
+    if shard is None:
+        return {"status": "error", "message": "Only a shard takes part in cross-shard payments"}
+    try:
+        side = data['side']
+        tx = data['tx']
+        tx_id = tx['tx_id']
+        amount = float(tx['amount'])
+        if tx_id in prepared_payments:
+            return {"status": "success", "message": "Already prepared"}
+
+        if side == "debit":
+            mmid = tx['mmid']
+            user = user_database.get(mmid)
+            if user is None:
+                return {"status": "failure", "message": "MMID not found"}
+            if not credential_hasher.verify(mmid, data['pin'], user['pin_code']):
+                return {"status": "failure", "message": "Incorrect PIN"}
+            # The amount is held by debiting it now; an abort refunds it
+            with account_locks.hold(user_key(mmid)):
+                if user['balance'] < amount:
+                    return {"status": "failure", "message": "Insufficient balance"}
+                user['balance'] -= amount
+                remaining_balance = user['balance']
+                prepared_payments[tx_id] = {"side": side, "tx": tx}
+                record = {"type": "prepare", "side": side, "tx": tx, "user_balance": remaining_balance}
+                lsn = wal.append(record) if wal is not None else None
+        elif side == "credit":
+            if tx['merchant_id'] not in merchant_database:
+                return {"status": "failure", "message": "Invalid Merchant ID"}
+            remaining_balance = None
+            with account_locks.hold(merchant_key(tx['merchant_id'])):
+                prepared_payments[tx_id] = {"side": side, "tx": tx}
+                lsn = wal.append({"type": "prepare", "side": side, "tx": tx}) if wal is not None else None
+        else:
+            return {"status": "error", "message": f"Unknown side: {side}"}
+
+        # A yes vote must survive a crash
+        if lsn is not None:
+            wal.wait_durable(lsn)
+        return {"status": "success", "remaining_balance": remaining_balance}
 
     except KeyError as e:
         return {"status": "error", "message": f"Missing field: {str(e)}"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
+
+def _prepared_lock_key(entry):
+    tx = entry["tx"]
+    return user_key(tx["mmid"]) if entry["side"] == "debit" else merchant_key(tx["merchant_id"])
+
+
+def handle_commit_payment(data):
+    try:
+        tx_id = data['tx_id']
+    except KeyError as e:
+        return {"status": "error", "message": f"Missing field: {str(e)}"}
+    entry = prepared_payments.get(tx_id)
+    lsn = None
+    if entry is not None:
+        with account_locks.hold(_prepared_lock_key(entry)):
+            if prepared_payments.pop(tx_id, None) is not None:
+                tx = entry["tx"]
+                record = {"type": "commit", "side": entry["side"]}
+                if entry["side"] == "credit":
+                    merchant = merchant_database[tx["merchant_id"]]
+                    merchant['balance'] += tx["amount"]
+                    record["merchant_balance"] = merchant['balance']
+                # Into this shard's chain segment, like a local payment
+                lsn = block_sequencer.add(tx, record)
+    elif ledger_index.locate(tx_id) is None and tx_id not in block_sequencer.pending:
+        return {"status": "failure", "message": "Unknown prepared payment"}
+    if lsn is not None:
+        wal.wait_durable(lsn)
+    return {"status": "success"}
+
+
+def handle_abort_payment(data):
+    try:
+        tx_id = data['tx_id']
+    except KeyError as e:
+        return {"status": "error", "message": f"Missing field: {str(e)}"}
+    # Aborting a payment that was never prepared here is a no-op
+    entry = prepared_payments.get(tx_id)
+    lsn = None
+    if entry is not None:
+        with account_locks.hold(_prepared_lock_key(entry)):
+            if prepared_payments.pop(tx_id, None) is not None:
+                tx = entry["tx"]
+                record = {"type": "abort", "tx_id": tx_id}
+                if entry["side"] == "debit":
+                    user = user_database[tx["mmid"]]
+                    user['balance'] += tx["amount"]
+                    record.update(mmid=tx["mmid"], user_balance=user['balance'])
+                lsn = wal.append(record) if wal is not None else None
+    if lsn is not None:
+        wal.wait_durable(lsn)
+    return {"status": "success"}
+
+
+def handle_list_prepared():
+    return {
+        "status": "success",
+        "prepared": [{"tx_id": tx_id, "side": entry["side"], "timestamp": entry["tx"]["timestamp"]}
+                     for tx_id, entry in list(prepared_payments.items())]
+    }
+
+# ---------- Settlement ----------
+
+def held_payments():
+    # Payments debited by a prepared cross-shard payment, not yet in the chain
+    return [entry["tx"] for entry in list(prepared_payments.values()) if entry["side"] == "debit"]
+
+
+def handle_get_settlement(data):
+    # End-of-day settlement for one UTC day, and reconciliation of every
+    # balance against the chain (settlement.py). Runs alongside payments.
+    if not isinstance(blockchain, BlockStore):
+        return {"status": "error", "message": "Settlement reads the block store; start the bank with its data directory"}
+    try:
+        start, end, day = day_bounds(data.get('day'))
+        by = data.get('by', 'merchant')
+        if by not in ("merchant", "user"):
+            raise ValueError(f"'by' must be 'merchant' or 'user', not {by!r}")
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
+
+    started = time.perf_counter()
+    run = Settlement(start, end, Accounts(user_database), Accounts(merchant_database))
+    sealed = blockchain.tx_count()
+    run.add_sealed(blockchain.directory, 0, sealed)
+    # Then what was sealed meanwhile, read together with the pending payments
+    # so each payment is counted once
+    sealed_now, pending = block_sequencer.sealed_and_pending(blockchain.tx_count)
+    run.add_sealed(blockchain.directory, sealed, sealed_now)
+    held = held_payments()
+    run.users.read_balances(user_database)
+    run.merchants.read_balances(merchant_database)
+    user_off, merchant_off = run.mismatches(*run.expected(pending, held))
+
+    mismatches = []
+    if len(user_off) or len(merchant_off):
+        # A payment in flight while the balances were read looks like a
+        # mismatch. Check those accounts again with their payments held off.
+        check = run.restrict(user_database, merchant_database, user_off, merchant_off)
+        keys = [user_key(mmid) for mmid in check.users.ids] + [merchant_key(mid) for mid in check.merchants.ids]
+        with account_locks.hold(*keys):
+            sealed_then, pending = block_sequencer.sealed_and_pending(blockchain.tx_count)
+            check.add_sealed(blockchain.directory, sealed_now, sealed_then)
+            held = held_payments()
+            check.users.read_balances(user_database)
+            check.merchants.read_balances(merchant_database)
+        expected_users, expected_merchants = check.expected(pending, held)
+        user_off, merchant_off = check.mismatches(expected_users, expected_merchants)
+        mismatches = (mismatch_rows("user", check.users, expected_users, user_off) +
+                      mismatch_rows("merchant", check.merchants, expected_merchants, merchant_off))
+        for row in mismatches:
+            print(f"[BANK] Reconciliation: {row['kind']} {row['id']} has {row['balance']}, expected {row['expected']}")
+
+    report = run.report(day, by)
+    report.update(status="success", reconciliation=run.reconciliation(mismatches, len(user_off) + len(merchant_off)),
+                  elapsed_ms=round((time.perf_counter() - started) * 1000, 1))
+    print(f"[BANK] Settlement for {day}: {report['transactions']} payments of {report['sealed_transactions']} "
+          f"sealed, {report['reconciliation']['mismatch_count']} mismatches, {report['elapsed_ms']} ms")
+    return report
+
 # ---------- Bank Server ----------
 
 
 def handle_get_blockchain():
-    return {"status": "success", "chain": blockchain}
+    # Whole-chain dump kept for old clients; it is streamed in chunks
+    return {"status": "success", "chain": blockchain.view(0, len(blockchain))}
+
+
+def handle_get_tx_proof(data):
+    # Proves one payment against its block's Merkle root. The response holds
+    # the block header, not its transactions, so it stays O(log n) in size.
+    try:
+        tx_id = data['tx_id']
+    except KeyError as e:
+        return {"status": "error", "message": f"Missing field: {str(e)}"}
+
+    location = ledger_index.locate(tx_id)
+    if location is None:
+        if tx_id in block_sequencer.pending:
+            return {"status": "pending", "message": "Transaction is not in a block yet"}
+        return {"status": "failure", "message": "Unknown transaction"}
+
+    block_index, position = location
+    block = blockchain[block_index]
+    leaves = [tx_leaf_hash(tx) for tx in block["transactions"]]
+    header = blockchain.header(block_index)
+    return {
+        "status": "success",
+        "tx": block["transactions"][position],
+        "block": header,
+        "proof": merkle_proof(leaves, position)
+    }
+
+
+# ---------- Ledger Queries ----------
+
+def _transactions_at(positions):
+    # Resolves index positions to transactions, tagged with their block
+    result = []
+    for block_index, position in positions:
+        tx = dict(blockchain.tx_at(block_index, position), block_index=block_index)
+        result.append(tx)
+    return result
 
 
-def start_bank_server():
-    print(f"[BANK] Starting bank server on {BANK_HOST}:{BANK_PORT}...")
+def _page_args(data):
+    offset = max(int(data.get('offset', 0)), 0)
+    limit = min(max(int(data.get('limit', 100)), 0), MAX_PAGE_SIZE)
+    return offset, limit
+
+
+def handle_get_transaction(data):
+    try:
+        tx_id = data['tx_id']
+    except KeyError as e:
+        return {"status": "error", "message": f"Missing field: {str(e)}"}
+
+    location = ledger_index.locate(tx_id)
+    if location is not None:
+        header = blockchain.header(location[0])
+        return {
+            "status": "success",
+            "state": "confirmed",
+            "tx": blockchain.tx_at(*location),
+            "block_index": header["index"],
+            "block_hash": header["hash"]
+        }
+    tx = block_sequencer.pending.get(tx_id)
+    if tx is not None:
+        return {"status": "success", "state": "pending", "tx": tx}
+    return {"status": "failure", "message": "Unknown transaction"}
+
+
+def handle_get_statement(data):
+    # Newest first, for one user (mmid) or one merchant (merchant_id).
+    # Payments still waiting for a block are listed separately.
+    try:
+        offset, limit = _page_args(data)
+        mmid = data.get('mmid')
+        merchant_id = data.get('merchant_id')
+        if mmid is not None:
+            account = user_database.get(mmid)
+        elif merchant_id is not None:
+            account = merchant_database.get(merchant_id)
+        else:
+            return {"status": "error", "message": "Missing field: 'mmid' or 'merchant_id'"}
+        if account is None:
+            return {"status": "failure", "message": "Account not found"}
+
+        positions, total = ledger_index.account_positions(mmid, merchant_id, offset, limit)
+        key, value = ('mmid', mmid) if mmid is not None else ('merchant_id', merchant_id)
+        pending = [tx for tx in block_sequencer.pending_transactions() if tx[key] == value]
+        return {
+            "status": "success",
+            "balance": account['balance'],
+            "transactions": _transactions_at(positions),
+            "pending": pending,
+            "total": total,
+            "offset": offset
+        }
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
+
+
+def handle_get_transactions_in_range(data):
+    # Sealed transactions with start_time <= timestamp < end_time, oldest first
+    try:
+        offset, limit = _page_args(data)
+        start_time = float(data['start_time'])
+        end_time = float(data.get('end_time', time.time()))
+        # Every payment stamped before sealed_before is in a block. Read
+        # before the range, so a block sealed in between is not missed.
+        unsealed = block_sequencer.pending_transactions() + [entry["tx"] for entry in list(prepared_payments.values())]
+        sealed_before = min((tx["timestamp"] for tx in unsealed), default=None)
+        positions, total = ledger_index.time_range(start_time, end_time, offset, limit)
+        return {
+            "status": "success",
+            "transactions": _transactions_at(positions),
+            "total": total,
+            "offset": offset,
+            "sealed_before": sealed_before
+        }
+    except KeyError as e:
+        return {"status": "error", "message": f"Missing field: {str(e)}"}
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
+
+
+def page_length(tx_counts):
+    # How many of the blocks with these transaction counts make one page:
+    # at most MAX_PAGE_TRANSACTIONS transactions, but always one block
+    total = 0
+    for n, count in enumerate(tx_counts):
+        total += count
+        if total > MAX_PAGE_TRANSACTIONS and n:
+            return n
+    return len(tx_counts)
+
+
+def handle_get_blocks(data):
+    # One page of blocks, either from an index (start/end) or after a known
+    # block hash. "next" is where the following page starts.
+    try:
+        height = len(blockchain)
+        if data.get('after_hash') is not None:
+            index = ledger_index.block_index(data['after_hash'])
+            if index is None:
+                return {"status": "failure", "message": "Unknown block hash"}
+            start = index + 1
+        else:
+            start = max(int(data.get('start', 0)), 0)
+        limit = min(int(data.get('limit', MAX_PAGE_SIZE)), MAX_PAGE_SIZE)
+        end = min(int(data.get('end', height)), height, start + max(limit, 0))
+        end = start + page_length([blockchain.header(i)['tx_count'] for i in range(start, end)])
+        blocks = blockchain[start:end] if start < end else []
+        return {
+            "status": "success",
+            "start": start,
+            "blocks": blocks,
+            "next": start + len(blocks),
+            "height": height
+        }
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
+
+
+def handle_subscribe_blocks(data):
+    # Starts a block subscription after a known block hash, from an index,
+    # or (by default) from the next block to be sealed. Returns the
+    # subscriber, which the server streams from until the client goes away.
+    try:
+        if data.get('after_hash') is not None:
+            index = ledger_index.block_index(data['after_hash'])
+            if index is None:
+                return {"status": "failure", "message": "Unknown block hash"}
+            start = index + 1
+        elif data.get('start') is not None:
+            start = max(int(data['start']), 0)
+        else:
+            start = len(blockchain)
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
+    return block_feed.add(BlockSubscription(block_feed, start))
+
+
+def wait_blocks_durable():
+    # Blocks are pushed only once their log record is on disk, so a
+    # subscriber never sees a block that a crash could take back
+    lsn = block_sequencer.journaled_lsn()
+    if lsn is not None:
+        wal.wait_durable(lsn)
+
+
+class BlockSubscription(Subscriber):
+    # position is the index of the next block to send
+    heartbeat_interval = SUBSCRIPTION_HEARTBEAT
+
+    def next_frame(self, heartbeat=False):
+        # The buffered live blocks when they follow on from what was last
+        # sent, otherwise the next page read back from the chain (after a
+        # resume, or after the buffer overflowed)
+        start = self.position
+        blocks = [block for block in self.take() if block['index'] >= start]
+        if not blocks or blocks[0]['index'] != start:
+            end = min(len(blockchain), start + SUBSCRIPTION_PAGE)
+            blocks = blockchain[start:end] if start < end else []
+        blocks = list(blocks[:SUBSCRIPTION_PAGE])
+        blocks = blocks[:page_length([block['tx_count'] for block in blocks])]
+        if not blocks and not heartbeat:
+            return None
+        if blocks:
+            self.position = blocks[-1]['index'] + 1
+            wait_blocks_durable()
+        return encode_json({
+            "status": "success",
+            "blocks": blocks,
+            "next": self.position,
+            "height": len(blockchain),
+            "more": True
+        })
+
+
+# ---------- Replication ----------
+
+# All a follower serves; everything else goes to the primary
+READ_ONLY_ACTIONS = {
+    "get_blockchain", "get_blocks", "subscribe_blocks", "get_tx_proof", "verify_chain",
+    "get_transaction", "get_statement", "get_transactions_in_range",
+    "get_metrics", "get_replication_status", "ping"
+}
+
+
+def handle_replicate(data):
+    # Starts a replicate stream for a follower, resuming after its last
+    # applied log position when it can (see replication.py)
+    if follower is not None:
+        return {"status": "error", "message": "Followers cannot be replicated from; use the primary"}
+    if wal is None:
+        return {"status": "error", "message": "Replication needs the write-ahead log"}
+    try:
+        after_lsn = int(data['after_lsn']) if data.get('after_lsn') is not None else None
+        chain_height = int(data['chain_height']) if data.get('chain_height') is not None else None
+    except (TypeError, ValueError) as e:
+        return {"status": "error", "message": str(e)}
+    stream = ReplicationStream(change_feed, wal, blockchain, after_lsn, chain_height, data.get('chain_tip'))
+    print(f"[BANK] Follower {'resuming' if stream.resumed else 'bootstrapping'} from log position {stream.position}")
+    return change_feed.add(stream)
+
+
+def handle_replication_status():
+    if follower is not None:
+        return dict(follower.status(), status="success")
+    return {
+        "status": "success",
+        "role": "primary",
+        "durable_lsn": wal.durable_lsn if wal is not None else None,
+        "followers": change_feed.stats()["subscribers"]
+    }
+
+
+def replica_reset(bootstrap):
+    # A (re)bootstrap replaces everything this follower holds
+    global blockchain, ledger_index, checkpoint_store
+    user_database.clear()
+    merchant_database.clear()
+    block_sequencer.pending.clear()
+    prepared_payments.clear()
+    blockchain = BlockList()
+    ledger_index = LedgerIndex()
+    # Checkpoints of the old copy say nothing about the new one
+    checkpoint_store = chainverify.CheckpointStore()
+    print(f"[BANK][FOLLOWER] Loading snapshot at log position {bootstrap['lsn']} "
+          f"({bootstrap['chain_height']} blocks)")
+
+
+def replica_load(frame):
+    user_database.update(frame.get("users", {}))
+    merchant_database.update(frame.get("merchants", {}))
+    for block in frame.get("blocks", []):
+        blockchain.append(block)
+        ledger_index.add_block(block)
+        block_feed.publish(block)
+    for tx in frame.get("pending", []):
+        if ledger_index.locate(tx["tx_id"]) is None:
+            block_sequencer.restore(tx)
+
+
+def replica_chain_tip():
+    return len(blockchain), blockchain.header(-1)['hash'] if blockchain else '0'*64
+
+
+def start_follower(host, port):
+    # Read replica mode: no log and no block sealing here, everything comes
+    # from the primary
+    global follower
+    follower = Follower(host, port, replica_reset, replica_load, apply_wal_record, replica_chain_tip)
+    follower.start()
+    return follower
+
+
+# ---------- Metrics ----------
+
+# Requests and latency per action are recorded by handle_frame; the rest is
+# read from the live state when metrics are collected
+metrics = Metrics("bank")
+metrics.gauge("chain_length", lambda: len(blockchain), "Sealed blocks")
+metrics.gauge("user_accounts", lambda: len(user_database), "Registered users")
+metrics.gauge("merchant_accounts", lambda: len(merchant_database), "Registered merchants")
+metrics.gauge("pending_transactions", lambda: len(block_sequencer.pending), "Payments waiting for a block")
+metrics.gauge("wal_last_lsn", lambda: wal.last_lsn if wal is not None else None, "Last write-ahead log position")
+metrics.gauge("idempotency_entries", lambda: idempotency_cache.stats()["entries"])
+metrics.gauge("idempotency_hits", lambda: idempotency_cache.hits)
+metrics.gauge("idempotency_evictions", lambda: idempotency_cache.evictions)
+metrics.gauge("credential_sessions", lambda: credential_hasher.stats()["sessions"])
+metrics.gauge("credential_kdf_runs", lambda: credential_hasher.kdf_runs)
+metrics.gauge("block_subscribers", lambda: block_feed.stats()["subscribers"], "Open subscribe_blocks streams")
+metrics.gauge("replication_followers", lambda: change_feed.stats()["subscribers"], "Open replicate streams")
+metrics.gauge("replication_lag_records", lambda: follower.status()["lag_records"] if follower else None,
+              "Durable primary log records not yet applied here")
+metrics.gauge("replication_lag_seconds", lambda: follower.status()["lag_seconds"] if follower else None,
+              "Seconds since this follower last held everything the primary had made durable")
+metrics.gauge("prepared_payments", lambda: len(prepared_payments) if shard else None,
+              "Cross-shard payments prepared here and not yet committed or aborted")
+metrics.gauge("cross_shard_commits", lambda: shard_router.cross_shard_commits if shard_router else None)
+metrics.gauge("cross_shard_aborts", lambda: shard_router.cross_shard_aborts if shard_router else None)
+metrics.gauge("cross_shard_in_doubt", lambda: len(shard_router.in_doubt) if shard_router else None,
+              "Committed cross-shard payments not yet confirmed by every shard")
+metrics.gauge("admitted_requests", lambda: admission_control.held, "Requests held now, running or queued")
+metrics.gauge("admission_limit", lambda: admission_control.limit)
+metrics.gauge("overloaded_rejections", lambda: admission_control.rejected, "Requests refused as overloaded")
+metrics.gauge("block_subscriber_overflows", lambda: block_feed.overflows,
+              "Times a subscriber fell behind and was caught up from the chain")
+
+
+def handle_get_metrics(data):
+    if data.get('format') == 'prometheus':
+        return {"status": "success", "text": metrics.prometheus()}
+    return dict(metrics.snapshot(), status="success")
+
+
+# Requests that carry credentials or move money are only accepted over an
+# encrypted session (securechannel.py)
+ENCRYPTED_ACTIONS = {
+    "register_user", "register_merchant", "validate_transaction", "validate_transactions",
+    "prepare_payment", "commit_payment", "abort_payment", "replicate"
+}
+
+# Every action a bank or shard router serves. Metrics record any other
+# action as "unknown", so clients cannot add labels of their own.
+ACTIONS = {
+    "register_user", "register_merchant", "validate_transaction", "validate_transactions",
+    "get_blockchain", "get_blocks", "subscribe_blocks", "replicate", "get_replication_status",
+    "prepare_payment", "commit_payment", "abort_payment", "list_prepared", "get_tx_proof",
+    "verify_chain", "get_transaction", "get_statement", "get_transactions_in_range",
+    "get_settlement", "get_idempotency_stats", "get_credential_stats", "get_metrics", "ping",
+    "get_merged_ledger", "get_shards"
+}
+
+# Served by the router process itself in sharded mode; everything else is
+# routed to the shards
+ROUTER_ACTIONS = {"validate_transaction", "validate_transactions", "get_idempotency_stats", "get_metrics", "ping"}
+
+
+def dispatch_request(request, received=None):
+    action = request.get("action")
+
+    if shard_router is not None and action not in ROUTER_ACTIONS:
+        return shard_router.dispatch(request, deadline_from(request, received))
+
+    if follower is not None:
+        if action not in READ_ONLY_ACTIONS:
+            return {"status": "error", "message": "This bank is a read-only follower; send this to the primary"}
+        if not follower.ready and action not in ("ping", "get_replication_status", "get_metrics"):
+            return {"status": "error", "message": "Follower is still loading its copy of the bank"}
+
+    if action == "register_user":
+        return handle_user_registration(request)
+    elif action == "register_merchant":
+        return handle_merchant_registration(request)
+    elif action == "validate_transaction":
+        return handle_transaction_validation(request, received)
+    elif action == "validate_transactions":
+        return handle_transactions_validation(request, received)
+    elif action == "get_blockchain":
+        return handle_get_blockchain()
+    elif action == "get_blocks":
+        return handle_get_blocks(request)
+    elif action == "subscribe_blocks":
+        return handle_subscribe_blocks(request)
+    elif action == "replicate":
+        return handle_replicate(request)
+    elif action == "get_replication_status":
+        return handle_replication_status()
+    elif action == "prepare_payment":
+        return handle_prepare_payment(request)
+    elif action == "commit_payment":
+        return handle_commit_payment(request)
+    elif action == "abort_payment":
+        return handle_abort_payment(request)
+    elif action == "list_prepared":
+        return handle_list_prepared()
+    elif action == "get_tx_proof":
+        return handle_get_tx_proof(request)
+    elif action == "verify_chain":
+        return handle_verify_chain(request)
+    elif action == "get_transaction":
+        return handle_get_transaction(request)
+    elif action == "get_statement":
+        return handle_get_statement(request)
+    elif action == "get_transactions_in_range":
+        return handle_get_transactions_in_range(request)
+    elif action == "get_settlement":
+        return handle_get_settlement(request)
+    elif action == "get_idempotency_stats":
+        return dict(idempotency_cache.stats(), status="success")
+    elif action == "get_credential_stats":
+        return dict(credential_hasher.stats(), status="success")
+    elif action == "get_metrics":
+        return handle_get_metrics(request)
+    elif action == "ping":
+        return {"status": "success"}
+    else:
+        return {"status": "error", "message": "Unknown action"}
+
+
+def handle_frame(body, received=None, encrypted=False):
+    # Returns the reply frame bodies; chain queries may stream several. A
+    # subscribe_blocks request returns its Subscriber instead, for the
+    # server to stream from. Handler time is recorded per action; streaming
+    # a long reply is not part of it. received is when the frame arrived
+    # (time.monotonic()), which the request's timeout_ms counts from;
+    # encrypted is whether it came over an encrypted session.
+    started = time.perf_counter()
+    metrics.start()
+    action = "invalid"
+    try:
+        request = decode_json(body)
+        action = request.get("action")
+        if action in ENCRYPTED_ACTIONS and not encrypted:
+            response = {"status": "error", "message": f"{action} must be sent over an encrypted session"}
+        elif expired(deadline_from(request, received)):
+            # Expired while queued: the client has given up on it
+            metrics.increment("deadline_expired")
+            response = expired_response()
+        else:
+            response = dispatch_request(request, received)
+    except Exception as e:
+        response = {"status": "error", "message": str(e)}
+    if action != "invalid" and not (isinstance(action, str) and action in ACTIONS):
+        action = "unknown"
+    if isinstance(response, Subscriber):
+        metrics.observe(action, time.perf_counter() - started, "success")
+        return response
+    if response.get("message") == "Unknown action":
+        action = "unknown"
+    metrics.observe(action, time.perf_counter() - started, str(response.get("status")))
+    return response_bodies(response)
+
+
+def overloaded_reply():
+    metrics.increment("overloaded")
+    return encode_json(overloaded_response(admission_control.retry_after_ms()))
+
+
+def serve_bank_connection(client_socket, addr):
+    # A connection stays open for as many framed requests as the client sends,
+    # encrypted if the client opened with a handshake. One left idle for
+    # CLIENT_TIMEOUT seconds is closed.
+    session = ServerSession()
+    client_socket.settimeout(CLIENT_TIMEOUT)
+    with client_socket:
+        try:
+            while True:
+                frame = read_frame(client_socket)
+                if frame is None:
+                    break
+                received = time.monotonic()
+                request_id, body = frame
+                body, handshake_reply = session.receive(request_id, body)
+                if handshake_reply is not None:
+                    metrics.increment("handshakes")
+                    write_frame(client_socket, request_id, handshake_reply)
+                    continue
+                entered = admission_control.try_enter()
+                if entered is None:
+                    write_frame(client_socket, request_id, session.send(request_id, overloaded_reply()))
+                    continue
+                try:
+                    replies = handle_frame(body, received, session.encrypted)
+                    if not isinstance(replies, Subscriber):
+                        for reply in replies:
+                            write_frame(client_socket, request_id, session.send(request_id, reply))
+                        continue
+                finally:
+                    admission_control.leave(entered)
+                # The subscription keeps the connection until it closes, and
+                # does not count against the admission limit
+                stream_subscription(client_socket, session, request_id, replies)
+                break
+        except socket.timeout:
+            pass
+        except (ProtocolError, OSError) as e:
+            print(f"[BANK] Connection from {addr} dropped: {e}")
+
+
+def stream_subscription(client_socket, session, request_id, subscriber):
+    # Pushes a subscription's frames as they become available. The first
+    # frame goes out at once; after that, an idle stream gets a heartbeat
+    # frame, which is also how a vanished client is noticed.
+    try:
+        heartbeat = True
+        while True:
+            subscriber.ready.clear()
+            body = subscriber.next_frame(heartbeat)
+            if body is None:
+                heartbeat = not subscriber.ready.wait(subscriber.heartbeat_interval)
+                continue
+            write_frame(client_socket, request_id, session.send(request_id, body))
+            heartbeat = False
+    finally:
+        subscriber.close()
+
+
+def warn_if_unauthenticated(host):
+    warning = unauthenticated_warning(host)
+    if warning:
+        print("[BANK] Warning:", warning)
+
+
+def start_bank_server(host=BANK_HOST, port=BANK_PORT):
+    print(f"[BANK] Starting bank server on {host}:{port}...")
+    warn_if_unauthenticated(host)
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
-        server_socket.bind((BANK_HOST, BANK_PORT))
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((host, port))
         server_socket.listen()
         print("[BANK] Waiting for user/merchant registrations and transaction validations...")
 
         while True:
             client_socket, addr = server_socket.accept()
-            with client_socket:
+            threading.Thread(target=serve_bank_connection, args=(client_socket, addr), daemon=True).start()
+
+# ---------- Asyncio Bank Server ----------
+
+class AsyncBankServer:
+    def __init__(self, host=BANK_HOST, port=BANK_PORT,
+                 max_connections=MAX_CONNECTIONS, max_inflight=MAX_INFLIGHT_REQUESTS):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.max_inflight = max_inflight
+        self.active_connections = 0
+        admission_control.limit = max_inflight
+        self._executor = ThreadPoolExecutor(HANDLER_THREADS, thread_name_prefix="bank-handler")
+
+    async def _handle_request(self, writer, session, request_id, body, received, closed):
+        # Handlers run on worker threads so a slow one never stalls the loop.
+        # Admission control bounds the requests running or waiting for a
+        # thread; past it, the reply goes out at once from the loop.
+        entered = admission_control.try_enter()
+        if entered is None:
+            if not writer.is_closing():
+                writer.write(pack_frame(request_id, session.send(request_id, overloaded_reply())))
+            return
+        try:
+            loop = asyncio.get_running_loop()
+            replies = await loop.run_in_executor(self._executor, handle_frame, body, received,
+                                                 session.encrypted)
+            if isinstance(replies, list):
+                if not writer.is_closing():
+                    writer.write(b"".join(pack_frame(request_id, session.send(request_id, reply))
+                                         for reply in replies))
+                return
+            # Streamed replies are encoded one chunk at a time, and each chunk
+            # waits for the client to drain the previous one
+            while not isinstance(replies, Subscriber) and not writer.is_closing():
+                reply = await loop.run_in_executor(self._executor, next, replies, None)
+                if reply is None:
+                    return
+                writer.write(pack_frame(request_id, session.send(request_id, reply)))
+                await writer.drain()
+        finally:
+            admission_control.leave(entered)
+        # A subscription lasts as long as the connection, so it does not hold
+        # an in-flight slot
+        if isinstance(replies, Subscriber):
+            await self._stream_subscription(writer, session, request_id, replies, closed)
+
+    async def _stream_subscription(self, writer, session, request_id, subscriber, closed):
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+
+        def notify():
+            # Called on the sequencer's thread
+            try:
+                loop.call_soon_threadsafe(wake.set)
+            except RuntimeError:
+                pass  # the loop has shut down
+
+        subscriber.notify = notify
+        heartbeat = True
+        try:
+            while not writer.is_closing() and not closed.is_set():
+                wake.clear()
+                body = await loop.run_in_executor(self._executor, subscriber.next_frame, heartbeat)
+                if body is None:
+                    waits = [asyncio.ensure_future(wake.wait()), asyncio.ensure_future(closed.wait())]
+                    done, pending = await asyncio.wait(waits, timeout=subscriber.heartbeat_interval,
+                                                       return_when=asyncio.FIRST_COMPLETED)
+                    for waiter in pending:
+                        waiter.cancel()
+                    heartbeat = not done
+                    continue
+                writer.write(pack_frame(request_id, session.send(request_id, body)))
+                await writer.drain()
+                heartbeat = False
+        finally:
+            subscriber.close()
+
+    async def _handle_connection(self, reader, writer):
+        if self.active_connections >= self.max_connections:
+            writer.close()
+            return
+
+        self.active_connections += 1
+        tasks = set()
+        session = ServerSession()
+        closed = asyncio.Event()  # ends this connection's subscriptions
+        try:
+            while True:
                 try:
-                    data = client_socket.recv(4096)
-                    if not data:
+                    frame = await read_frame_async(reader, CLIENT_TIMEOUT, CLIENT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # Idle for CLIENT_TIMEOUT. Requests still running (a
+                    # subscription, with its heartbeats) keep it open.
+                    if tasks:
                         continue
+                    break
+                if frame is None:
+                    break
+                # Frames are opened and replies sealed on the loop thread, in
+                # the order they cross the wire
+                received = time.monotonic()
+                request_id, body = frame
+                body, handshake_reply = session.receive(request_id, body)
+                if handshake_reply is not None:
+                    metrics.increment("handshakes")
+                    writer.write(pack_frame(request_id, handshake_reply))
+                    continue
+                # Each frame becomes its own task so pipelined requests on one
+                # connection do not wait for each other
+                task = asyncio.ensure_future(self._handle_request(writer, session, request_id, body, received, closed))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                await writer.drain()
+            closed.set()
+            if tasks:
+                await asyncio.gather(*tasks)
+            await writer.drain()
+        except (ProtocolError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            closed.set()
+            self.active_connections -= 1
+            writer.close()
 
-                    request = json.loads(data.decode())
-                    action = request.get("action")
+    async def serve_forever(self):
+        server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port,
+            backlog=min(self.max_connections, 4096))
+        print(f"[BANK] Async bank server listening on {self.host}:{self.port} "
+              f"(max connections: {self.max_connections}, max in-flight: {self.max_inflight})")
+        warn_if_unauthenticated(self.host)
+        async with server:
+            await server.serve_forever()
 
-                    if action == "register_user":
-                        response = handle_user_registration(request)
-                    elif action == "register_merchant":
-                        response = handle_merchant_registration(request)
-                    elif action == "validate_transaction":
-                        response = handle_transaction_validation(request)
-                    elif action == "get_blockchain":
-                        response = handle_get_blockchain()
-                    else:
-                        response = {"status": "error", "message": "Unknown action"}
 
-                    client_socket.send(json.dumps(response).encode())
-
-                except Exception as e:
-                    error_response = {"status": "error", "message": str(e)}
-                    client_socket.send(json.dumps(error_response).encode())
+def start_async_bank_server(host=BANK_HOST, port=BANK_PORT,
+                            max_connections=MAX_CONNECTIONS, max_inflight=MAX_INFLIGHT_REQUESTS):
+    server = AsyncBankServer(host, port, max_connections, max_inflight)
+    asyncio.run(server.serve_forever())
 
 if __name__ == "__main__":
-    start_bank_server()
\ No newline at end of file
+    args = sys.argv[1:]
+    host = args[args.index("--host") + 1] if "--host" in args else BANK_HOST
+    shard_processes = []
+    if "--follow" in args:
+        # python bank.py --follow PRIMARY_HOST:PORT [--port N]
+        primary_host, primary_port = args[args.index("--follow") + 1].rsplit(":", 1)
+        start_follower(primary_host, int(primary_port))
+        port = int(args[args.index("--port") + 1]) if "--port" in args else REPLICA_PORT
+        metrics_port = REPLICA_METRICS_PORT
+    elif "--shards" in args:
+        # python bank.py --shards N: a router in front of N shard processes
+        count = int(args[args.index("--shards") + 1])
+        shard_processes, addresses = start_shards(count, WAL_DIR, ["--async"] if "--async" in args else [])
+        shard_router = ShardRouter(addresses, os.path.join(WAL_DIR, "router"))
+        shard_router.start_resolver()
+        print(f"[BANK] Routing to {count} shards on ports {addresses[0][1]}-{addresses[-1][1]}")
+        port = int(args[args.index("--port") + 1]) if "--port" in args else BANK_PORT
+        metrics_port = BANK_METRICS_PORT
+    else:
+        data_dir = args[args.index("--data") + 1] if "--data" in args else WAL_DIR
+        if "--shard" in args:
+            # One shard of a sharded bank (started by the router):
+            # --shard INDEX/COUNT
+            index, count = args[args.index("--shard") + 1].split("/")
+            shard = (int(index), int(count))
+        credential_hasher.start()
+        open_wal(data_dir)
+        block_sequencer.start()
+        start_snapshotter()
+        if "--port" in args:
+            port = int(args[args.index("--port") + 1])
+        else:
+            port = SHARD_BASE_PORT + shard[0] if shard else BANK_PORT
+        metrics_port = SHARD_METRICS_BASE_PORT + shard[0] if shard else BANK_METRICS_PORT
+    try:
+        serve_metrics(metrics, host, metrics_port)
+    except OSError as e:
+        print("[BANK] Metrics endpoint not started:", str(e))
+    try:
+        if "--async" in args:
+            start_async_bank_server(host, port)
+        else:
+            start_bank_server(host, port)
+    finally:
+        for process in shard_processes:
+            process.terminate()
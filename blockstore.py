@@ -0,0 +1,228 @@
+# blockstore.py
+#
+# Memory-mapped, fixed-width binary storage for the blockchain.
+#
+# Two files hold the chain:
+#   blocks.dat        one 128-byte header per block
+#   transactions.dat  one 64-byte record per transaction, in chain order
+# Each starts with a 64-byte file header (magic + record count). Hashes and
+# IDs are stored as raw bytes instead of hex strings. Amounts and timestamps
+# are IEEE doubles, the same values the block hashes and Merkle leaves were
+# computed from, so decoded blocks verify exactly.
+#
+# BlockStore behaves like the list of block dicts it replaces (len, indexing,
+# slicing, iteration, append). Blocks are decoded straight out of the mapping
+# only when asked for, so the chain never lives on the Python heap.
+# There is a single writer (the block sequencer) and any number of readers.
+
+import os
+import mmap
+import struct
+import collections.abc
+
+FILE_HEADER = struct.Struct("<8sQ48x")
+BLOCK_RECORD = struct.Struct("<Qd32s32s32sQI4x")
+TX_RECORD = struct.Struct("<32s8s8sdd")
+
+BLOCKS_FILE = "blocks.dat"
+TRANSACTIONS_FILE = "transactions.dat"
+BLOCKS_MAGIC = b"BLKSTOR1"
+TRANSACTIONS_MAGIC = b"TXSTOR01"
+MIN_GROWTH = 1 << 20
+
+# NumPy view of transactions.dat records, for bulk jobs such as settlement
+TX_DTYPE = [("tx_id", "V32"), ("mmid", "V8"), ("merchant_id", "V8"),
+            ("amount", "<f8"), ("timestamp", "<f8")]
+
+
+class _MappedFile:
+    # A file of fixed-width records after a FILE_HEADER, mapped into memory
+    # and grown in place as records are appended
+    def __init__(self, path, magic, record_size, readonly=False):
+        self.path = path
+        self.record_size = record_size
+        self.readonly = readonly
+        exists = os.path.exists(path) and os.path.getsize(path) >= FILE_HEADER.size
+        if not exists:
+            if readonly:
+                raise FileNotFoundError(path)
+            with open(path, "wb") as f:
+                f.write(FILE_HEADER.pack(magic, 0))
+        self._file = open(path, "rb" if readonly else "r+b")
+        self._map()
+        self.magic = magic
+        found, self.count = FILE_HEADER.unpack_from(self.mm, 0)
+        if found != magic:
+            raise ValueError(f"{path} is not a block store file")
+
+    def _map(self):
+        access = mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE
+        # Readers may still hold the old mapping; it stays valid until they
+        # drop it, so it is never closed explicitly
+        self.mm = mmap.mmap(self._file.fileno(), 0, access=access)
+
+    def offset(self, index):
+        return FILE_HEADER.size + index * self.record_size
+
+    def reserve(self, count):
+        needed = self.offset(count)
+        if needed > len(self.mm):
+            size = max(needed, len(self.mm) * 2, len(self.mm) + MIN_GROWTH)
+            self._file.truncate(size)
+            self._map()
+
+    def set_count(self, count):
+        self.count = count
+        FILE_HEADER.pack_into(self.mm, 0, self.magic, count)
+
+    def flush(self):
+        self.mm.flush()
+
+
+class BlockStore(collections.abc.Sequence):
+    def __init__(self, directory, readonly=False):
+        self.directory = directory
+        self.path = os.path.join(directory, BLOCKS_FILE)
+        self._blocks = _MappedFile(self.path, BLOCKS_MAGIC, BLOCK_RECORD.size, readonly)
+        self._txs = _MappedFile(os.path.join(directory, TRANSACTIONS_FILE),
+                                TRANSACTIONS_MAGIC, TX_RECORD.size, readonly)
+        self._txs.count = self._tx_end(len(self))
+
+    # ----- Reading -----
+
+    def __len__(self):
+        return self._blocks.count
+
+    def _tx_end(self, height):
+        if height == 0:
+            return 0
+        record = self._record(height - 1)
+        return record[5] + record[6]
+
+    def _record(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("block index out of range")
+        return BLOCK_RECORD.unpack_from(self._blocks.mm, self._blocks.offset(index))
+
+    def header(self, index):
+        # The block without its transactions, decoded from one record
+        block_index, timestamp, prev_hash, root, block_hash, first_tx, tx_count = self._record(index)
+        return {
+            "index": block_index,
+            "timestamp": timestamp,
+            "prev_hash": prev_hash.hex(),
+            "merkle_root": root.hex(),
+            "tx_count": tx_count,
+            "hash": block_hash.hex()
+        }
+
+    def tx_at(self, block_index, position):
+        return self.transaction(self._record(block_index)[5] + position)
+
+    def transaction(self, number):
+        # Transactions are numbered across the whole chain
+        tx_id, mmid, merchant_id, amount, timestamp = TX_RECORD.unpack_from(
+            self._txs.mm, self._txs.offset(number))
+        return {
+            "tx_id": tx_id.hex(),
+            "mmid": mmid.hex(),
+            "merchant_id": merchant_id.hex(),
+            "amount": amount,
+            "timestamp": timestamp
+        }
+
+    def _block(self, index):
+        block_index, timestamp, prev_hash, root, block_hash, first_tx, tx_count = self._record(index)
+        return {
+            "index": block_index,
+            "timestamp": timestamp,
+            "prev_hash": prev_hash.hex(),
+            "merkle_root": root.hex(),
+            "tx_count": tx_count,
+            "transactions": [self.transaction(n) for n in range(first_tx, first_tx + tx_count)],
+            "hash": block_hash.hex()
+        }
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._block(i) for i in range(*index.indices(len(self)))]
+        return self._block(index)
+
+    def view(self, start=0, end=None):
+        # Lazy sequence over a range of blocks, decoded only when sliced
+        return BlockView(self, start, len(self) if end is None else end)
+
+    def tx_count(self):
+        return self._txs.count
+
+    # ----- Writing -----
+
+    def append(self, block):
+        index = len(self)
+        first_tx = self._txs.count
+        transactions = block["transactions"]
+        self._txs.reserve(first_tx + len(transactions))
+        for n, tx in enumerate(transactions):
+            TX_RECORD.pack_into(self._txs.mm, self._txs.offset(first_tx + n),
+                                bytes.fromhex(tx["tx_id"]), bytes.fromhex(tx["mmid"]),
+                                bytes.fromhex(tx["merchant_id"]), float(tx["amount"]), tx["timestamp"])
+        self._blocks.reserve(index + 1)
+        BLOCK_RECORD.pack_into(self._blocks.mm, self._blocks.offset(index),
+                               block["index"], block["timestamp"], bytes.fromhex(block["prev_hash"]),
+                               bytes.fromhex(block["merkle_root"]), bytes.fromhex(block["hash"]),
+                               first_tx, len(transactions))
+        # Publish the transactions before the block that refers to them
+        self._txs.set_count(first_tx + len(transactions))
+        self._blocks.set_count(index + 1)
+
+    def truncate(self, height):
+        # Forgets blocks past height; recovery replays them from the log
+        if height > len(self):
+            raise ValueError(f"Block store holds {len(self)} blocks, not {height}")
+        self._blocks.set_count(height)
+        self._txs.set_count(self._tx_end(height))
+
+    def flush(self):
+        self._txs.flush()
+        self._blocks.flush()
+
+
+class BlockList(list):
+    # In-memory chain with the same interface as BlockStore, used when the
+    # bank runs without a data directory
+    def header(self, index):
+        return {key: value for key, value in self[index].items() if key != "transactions"}
+
+    def tx_at(self, block_index, position):
+        return self[block_index]["transactions"][position]
+
+    def view(self, start=0, end=None):
+        return self[start:end]
+
+    def truncate(self, height):
+        del self[height:]
+
+    def flush(self):
+        pass
+
+
+class BlockView(collections.abc.Sequence):
+    def __init__(self, store, start, end):
+        self.store = store
+        self.start = start
+        self.end = max(start, end)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return [self.store[self.start + i] for i in range(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("block index out of range")
+        return self.store[self.start + index]
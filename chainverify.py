@@ -0,0 +1,172 @@
+# chainverify.py
+#
+# Verification of the bank's blockchain, shared by the bank and
+# fetch_blocks.py.
+#
+# A block is valid when its index is its position, its prev_hash is the hash
+# of the block before it, its Merkle root matches its transactions, and its
+# hash matches its header. Verifying a long chain from scratch gets slower
+# with every block, so verified positions are recorded as checkpoints. After
+# that, an incremental check re-hashes only the blocks past the latest
+# checkpoint and confirms that every checkpointed block still has the hash
+# it had when it was verified. A full audit re-verifies everything, split
+# across processes.
+
+import os
+import hmac
+import json
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from merkle import tx_leaf_hash, merkle_root, compute_block_hash
+from blockstore import BlockStore
+
+GENESIS_HASH = '0' * 64
+CHECKPOINT_INTERVAL = 1000
+
+
+def block_error(block, index, prev_hash):
+    # Returns why the block is invalid, or None
+    if block.get("index") != index:
+        return f"block at position {index} has index {block.get('index')}"
+    if block["prev_hash"] != prev_hash:
+        return f"block {index} does not link to the block before it"
+    root = merkle_root([tx_leaf_hash(tx) for tx in block["transactions"]])
+    if root != block["merkle_root"] or block["tx_count"] != len(block["transactions"]):
+        return f"block {index} transactions do not match its Merkle root"
+    if compute_block_hash(index, prev_hash, root, block["timestamp"]) != block["hash"]:
+        return f"block {index} hash does not match its header"
+    return None
+
+
+def verify_blocks(blocks, start_index, prev_hash):
+    # Verifies consecutive blocks starting at start_index.
+    # Returns (None, None) or (bad index, reason).
+    for offset, block in enumerate(blocks):
+        error = block_error(block, start_index + offset, prev_hash)
+        if error:
+            return start_index + offset, error
+        prev_hash = block["hash"]
+    return None, None
+
+
+def _verify_job(job):
+    blocks, start_index, prev_hash = job[:3]
+    if isinstance(blocks, str):
+        # A block store directory plus a range: the worker maps the store
+        # itself instead of receiving the decoded blocks
+        store = BlockStore(blocks, readonly=True)
+        blocks = store.view(start_index, start_index + job[3])
+    return verify_blocks(blocks, start_index, prev_hash)
+
+
+def _block_hash(chain, index):
+    return chain.header(index)["hash"] if hasattr(chain, "header") else chain[index]["hash"]
+
+
+def full_audit(chain, workers=None, chunk_size=2000, height=None):
+    # Re-verifies every block in parallel. Each range links to the stored
+    # hash of the block before it, and that block's own range checks that
+    # hash, so together the ranges cover every link.
+    height = len(chain) if height is None else height
+    directory = getattr(chain, "directory", None)
+    jobs = []
+    for start in range(0, height, chunk_size):
+        prev_hash = _block_hash(chain, start - 1) if start else GENESIS_HASH
+        size = min(chunk_size, height - start)
+        if directory:
+            jobs.append((directory, start, prev_hash, size))
+        else:
+            jobs.append((chain[start:start + size], start, prev_hash))
+    if len(jobs) <= 1 or workers == 1:
+        results = map(_verify_job, jobs)
+        return next(((i, e) for i, e in results if i is not None), (None, None))
+    # Workers are spawned, not forked: the bank audits from a request thread,
+    # and a forked child could inherit a lock another thread was holding
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        for bad_index, error in pool.map(_verify_job, jobs):
+            if bad_index is not None:
+                return bad_index, error
+    return None, None
+
+
+class CheckpointStore:
+    # Verified (index, hash) positions, kept in a JSON file. With a key, each
+    # checkpoint carries an HMAC so edits to the file are caught; without one
+    # the file is trusted as is, as for a client's own copy.
+    def __init__(self, path=None, key=None, interval=CHECKPOINT_INTERVAL):
+        self.path = path
+        self.key = key.encode() if isinstance(key, str) else key
+        self.interval = interval
+        self.checkpoints = []
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for entry in json.load(f):
+                    if self.key and not hmac.compare_digest(entry.get("mac", ""), self._mac(entry)):
+                        raise ValueError(f"Checkpoint {entry['index']} in {path} has a bad signature")
+                    self.checkpoints.append(entry)
+
+    def _mac(self, entry):
+        return hmac.new(self.key, f"{entry['index']}:{entry['hash']}".encode(), hashlib.sha256).hexdigest()
+
+    def latest(self):
+        return self.checkpoints[-1] if self.checkpoints else None
+
+    def add(self, index, block_hash):
+        entry = {"index": index, "hash": block_hash}
+        if self.key:
+            entry["mac"] = self._mac(entry)
+        self.checkpoints.append(entry)
+        if self.path:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.checkpoints, f)
+            os.replace(tmp_path, self.path)
+
+    def reset(self):
+        self.checkpoints = []
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def verify_chain(chain, checkpoints=None, full=False, workers=None):
+    # Incremental by default: checks every checkpoint and the blocks after the
+    # latest one, then checkpoints the newly verified blocks. full=True
+    # audits the whole chain in parallel.
+    height = len(chain)
+    if checkpoints is None:
+        checkpoints = CheckpointStore()
+
+    if full:
+        bad_index, error = full_audit(chain, workers, height=height)
+        verified_from = 0
+    else:
+        bad_index, error = None, None
+        for checkpoint in checkpoints.checkpoints:
+            index = checkpoint["index"]
+            if index >= height or _block_hash(chain, index) != checkpoint["hash"]:
+                bad_index, error = index, f"block {index} no longer matches its checkpoint"
+                break
+        latest = checkpoints.latest()
+        verified_from = latest["index"] + 1 if latest else 0
+        if bad_index is None:
+            prev_hash = _block_hash(chain, verified_from - 1) if verified_from else GENESIS_HASH
+            bad_index, error = verify_blocks(chain[verified_from:height], verified_from, prev_hash)
+
+    if bad_index is not None:
+        return {"status": "failure", "index": bad_index, "message": error, "height": height}
+
+    # Checkpoint every interval boundary that is now verified
+    latest = checkpoints.latest()
+    next_index = (latest["index"] if latest else -1) + checkpoints.interval
+    while next_index < height:
+        checkpoints.add(next_index, _block_hash(chain, next_index))
+        next_index += checkpoints.interval
+
+    return {
+        "status": "success",
+        "height": height,
+        "verified_blocks": height - verified_from,
+        "checkpoint": checkpoints.latest()["index"] if checkpoints.latest() else None
+    }
@@ -0,0 +1,139 @@
+# credentials.py
+#
+# Salted scrypt storage for passwords and PINs.
+#
+# A stored secret looks like
+#   scrypt$<n>$<r>$<p>$<salt hex>$<key hex>
+# so the cost parameters can be raised later without breaking old accounts.
+# scrypt is deliberately slow and memory-hungry (about 16 MiB and tens of
+# milliseconds per check with the defaults), so it runs in a process pool and
+# never inside a request loop.
+#
+# Repeat payments from the same account skip the KDF through a short-lived,
+# bounded cache of verified sessions. Only a secret that matches the cached
+# session is answered from the cache; any other guess goes through the full
+# KDF, so guessing a PIN costs as much as it did without the cache.
+
+import os
+import hmac
+import time
+import hashlib
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+KDF_N = 2 ** 14
+KDF_R = 8
+KDF_P = 1
+KDF_KEY_BYTES = 32
+SALT_BYTES = 16
+KDF_PREFIX = "scrypt"
+
+
+def _derive(secret, salt, n, r, p):
+    return hashlib.scrypt(secret.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=2 * 128 * r * (n + p + 2), dklen=KDF_KEY_BYTES)
+
+
+def hash_secret(secret):
+    salt = os.urandom(SALT_BYTES)
+    key = _derive(str(secret), salt, KDF_N, KDF_R, KDF_P)
+    return f"{KDF_PREFIX}${KDF_N}${KDF_R}${KDF_P}${salt.hex()}${key.hex()}"
+
+
+def is_hashed(stored):
+    return isinstance(stored, str) and stored.startswith(KDF_PREFIX + "$")
+
+
+def check_secret(secret, stored):
+    if not is_hashed(stored):
+        # Secrets are only ever stored hashed; anything else never matches
+        return False
+    _, n, r, p, salt, key = stored.split("$")
+    derived = _derive(str(secret), bytes.fromhex(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(derived, bytes.fromhex(key))
+
+
+class CredentialHasher:
+    def __init__(self, workers, session_ttl, max_sessions):
+        self.workers = workers
+        self.session_ttl = session_ttl
+        self.max_sessions = max_sessions
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        # account -> (expires_at, tag); least recently used first
+        self._sessions = collections.OrderedDict()
+        self._sessions_lock = threading.Lock()
+        # Tags are keyed with a secret that never leaves this process
+        self._session_key = os.urandom(32)
+        self.kdf_runs = 0
+        self.session_hits = 0
+
+    def start(self):
+        # Starts the worker processes; call before the server spawns threads
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.workers)
+        return self._pool
+
+    def hash_many(self, secrets):
+        pool = self.start()
+        return list(pool.map(hash_secret, [str(secret) for secret in secrets]))
+
+    def hash(self, secret):
+        return self.hash_many([secret])[0]
+
+    def _tag(self, account, secret, stored):
+        message = f"{account}\x00{stored}\x00{secret}".encode()
+        return hmac.new(self._session_key, message, hashlib.sha256).digest()
+
+    def _session_matches(self, account, tag):
+        with self._sessions_lock:
+            session = self._sessions.get(account)
+            if session is None:
+                return False
+            if session[0] < time.monotonic():
+                del self._sessions[account]
+                return False
+            if not hmac.compare_digest(session[1], tag):
+                return False
+            self._sessions.move_to_end(account)
+            self.session_hits += 1
+            return True
+
+    def _remember(self, account, tag):
+        with self._sessions_lock:
+            self._sessions[account] = (time.monotonic() + self.session_ttl, tag)
+            self._sessions.move_to_end(account)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def verify_many(self, checks):
+        # checks are (account, secret, stored) triples; returns one bool per
+        # check. Checks that miss the session cache run in parallel.
+        results = [None] * len(checks)
+        tags = [self._tag(account, secret, stored) for account, secret, stored in checks]
+        misses = []
+        for i, (account, _, _) in enumerate(checks):
+            if self._session_matches(account, tags[i]):
+                results[i] = True
+            else:
+                misses.append(i)
+        if misses:
+            pool = self.start()
+            with self._sessions_lock:
+                self.kdf_runs += len(misses)
+            futures = [pool.submit(check_secret, str(checks[i][1]), checks[i][2]) for i in misses]
+            for i, future in zip(misses, futures):
+                results[i] = future.result()
+                if results[i]:
+                    self._remember(checks[i][0], tags[i])
+        return results
+
+    def verify(self, account, secret, stored):
+        return self.verify_many([(account, secret, stored)])[0]
+
+    def stats(self):
+        with self._sessions_lock:
+            return {"sessions": len(self._sessions), "session_hits": self.session_hits,
+                    "kdf_runs": self.kdf_runs}
@@ -0,0 +1,106 @@
+# deadlines.py
+#
+# Deadlines and load shedding along the payment path (user -> merchant ->
+# bank).
+#
+# A request may carry "timeout_ms": how long its sender will wait for the
+# answer. Each hop turns it into a local deadline (time.monotonic(), counted
+# from when the frame was received, so clocks need not agree between hosts)
+# and forwards what is left of it. Work whose deadline has passed is dropped
+# instead of done: nobody is waiting for its answer.
+#
+# A server admits at most `limit` requests at once, running or waiting for a
+# handler. Beyond that it answers at once with status "overloaded" and a
+# retry_after_ms hint, instead of queueing work it cannot finish in time.
+
+import math
+import time
+import threading
+
+# Retry hints stay within these bounds
+RETRY_AFTER_MIN_MS = 10
+RETRY_AFTER_MAX_MS = 5000
+
+
+def deadline_from(request, received, default=None):
+    # The deadline for a request received at `received`, from its
+    # timeout_ms, else `default` seconds; None means no deadline. Requests
+    # that did not come off the wire (received is None) have none.
+    if received is None:
+        return None
+    timeout_ms = request.get("timeout_ms") if isinstance(request, dict) else None
+    if timeout_ms is not None:
+        return received + max(float(timeout_ms), 0.0) / 1000
+    return received + default if default is not None else None
+
+
+def remaining(deadline):
+    # Seconds left, never negative; None without a deadline
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0.0)
+
+
+def expired(deadline):
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def with_deadline(request, deadline):
+    # The request to forward downstream, carrying what is left of the deadline
+    if deadline is None:
+        return request
+    return dict(request, timeout_ms=int(remaining(deadline) * 1000))
+
+
+def expired_response():
+    # Only for work that was dropped before it started
+    return {"status": "expired", "message": "Deadline exceeded; the request was not processed"}
+
+
+def overloaded_response(retry_after_ms):
+    return {"status": "overloaded", "message": f"Overloaded, retry after {retry_after_ms} ms",
+            "retry_after_ms": retry_after_ms}
+
+
+class AdmissionControl:
+    def __init__(self, limit):
+        self.limit = limit
+        self.held = 0
+        self._hold_time = 0.0     # moving average of how long a request holds its slot
+        self._lock = threading.Lock()
+
+        # Counters
+        self.admitted = 0
+        self.rejected = 0
+
+    def try_enter(self):
+        # Returns the admission time, or None when the server is full
+        with self._lock:
+            if self.held >= self.limit:
+                self.rejected += 1
+                return None
+            self.held += 1
+            self.admitted += 1
+        return time.monotonic()
+
+    def leave(self, entered):
+        held_for = time.monotonic() - entered
+        with self._lock:
+            self.held -= 1
+            self._hold_time += (held_for - self._hold_time) * 0.05
+
+    def retry_after_ms(self):
+        # About how long the requests queued now take to get through
+        with self._lock:
+            estimate = math.ceil(self._hold_time * 1000)
+        return min(max(estimate, RETRY_AFTER_MIN_MS), RETRY_AFTER_MAX_MS)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "limit": self.limit,
+                "held": self.held,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "hold_time_ms": round(self._hold_time * 1000, 3)
+            }
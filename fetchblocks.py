@@ -1,23 +1,139 @@
-# fetch_blocks.py
-
-import socket, json
-
-BANK_HOST = '192.168.1.7'
-BANK_PORT = 9999
-
-def fetch_blockchain():
-    req = {"action": "get_blockchain"}
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((BANK_HOST, BANK_PORT))
-        s.send(json.dumps(req).encode())
-        response = json.loads(s.recv(65536).decode())
-        return response
-
-response = fetch_blockchain()
-if response['status'] == 'success':
-    for i, block in enumerate(response['chain']):
-        print(f"\n--- Block {i} ---")
-        for key, value in block.items():
-            print(f"{key}: {value}")
-else:
-    print("Error:", response.get("message"))
+# fetch_blocks.py
+
+import os
+import sys
+import json
+import time
+
+from protocol import Connection, ProtocolError
+from chainverify import CheckpointStore, verify_chain
+
+BANK_HOST = '192.168.1.7'
+BANK_PORT = 9999
+
+# Blocks already fetched are kept locally, one JSON block per line, so each
+# run only asks the bank for what is new
+CACHE_FILE = 'fetched_blocks.jsonl'
+CHECKPOINT_FILE = 'fetched_checkpoints.json'
+PAGE_SIZE = 1000
+
+# --follow keeps a subscribe_blocks stream open. The bank sends a heartbeat
+# while no blocks are sealed, so a silent connection is treated as lost.
+FOLLOW_TIMEOUT = 30
+RECONNECT_DELAY = 2
+
+
+def load_cached_blocks(path=CACHE_FILE):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_cached_blocks(blocks, path=CACHE_FILE, append=True):
+    with open(path, "a" if append else "w") as f:
+        for block in blocks:
+            f.write(json.dumps(block) + "\n")
+
+
+def fetch_blockchain(known_blocks=None, page_size=PAGE_SIZE, bank_host=BANK_HOST, bank_port=BANK_PORT):
+    # Pages through the blocks after the last known one. The returned chain
+    # is known_blocks plus the new blocks; "new" counts the latter.
+    chain = list(known_blocks or [])
+    fetched = 0
+    with Connection(bank_host, bank_port) as conn:
+        while True:
+            req = {"action": "get_blocks", "limit": page_size}
+            if chain:
+                req["after_hash"] = chain[-1]['hash']
+            else:
+                req["start"] = 0
+            response = conn.request(req)
+            if response['status'] != 'success':
+                if chain and response.get('message') == 'Unknown block hash':
+                    # Our copy does not belong to this bank's chain; start over
+                    chain = []
+                    fetched = 0
+                    continue
+                return response
+            chain.extend(response['blocks'])
+            fetched += len(response['blocks'])
+            if not response['blocks'] or response['next'] >= response['height']:
+                return {"status": "success", "chain": chain, "new": fetched}
+
+
+def follow_blocks(chain, on_blocks, bank_host=BANK_HOST, bank_port=BANK_PORT):
+    # Receives new blocks as the bank seals them and hands each batch to
+    # on_blocks. After a dropped connection it resumes after the last block
+    # it has. Returns only when the bank refuses the subscription.
+    while True:
+        request = {"action": "subscribe_blocks"}
+        if chain:
+            request["after_hash"] = chain[-1]['hash']
+        else:
+            request["start"] = 0
+        try:
+            with Connection(bank_host, bank_port, timeout=FOLLOW_TIMEOUT) as conn:
+                for response in conn.request_stream(request):
+                    if response['status'] != 'success':
+                        return response
+                    if response['blocks']:
+                        chain.extend(response['blocks'])
+                        on_blocks(response['blocks'])
+        except (OSError, ProtocolError) as e:
+            print(f"Subscription lost ({e}), reconnecting...")
+            time.sleep(RECONNECT_DELAY)
+
+
+def print_block(block):
+    print(f"\n--- Block {block['index']} ---")
+    for key, value in block.items():
+        print(f"{key}: {value}")
+
+
+def main():
+    # --audit re-verifies the whole cached chain in parallel instead of only
+    # the blocks past the last checkpoint; --follow then keeps printing new
+    # blocks as they are sealed
+    full_audit = "--audit" in sys.argv[1:]
+    follow = "--follow" in sys.argv[1:]
+    cached = load_cached_blocks()
+    response = fetch_blockchain(cached)
+    if response['status'] == 'success':
+        chain = response['chain']
+        new_start = len(chain) - response['new']
+        checkpoints = CheckpointStore(CHECKPOINT_FILE)
+        if new_start < len(cached):
+            checkpoints.reset()
+            save_cached_blocks(chain, append=False)
+        else:
+            save_cached_blocks(chain[new_start:])
+        for i in range(new_start, len(chain)):
+            print_block(chain[i])
+        print(f"\n{response['new']} new blocks, {len(chain)} in total")
+
+        result = verify_chain(chain, checkpoints, full=full_audit)
+        if result['status'] == 'success':
+            print(f"Chain verified ({result['verified_blocks']} blocks checked)")
+        else:
+            print(f"Chain verification FAILED at block {result['index']}: {result['message']}")
+            return
+
+        if follow:
+            def on_blocks(blocks):
+                save_cached_blocks(blocks)
+                for block in blocks:
+                    print_block(block)
+                result = verify_chain(chain, checkpoints)
+                if result['status'] != 'success':
+                    print(f"Chain verification FAILED at block {result['index']}: {result['message']}")
+                    sys.exit(1)
+
+            print("Waiting for new blocks...")
+            response = follow_blocks(chain, on_blocks)
+            print("Subscription refused:", response.get("message"))
+    else:
+        print("Error:", response.get("message"))
+
+if __name__ == "__main__":
+    main()
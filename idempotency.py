@@ -0,0 +1,110 @@
+# idempotency.py
+#
+# Result cache that makes retried payments safe. A client tags a payment with
+# an idempotency key; the first request with that key runs and its response is
+# kept, and any retry within the TTL gets the same response back without
+# running again.
+#
+# Entries expire `ttl` seconds after they are stored and the cache never holds
+# more than `max_entries`; the oldest entry is evicted first. Because every
+# entry has the same TTL, insertion order is also expiry order, so lookups,
+# inserts, expiry and eviction are all O(1).
+
+import time
+import threading
+import collections
+
+
+class _InFlight:
+    # A request that has claimed its key and not finished yet
+    __slots__ = ("fingerprint", "done", "response")
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.done = threading.Event()
+        self.response = None
+
+
+class IdempotencyCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()  # key -> (expires_at, fingerprint, response)
+        self._in_flight = {}                       # key -> _InFlight
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _expire(self, now):
+        while self._entries:
+            key, (expires_at, _, _) = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[key]
+            self.expirations += 1
+
+    def claim(self, key, fingerprint, wait=True):
+        # Returns the stored response for a key seen before, or None after
+        # reserving the key for the caller, who must then call complete() or
+        # release(). A retry that arrives while the first request is still
+        # running waits for its response (or, with wait=False, is told the
+        # payment is in progress). Reusing a key for a different payment is
+        # an error.
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                if entry[1] != fingerprint:
+                    return _mismatch()
+                return entry[2]
+            in_flight = self._in_flight.get(key)
+            if in_flight is None:
+                self.misses += 1
+                self._in_flight[key] = _InFlight(fingerprint)
+                return None
+            self.hits += 1
+        if in_flight.fingerprint != fingerprint:
+            return _mismatch()
+        if not wait:
+            return {"status": "error", "message": "A payment with this idempotency key is in progress"}
+        in_flight.done.wait()
+        if in_flight.response is None:
+            return {"status": "error", "message": "The original payment did not complete; retry it"}
+        return in_flight.response
+
+    def complete(self, key, response):
+        with self._lock:
+            in_flight = self._in_flight.pop(key, None)
+            self._entries[key] = (time.monotonic() + self.ttl, in_flight.fingerprint if in_flight else None, response)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        if in_flight is not None:
+            in_flight.response = response
+            in_flight.done.set()
+
+    def release(self, key):
+        # Gives up a claimed key without storing a response, so the payment
+        # can be retried
+        with self._lock:
+            in_flight = self._in_flight.pop(key, None)
+        if in_flight is not None:
+            in_flight.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+
+def _mismatch():
+    return {"status": "error", "message": "Idempotency key was already used for a different payment"}
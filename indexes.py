@@ -0,0 +1,59 @@
+# indexes.py
+#
+# In-memory secondary indexes over the bank's sealed blocks, so statements and
+# lookups do not have to scan the chain. Every transaction is identified by
+# its position: (block index, position inside the block).
+#
+# The indexes have a single writer (the block sequencer, through add_block)
+# and any number of readers. Every update is a single list or dict
+# operation, so under the GIL readers never see a half-applied change.
+
+import bisect
+import collections
+
+
+class LedgerIndex:
+    def __init__(self):
+        self.by_tx = {}                                   # tx_id -> position
+        self.by_mmid = collections.defaultdict(list)      # mmid -> positions, chain order
+        self.by_merchant = collections.defaultdict(list)  # merchant_id -> positions, chain order
+        self.by_time = []                                 # (timestamp, block, position), sorted
+        self.by_hash = {}                                 # block hash -> block index
+
+    def add_block(self, block):
+        index = block["index"]
+        self.by_hash[block["hash"]] = index
+        for position, tx in enumerate(block["transactions"]):
+            location = (index, position)
+            self.by_tx[tx["tx_id"]] = location
+            self.by_mmid[tx["mmid"]].append(location)
+            self.by_merchant[tx["merchant_id"]].append(location)
+            # Timestamps are taken before payments reach the sequencer, so
+            # they are only nearly in order; the insert point is at or near
+            # the end and costs little
+            bisect.insort(self.by_time, (tx["timestamp"], index, position))
+
+    def locate(self, tx_id):
+        return self.by_tx.get(tx_id)
+
+    def block_index(self, block_hash):
+        return self.by_hash.get(block_hash)
+
+    def account_positions(self, mmid=None, merchant_id=None, offset=0, limit=100):
+        # Newest first, skipping `offset` entries; also returns the total
+        if mmid is not None:
+            positions = self.by_mmid.get(mmid, [])
+        else:
+            positions = self.by_merchant.get(merchant_id, [])
+        total = len(positions)
+        end = max(total - offset, 0)
+        start = max(end - limit, 0)
+        return positions[start:end][::-1], total
+
+    def time_range(self, start_time, end_time, offset=0, limit=100):
+        # Oldest first, for timestamps in [start_time, end_time); also returns
+        # the number of matches
+        lo = bisect.bisect_left(self.by_time, (start_time,))
+        hi = bisect.bisect_left(self.by_time, (end_time,))
+        entries = self.by_time[lo + offset:min(lo + offset + limit, hi)]
+        return [(index, position) for _, index, position in entries], max(hi - lo, 0)
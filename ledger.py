@@ -0,0 +1,147 @@
+# ledger.py
+#
+# Concurrency control for the bank's shared state. Transfers lock only the
+# two accounts they touch, so payments between unrelated users and merchants
+# can be validated in parallel, and every block goes through one sequencer
+# so the chain stays correctly linked.
+
+import time
+import threading
+import collections
+from contextlib import contextmanager
+
+
+def user_key(mmid):
+    return ("user", mmid)
+
+
+def merchant_key(merchant_id):
+    return ("merchant", merchant_id)
+
+
+class AccountLocks:
+    # One lock per account, created the first time the account is touched
+    def __init__(self):
+        self._locks = {}
+        self._registry_lock = threading.Lock()
+
+    def _lock_for(self, key):
+        lock = self._locks.get(key)
+        if lock is None:
+            with self._registry_lock:
+                lock = self._locks.setdefault(key, threading.Lock())
+        return lock
+
+    @contextmanager
+    def hold(self, *keys):
+        # Locks are always taken in sorted key order, so two transfers that
+        # share accounts can never wait on each other in a cycle
+        locks = [self._lock_for(key) for key in sorted(set(keys))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+
+class BlockSequencer:
+    # The only writer of the chain. Transactions queue up in arrival order and
+    # are sealed into one block when max_transactions are pending or the
+    # oldest has waited max_wait seconds. seal(transactions) builds and
+    # appends the block; it runs under the sequencer lock, so it always sees
+    # the real tip.
+    #
+    # With a journal attached, each transaction's record and each sealed
+    # block are journaled under the same lock, so the log order always
+    # matches the chain. Memory is updated first, so anything that reads the
+    # state after seeing a log position also sees that change.
+    def __init__(self, seal, max_transactions, max_wait, journal=None):
+        self.seal = seal
+        self.max_transactions = max_transactions
+        self.max_wait = max_wait
+        self.journal = journal
+        self.pending = collections.OrderedDict()  # tx_id -> transaction
+        self.last_lsn = None                      # log position of the last journaled record
+        self._oldest_pending = None
+        self._lock = threading.Lock()
+
+    def add(self, tx, record=None):
+        # Queues a transaction and returns the log position of its record
+        # (None without a journal)
+        return self.add_batch([(tx, record)])
+
+    def add_batch(self, entries):
+        # Queues (tx, record) pairs in one step: they are journaled back to
+        # back and sealed into the same block, which may then run past
+        # max_transactions by up to one batch. Returns the log position of
+        # the last record.
+        with self._lock:
+            if entries and not self.pending:
+                self._oldest_pending = time.monotonic()
+            lsn = None
+            for tx, record in entries:
+                self.pending[tx["tx_id"]] = tx
+                if self.journal is not None and record is not None:
+                    lsn = self.last_lsn = self.journal(dict(record, tx=tx))
+            if len(self.pending) >= self.max_transactions:
+                self._seal_pending()
+            return lsn
+
+    def restore(self, tx):
+        # Queues a transaction recovered from a snapshot or the log, without
+        # journaling it again. Its wait for a block starts now.
+        with self._lock:
+            if not self.pending:
+                self._oldest_pending = time.monotonic()
+            self.pending[tx["tx_id"]] = tx
+
+    def _seal_pending(self):
+        transactions = list(self.pending.values())
+        self.pending.clear()
+        block = self.seal(transactions)
+        if self.journal is not None:
+            self.last_lsn = self.journal({"type": "block", "block": block})
+        return block
+
+    def flush(self, only_if_due=False):
+        # Seals whatever is pending; with only_if_due, only once the oldest
+        # pending transaction has waited max_wait
+        with self._lock:
+            if not self.pending:
+                return None
+            if only_if_due and time.monotonic() - self._oldest_pending < self.max_wait:
+                return None
+            return self._seal_pending()
+
+    def journaled_lsn(self):
+        # Log position covering every block sealed so far. Taking the lock
+        # waits out a seal in progress, whose block is journaled after
+        # seal() returns.
+        with self._lock:
+            return self.last_lsn
+
+    def pending_transactions(self):
+        with self._lock:
+            return list(self.pending.values())
+
+    def sealed_and_pending(self, sealed_count):
+        # sealed_count() and the pending transactions, read together so that
+        # every queued transaction is counted in exactly one of them
+        with self._lock:
+            return sealed_count(), list(self.pending.values())
+
+    def start(self):
+        # Background thread that seals partly filled blocks on time
+        def run():
+            while True:
+                time.sleep(self.max_wait / 4)
+                try:
+                    self.flush(only_if_due=True)
+                except Exception as e:
+                    print("[BANK] Sealing block failed:", str(e))
+
+        thread = threading.Thread(target=run, name="block-sequencer", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,110 @@
+# ledger_stress.py
+#
+# Stress test for the bank's ledger locking. Many threads push random
+# payments through handle_transaction_validation at the same time; at the end
+# the money in the system must be exactly what it was at the start, no
+# balance may be negative, and the correctly linked chain must hold exactly
+# one transaction per approved payment.
+#
+# Run with: python ledger_stress.py [threads] [payments_per_thread]
+
+import io
+import sys
+import random
+import threading
+import contextlib
+
+import bank
+
+USERS = 50
+MERCHANTS = 10
+START_BALANCE = 10000.0
+
+
+def setup():
+    users = []
+    for i in range(USERS):
+        response = bank.handle_user_registration({
+            "name": f"user{i}", "password": "pw", "ifsc_code": "IFSC0001",
+            "balance": START_BALANCE, "pin_code": "1234", "phone_number": f"90000{i:05d}"
+        })
+        users.append(response["mmid"])
+    merchants = []
+    for i in range(MERCHANTS):
+        response = bank.handle_merchant_registration({
+            "name": f"merchant{i}", "password": "pw", "ifsc_code": "IFSC0001", "balance": 0.0
+        })
+        merchants.append(response["merchant_id"])
+    return users, merchants
+
+
+def total_money():
+    return (sum(u["balance"] for u in bank.user_database.values()) +
+            sum(m["balance"] for m in bank.merchant_database.values()))
+
+
+def worker(users, merchants, payments, approved, seed):
+    rng = random.Random(seed)
+    count = 0
+    for _ in range(payments):
+        # Whole-number amounts keep float sums exact; some payments overdraw
+        response = bank.handle_transaction_validation({
+            "mmid": rng.choice(users),
+            "pin": "1234",
+            "amount": rng.randint(1, 60),
+            "encrypted_merchant_id": rng.choice(merchants),
+        })
+        if response["status"] == "success":
+            count += 1
+    approved.append(count)
+
+
+def run(threads=16, payments_per_thread=2000):
+    # Switch threads as often as possible to provoke interleavings
+    sys.setswitchinterval(1e-6)
+    with contextlib.redirect_stdout(io.StringIO()):
+        users, merchants = setup()
+        before = total_money()
+        approved = []
+        pool = [threading.Thread(target=worker, args=(users, merchants, payments_per_thread, approved, seed))
+                for seed in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+    after = total_money()
+    bank.block_sequencer.flush()
+    transactions = [tx for block in bank.blockchain for tx in block["transactions"]]
+
+    failures = []
+    if before != after:
+        failures.append(f"money not conserved: {before} before, {after} after")
+    negative = [mmid for mmid, u in bank.user_database.items() if u["balance"] < 0]
+    if negative:
+        failures.append(f"{len(negative)} users overdrawn")
+    if len(transactions) != sum(approved):
+        failures.append(f"{len(transactions)} transactions in the chain for {sum(approved)} approved payments")
+    for prev, block in zip(bank.blockchain, bank.blockchain[1:]):
+        if block["prev_hash"] != prev["hash"]:
+            failures.append(f"chain broken at block {block['index']}")
+            break
+    spent = {}
+    for tx in transactions:
+        spent[tx["mmid"]] = spent.get(tx["mmid"], 0) + tx["amount"]
+    for mmid, u in bank.user_database.items():
+        if START_BALANCE - spent.get(mmid, 0) != u["balance"]:
+            failures.append(f"user {mmid} balance does not match the chain")
+            break
+
+    print(f"[STRESS] {threads} threads x {payments_per_thread} payments, "
+          f"{sum(approved)} approved, total money {before} -> {after}")
+    for failure in failures:
+        print("[STRESS] FAILED:", failure)
+    if not failures:
+        print("[STRESS] OK: balances conserved and chain consistent")
+    return not failures
+
+
+if __name__ == "__main__":
+    args = [int(a) for a in sys.argv[1:3]]
+    sys.exit(0 if run(*args) else 1)
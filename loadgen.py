@@ -0,0 +1,319 @@
+# loadgen.py
+#
+# End-to-end load generator for the user -> merchant -> bank flow.
+#
+# Starts a bank and N merchants as separate processes on loopback, registers
+# M synthetic users through User.register_with_bank, then drives payments at
+# a fixed target rate. The load is open-loop: payments are started on
+# schedule whether or not earlier ones have finished, and latency is measured
+# from the scheduled start, so a slow server cannot hide its queueing delay.
+# A share of the traffic also asks the bank for Merkle proofs of earlier
+# payments.
+#
+# Throughput, p50/p95/p99 latency and error rates per action are printed and
+# written as JSON, so runs can be compared over time.
+#
+# Run with:
+#   python loadgen.py [--merchants N] [--users M] [--rate R] [--duration S]
+#                     [--proof-ratio F] [--async] [--out FILE]
+
+import io
+import os
+import sys
+import json
+import time
+import queue
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import contextlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import Connection
+from user import User
+from qrcodes import ensure_qr
+
+HOST = '127.0.0.1'
+DEFAULTS = {
+    "merchants": 4,
+    "users": 200,
+    "rate": 200.0,         # payments started per second
+    "duration": 30.0,      # seconds of payment traffic
+    "proof_ratio": 0.1,    # extra get_tx_proof requests per payment
+    "threads": 256,        # most requests in flight at once (one payment per user)
+}
+START_BALANCE = 1e9
+PIN = "1234"
+
+
+# ---------- Servers (child processes) ----------
+
+def serve_bank(port, data_dir, use_async):
+    import bank
+    bank.credential_hasher.start()
+    bank.open_wal(data_dir)
+    bank.block_sequencer.start()
+    bank.start_snapshotter()
+    if use_async:
+        bank.start_async_bank_server(HOST, port)
+    else:
+        bank.start_bank_server(HOST, port)
+
+
+def serve_merchant(port, bank_port, qr_dir, index):
+    import merchant
+    merchant.MERCHANT_HOST = HOST
+    merchant.MERCHANT_PORT = port
+    m = merchant.Merchant(f"merchant{index}", "pw", "LOAD0001", 0.0, headless=True, qr_dir=qr_dir)
+    m.bank_pool = merchant.BankConnectionPool(HOST, bank_port)
+    m.payment_batcher = merchant.PaymentBatcher(m._bank_request)
+    with contextlib.redirect_stdout(io.StringIO()):
+        m.register_with_bank()
+    # register_with_bank cached the VMID next to the QR code
+    vmid = ensure_qr(m.merchant_id, key=m.key, directory=qr_dir)[0]
+    # The parent reads this line; everything after it is discarded
+    print("READY", json.dumps({"merchant_id": m.merchant_id, "vmid": vmid}), flush=True)
+    sys.stdout = open(os.devnull, "w")
+    m.start_server()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with Connection(HOST, port, timeout=1) as conn:
+                conn.request({"action": "ping"})
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not start")
+
+
+def spawn(*args, read_ready=False):
+    # Server output is discarded; a merchant's first line announces its VMID
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), *map(str, args)],
+                            stdout=subprocess.PIPE if read_ready else subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL, text=True)
+
+
+# ---------- Measurement ----------
+
+class ActionStats:
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, latency, error=None):
+        with self._lock:
+            self.latencies.append(latency)
+            if error is not None:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def summary(self, elapsed):
+        samples = sorted(self.latencies)
+        failed = sum(self.errors.values())
+        def percentile(p):
+            return round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 2) if samples else None
+        return {
+            "requests": len(samples),
+            "errors": failed,
+            "error_rate": round(failed / len(samples), 4) if samples else 0.0,
+            "throughput": round((len(samples) - failed) / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(samples[-1] * 1000, 2) if samples else None,
+            "error_messages": dict(sorted(self.errors.items(), key=lambda item: -item[1])[:10])
+        }
+
+
+def timed(stats, scheduled, call, ok=("success",)):
+    # Runs call() and records its latency from the scheduled start
+    try:
+        response = call()
+        error = None if response.get("status") in ok else str(response.get("message"))
+    except Exception as e:
+        response, error = None, f"{type(e).__name__}: {e}"
+    stats.record(time.monotonic() - scheduled, error)
+    return response
+
+
+# ---------- Load ----------
+
+def register_users(count, bank_port, stats, threads):
+    def register(i):
+        user = User(f"loaduser{i}", "pw", "LOAD0001", START_BALANCE, PIN, f"7{i:09d}")
+        timed(stats, time.monotonic(), lambda: user.register_with_bank(HOST, bank_port))
+        return user
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(threads) as pool:
+            users = list(pool.map(register, range(count)))
+    return [user for user in users if user.mmid]
+
+
+def drive_payments(users, bank_port, config, stats):
+    # Open loop: payment k starts at start + k / rate
+    rng = random.Random(42)
+    interval = 1.0 / config["rate"]
+    total = int(config["rate"] * config["duration"])
+    tx_ids = []
+    bank_connection = Connection(HOST, bank_port)
+    # A user (and so their merchant connection) makes one payment at a time.
+    # There are never more workers than users, so a worker always finds an
+    # idle one.
+    idle = queue.Queue()
+    for user in rng.sample(users, len(users)):
+        idle.put(user)
+
+    def pay(scheduled):
+        user = idle.get()
+        try:
+            response = timed(stats["payment"], scheduled,
+                             lambda: user.send_transaction(user.merchant["vmid"], PIN, 1))
+        finally:
+            idle.put(user)
+        if response and response.get("tx_id"):
+            tx_ids.append(response["tx_id"])
+
+    def prove(tx_id, scheduled):
+        timed(stats["get_tx_proof"], scheduled,
+              lambda: bank_connection.request({"action": "get_tx_proof", "tx_id": tx_id}),
+              ok=("success", "pending"))
+
+    start = time.monotonic()
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(min(config["threads"], len(users))) as pool:
+            for k in range(total):
+                scheduled = start + k * interval
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(pay, scheduled)
+                if tx_ids and rng.random() < config["proof_ratio"]:
+                    pool.submit(prove, rng.choice(tx_ids), scheduled)
+    elapsed = time.monotonic() - start
+    bank_connection.close()
+    return elapsed
+
+
+def connect_users(users, merchants):
+    # Each user keeps one connection to one merchant, as a till would
+    for i, user in enumerate(users):
+        merchant = merchants[i % len(merchants)]
+        user.connect_to_merchant(HOST, merchant["port"])
+        user.merchant = merchant
+
+
+def run(config):
+    workdir = tempfile.mkdtemp(prefix="loadgen-")
+    children = []
+    try:
+        bank_port = free_port()
+        children.append(spawn("--serve-bank", bank_port, os.path.join(workdir, "bank"),
+                              int(config["async"])))
+        wait_for_port(bank_port)
+
+        merchants = []
+        for i in range(config["merchants"]):
+            port = free_port()
+            child = spawn("--serve-merchant", port, bank_port, os.path.join(workdir, "qr"), i, read_ready=True)
+            children.append(child)
+            line = child.stdout.readline()
+            if not line.startswith("READY"):
+                raise RuntimeError(f"Merchant {i} did not start")
+            merchants.append(dict(json.loads(line.split(" ", 1)[1]), port=port))
+        print(f"[LOAD] Bank on port {bank_port}, {len(merchants)} merchants started")
+
+        stats = {"register_user": ActionStats(), "payment": ActionStats(), "get_tx_proof": ActionStats()}
+        start = time.monotonic()
+        users = register_users(config["users"], bank_port, stats["register_user"], min(config["threads"], 32))
+        registration_time = time.monotonic() - start
+        print(f"[LOAD] Registered {len(users)} users in {registration_time:.1f}s")
+        if not users:
+            raise RuntimeError("No user could register")
+
+        connect_users(users, merchants)
+        print(f"[LOAD] Driving {config['rate']:.0f} payments/s for {config['duration']:.0f}s...")
+        elapsed = drive_payments(users, bank_port, config, stats)
+
+        results = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "config": config,
+            "elapsed_seconds": round(elapsed, 2),
+            "actions": {
+                "register_user": stats["register_user"].summary(registration_time),
+                "payment": stats["payment"].summary(elapsed),
+                "get_tx_proof": stats["get_tx_proof"].summary(elapsed),
+            }
+        }
+        return results
+    finally:
+        for child in children:
+            child.terminate()
+        for child in children:
+            child.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def print_results(results):
+    for action, summary in results["actions"].items():
+        if not summary["requests"]:
+            continue
+        print(f"[LOAD] {action:14} {summary['requests']:7} requests  {summary['throughput']:8.1f}/s  "
+              f"p50 {summary['p50_ms']} ms  p95 {summary['p95_ms']} ms  p99 {summary['p99_ms']} ms  "
+              f"errors {summary['error_rate'] * 100:.2f}%")
+        for message, count in summary["error_messages"].items():
+            print(f"[LOAD]     {count} x {message}")
+
+
+def parse_args(args):
+    config = dict(DEFAULTS, **{"async": False})
+    out = f"loadgen-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    i = 0
+    while i < len(args):
+        option = args[i]
+        if option == "--async":
+            config["async"] = True
+        elif option == "--out":
+            i += 1
+            out = args[i]
+        else:
+            key = option.lstrip("-").replace("-", "_")
+            if key not in DEFAULTS:
+                raise SystemExit(f"Unknown option {option}")
+            i += 1
+            config[key] = type(DEFAULTS[key])(args[i])
+        i += 1
+    return config, out
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == "--serve-bank":
+        serve_bank(int(args[1]), args[2], bool(int(args[3])))
+        return
+    if args and args[0] == "--serve-merchant":
+        serve_merchant(int(args[1]), int(args[2]), args[3], int(args[4]))
+        return
+
+    config, out = parse_args(args)
+    results = run(config)
+    print_results(results)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"[LOAD] Results written to {out}")
+
+
+if __name__ == "__main__":
+    main()
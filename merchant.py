@@ -1,7 +1,20 @@
+import sys
 import socket
 import json
-from cryptography.fernet import Fernet
-import qrcode
+import time
+import queue
+import select
+import threading
+import collections
+from PIL import Image
+
+from protocol import ProtocolError, read_frame, write_frame, encode_json
+from merkle import verify_tx_proof
+from qrcodes import QR_DIR, ensure_qr
+from metrics import Metrics, serve_metrics
+from securechannel import SecureConnection, ServerSession, unauthenticated_warning
+from deadlines import (deadline_from, remaining, expired, with_deadline, expired_response,
+                       overloaded_response, RETRY_AFTER_MIN_MS, RETRY_AFTER_MAX_MS)
 
 
 # Configuration
@@ -11,14 +24,345 @@ MERCHANT_PORT = 8889
 BANK_HOST = '192.168.1.7'
 BANK_PORT = 9999
 
+# Bank connection pool
+BANK_POOL_SIZE = 8
+BANK_POOL_WARM = 2
+BANK_POOL_WAIT_TIMEOUT = 10
+BANK_POOL_HEALTH_CHECK_INTERVAL = 30
+
+# User-facing server: at most MERCHANT_WORKERS payments are handled at once
+# and up to MERCHANT_QUEUE_SIZE more wait for a worker; beyond that users are
+# told to retry. Latency percentiles cover the last LATENCY_WINDOW requests.
+MERCHANT_WORKERS = 16
+MERCHANT_QUEUE_SIZE = 256
+LATENCY_WINDOW = 1000
+
+# A payment without a timeout_ms gets DEFAULT_PAYMENT_TIMEOUT seconds; what is
+# left of it when the merchant calls the bank goes along as the bank's
+# timeout_ms, and bounds the wait for the reply. Other bank requests wait at
+# most BANK_REQUEST_TIMEOUT seconds. Idle user connections are closed after
+# USER_IDLE_TIMEOUT seconds.
+DEFAULT_PAYMENT_TIMEOUT = 10
+BANK_REQUEST_TIMEOUT = 30
+USER_IDLE_TIMEOUT = 300
+
+# Prometheus scrape endpoint (GET /metrics); a plain JSON
+# {"action": "get_metrics"} frame returns the same data
+MERCHANT_METRICS_PORT = 9101
+
+# Payments arriving within BATCH_WINDOW seconds of each other go to the bank
+# as one validate_transactions request of at most BATCH_MAX_SIZE payments
+BATCH_WINDOW = 0.005
+BATCH_MAX_SIZE = 100
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class BankConnectionPool:
+    # Bounded pool of persistent connections to the bank. Callers borrow a
+    # connection, and wait in line when all of them are busy. Each connection
+    # agrees on its session keys once, when it is opened.
+    def __init__(self, host=BANK_HOST, port=BANK_PORT, size=BANK_POOL_SIZE, warm=BANK_POOL_WARM,
+                 wait_timeout=BANK_POOL_WAIT_TIMEOUT, health_check_interval=BANK_POOL_HEALTH_CHECK_INTERVAL):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.warm = min(warm, size)
+        self.wait_timeout = wait_timeout
+        self.health_check_interval = health_check_interval
+        self._idle = collections.deque()  # (connection, last_used)
+        self._open = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.wait_time = 0.0
+
+    def warm_up(self):
+        # Open connections up front so the first payments skip the handshake
+        while True:
+            with self._cond:
+                if self._open >= self.warm or self._closed:
+                    return
+                self._open += 1
+            try:
+                connection = SecureConnection(self.host, self.port)
+            except OSError:
+                with self._cond:
+                    self._open -= 1
+                raise
+            with self._cond:
+                self._idle.append((connection, time.monotonic()))
+                self._cond.notify()
+
+    def _is_healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+        # An idle socket that is readable has been closed or reset by the bank
+        readable, _, _ = select.select([connection.sock], [], [], 0)
+        if readable:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            return connection.request({"action": "ping"}).get("status") == "success"
+        except Exception:
+            return False
+
+    def acquire(self, timeout=None):
+        # Waits at most wait_timeout seconds for a connection, or timeout if
+        # that is shorter
+        start = time.monotonic()
+        wait_timeout = self.wait_timeout if timeout is None else min(self.wait_timeout, timeout)
+        waited = False
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise ConnectionError("Bank connection pool is closed")
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    connection = None
+                    self.misses += 1
+                    break
+                left = wait_timeout - (time.monotonic() - start)
+                if left <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeout("Timed out waiting for a bank connection")
+                waited = True
+                self._cond.wait(left)
+            if waited:
+                self.waits += 1
+                self.wait_time += time.monotonic() - start
+
+        try:
+            # An idle connection only counts as a hit once it proves healthy;
+            # one that is replaced counts as a reconnect and a miss
+            if connection is not None:
+                healthy = self._is_healthy(connection, last_used)
+                with self._cond:
+                    if healthy:
+                        self.hits += 1
+                    else:
+                        self.reconnects += 1
+                        self.misses += 1
+                if not healthy:
+                    connection.close()
+                    connection = None
+            if connection is None:
+                connection = SecureConnection(self.host, self.port, timeout)
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        return connection
+
+    def release(self, connection):
+        with self._cond:
+            if connection.closed or self._closed:
+                connection.close()
+                self._open -= 1
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def request(self, request, timeout=BANK_REQUEST_TIMEOUT):
+        # A request that times out closes its connection, so a late reply is
+        # never read as the answer to the next request
+        if timeout is not None and timeout <= 0:
+            raise socket.timeout("Deadline exceeded before the request was sent")
+        connection = self.acquire(timeout)
+        try:
+            connection.sock.settimeout(timeout)
+            return connection.request(request)
+        finally:
+            self.release(connection)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "size": self.size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "hits": self.hits,
+                "misses": self.misses,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "reconnects": self.reconnects,
+                "wait_time": self.wait_time,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                connection, _ = self._idle.pop()
+                connection.close()
+                self._open -= 1
+            self._cond.notify_all()
+
+
+class _QueuedPayment:
+    __slots__ = ("request", "deadline", "response", "done")
+
+    def __init__(self, request, deadline):
+        self.request = request
+        self.deadline = deadline
+        self.response = None
+        self.done = threading.Event()
+
+
+def bank_timeout_response():
+    # The bank may still apply the payment after we stop waiting
+    return {"status": "error", "message": "Deadline exceeded waiting for the bank; the payment may still "
+                                          "go through, retry with the same idempotency key"}
+
+
+class PaymentBatcher:
+    # Coalesces validate_transaction requests from concurrent user
+    # connections. The first payment of a batch waits up to `window` seconds
+    # (less if the batch fills up) and then sends the whole batch in one
+    # validate_transactions call; every caller gets its own result back.
+    # Payments whose deadline passes while they wait are not sent; each sent
+    # payment carries what is left of its own deadline.
+    def __init__(self, send, window=BATCH_WINDOW, max_size=BATCH_MAX_SIZE):
+        self.send = send
+        self.window = window
+        self.max_size = max_size
+        self._batch = []
+        self._cond = threading.Condition()
+        self.batches = 0
+        self.payments = 0
+
+    def submit(self, request, deadline=None):
+        payment = _QueuedPayment(request, deadline)
+        with self._cond:
+            if len(self._batch) >= self.max_size:
+                self._batch = []
+            batch = self._batch
+            batch.append(payment)
+            leader = len(batch) == 1
+            if len(batch) >= self.max_size:
+                self._cond.notify_all()
+
+        if not leader:
+            if not payment.done.wait(remaining(deadline)):
+                return bank_timeout_response()
+            return payment.response
+
+        window_end = time.monotonic() + self.window
+        with self._cond:
+            while len(batch) < self.max_size:
+                left = window_end - time.monotonic()
+                if left <= 0:
+                    break
+                self._cond.wait(left)
+            if self._batch is batch:
+                self._batch = []
+        self._send_batch(batch)
+        return payment.response
+
+    def _send_batch(self, batch):
+        for payment in batch:
+            if expired(payment.deadline):
+                payment.response = expired_response()
+                payment.done.set()
+        batch = [payment for payment in batch if payment.response is None]
+        if not batch:
+            return
+        # Wait for the bank as long as the payment with the most time left
+        deadlines = [payment.deadline for payment in batch]
+        timeout = None if None in deadlines else remaining(max(deadlines))
+        try:
+            if len(batch) == 1:
+                responses = [self.send(with_deadline(batch[0].request, batch[0].deadline), timeout)]
+            else:
+                items = [{key: value for key, value in with_deadline(p.request, p.deadline).items() if key != "action"}
+                         for p in batch]
+                response = self.send({"action": "validate_transactions", "transactions": items}, timeout)
+                if response.get("status") != "success":
+                    responses = [response] * len(batch)
+                else:
+                    responses = response["results"]
+        except socket.timeout:
+            responses = [bank_timeout_response()] * len(batch)
+        except Exception as e:
+            responses = [{"status": "error", "message": f"Bank request failed: {str(e)}"}] * len(batch)
+        self.batches += 1
+        self.payments += len(batch)
+        for payment, response in zip(batch, responses):
+            payment.response = response
+            payment.done.set()
+
+
+class _UserConnection:
+    # A user's socket, shared by its reader thread and the workers replying
+    # on it. Replies may go out in any order; the request ID matches them up.
+    # Replies are sealed under write_lock, in the order they are written.
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.session = ServerSession()
+        self.write_lock = threading.Lock()
+        self.pending = 0
+        self.idle = threading.Condition()
+
+    def started(self):
+        with self.idle:
+            self.pending += 1
+
+    def finished(self):
+        with self.idle:
+            self.pending -= 1
+            self.idle.notify_all()
+
+    def wait_idle(self):
+        with self.idle:
+            while self.pending:
+                self.idle.wait()
+
+
 class Merchant:
-    def __init__(self, name, password, ifsc_code, balance):
+    def __init__(self, name, password, ifsc_code, balance, headless=False, qr_dir=QR_DIR):
         self.name = name
         self.password = password
         self.ifsc_code = ifsc_code
         self.balance = balance
         self.merchant_id = None
         self.key = 5
+        self.headless = headless
+        self.qr_dir = qr_dir
+        self.bank_pool = BankConnectionPool(BANK_HOST, BANK_PORT)
+        self.payment_batcher = PaymentBatcher(self._bank_request)
+        self.requests = queue.Queue(MERCHANT_QUEUE_SIZE)
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.rejected = 0
+        self.metrics = Metrics("merchant")
+        self.metrics.gauge("queued_requests", self.requests.qsize, "Payments waiting for a worker")
+        self.metrics.gauge("bank_batches", lambda: self.payment_batcher.batches, "validate_transactions calls")
+        self.metrics.gauge("bank_batched_payments", lambda: self.payment_batcher.payments)
+        self.metrics.gauge("bank_pool_open", lambda: self.bank_pool.stats()["open"], "Open bank connections")
+
+    def _bank_request(self, request, timeout=BANK_REQUEST_TIMEOUT):
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = self.bank_pool.request(request, timeout)
+            status = response.get("status")
+            return response
+        finally:
+            self.metrics.observe("bank_" + request.get("action", "unknown"),
+                                 time.perf_counter() - started, status, finished=False)
 
     def register_with_bank(self):
         request = {
@@ -30,16 +374,13 @@ class Merchant:
         }
 
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as bank_socket:
-                bank_socket.connect((BANK_HOST, BANK_PORT))
-                bank_socket.send(json.dumps(request).encode())
-                response = json.loads(bank_socket.recv(4096).decode())
-
-                if response['status'] == 'success':
-                    self.merchant_id = response['merchant_id']
-                    print(f"[MERCHANT] Registered with Bank | Merchant ID: {self.merchant_id}")
-                else:
-                    print("[MERCHANT] Registration failed:", response['message'])
+            response = self._bank_request(request)
+
+            if response['status'] == 'success':
+                self.merchant_id = response['merchant_id']
+                print(f"[MERCHANT] Registered with Bank | Merchant ID: {self.merchant_id}")
+            else:
+                print("[MERCHANT] Registration failed:", response['message'])
 
         except Exception as e:
             print("[MERCHANT] Error registering with bank:", str(e))
@@ -54,34 +395,25 @@ class Merchant:
             vmid = simple_permutation_encrypt(self.key, self.merchant_id)
             print(f"[MERCHANT] VMID (Encrypted Merchant ID): {vmid}")
 
-            # Generate a QR code for the VMID
-            qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-            )
-            qr.add_data(vmid)
-            qr.make(fit=True)
-
-            # Display the QR code
-            qr_image = qr.make_image(fill_color="black", back_color="white")
-            qr_image.show()
-            print("[MERCHANT] QR Code displayed.")
+            # Generate the QR code for the VMID; it is cached on disk by
+            # merchant_id, so it is only built once
+            vmid, qr_files, cached = ensure_qr(self.merchant_id, vmid, self.key, self.qr_dir)
+            print(f"[MERCHANT] QR Code {'loaded from' if cached else 'saved to'} {', '.join(qr_files.values())}")
+
+            # Display the QR code, unless there is no screen to show it on
+            if not self.headless:
+                Image.open(qr_files["png"]).show()
+                print("[MERCHANT] QR Code displayed.")
 
         except Exception as e:
             print("[MERCHANT] Error generating VMID or QR Code:", str(e))
 
-    def handle_user_transaction(self, client_socket):
-        def simple_permutation_decipher_json(self, encrypted_data):
-            # Simple permutation decryption: reverse the string back to original
-            decrypted_data = encrypted_data[::-1]  # Reverse the string
-            return json.loads(decrypted_data)  # Convert back to dictionary
-        
+    def handle_user_transaction(self, data, deadline=None):
+        # data is the body of one frame from the user; returns the response to send back
+        # It has already been decrypted by the connection's session
+        # deadline is when the user stops waiting (time.monotonic())
         try:
-            data = client_socket.recv(4096)
-            transaction_request = simple_permutation_decipher_json(self, data.decode())
-            # transaction_request = json.loads(data.decode())
+            transaction_request = json.loads(data.decode())
             print("[MERCHANT] Received transaction request:", transaction_request)
             # Decrypt the encrypted merchant ID (VMID) to retrieve the original merchant ID
             try:
@@ -93,9 +425,7 @@ class Merchant:
                 decrypted_merchant_id = simple_permutation_decrypt(self.key, transaction_request['encrypted_merchant_id'])
                 print("[MERCHANT] Decrypted Merchant ID:", decrypted_merchant_id)
             except Exception as e:
-                error_response = {"status": "error", "message": f"Decryption failed: {str(e)}"}
-                client_socket.send(json.dumps(error_response).encode())
-                return
+                return {"status": "error", "message": f"Decryption failed: {str(e)}"}
             validation_request = {
                 "action": "validate_transaction",
                 "encrypted_merchant_id": decrypted_merchant_id,
@@ -103,43 +433,164 @@ class Merchant:
                 "pin": transaction_request['pin'],
                 "amount": transaction_request['amount']
             }
-            def simple_permutation_encrypt_json(data):
-                # Simple permutation encryption: reverse the string representation of the data
-                json_data = json.dumps(data)  # Convert data to JSON string
-                encrypted_data = json_data[::-1]  # Reverse the string
-                return encrypted_data
-            
-            # validation_request = simple_permutation_encrypt_json(validation_request)
+            if transaction_request.get('idempotency_key') is not None:
+                validation_request['idempotency_key'] = transaction_request['idempotency_key']
             # Send validation request to bank
             print("[MERCHANT] Sending transaction validation request to bank...")
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as bank_socket:
-                bank_socket.connect((BANK_HOST, BANK_PORT))
-                bank_socket.send(json.dumps(validation_request).encode())
-                bank_response = json.loads(bank_socket.recv(4096).decode())
-
-            # Send bank response back to user
-            client_socket.send(json.dumps(bank_response).encode())
+            bank_response = self.payment_batcher.submit(validation_request, deadline)
 
             # Display to merchant console
             print("[MERCHANT] Transaction status:", bank_response['status'])
             print("[MERCHANT] Message:", bank_response['message'])
+            return bank_response
 
         except Exception as e:
-            error_response = {"status": "error", "message": str(e)}
-            client_socket.send(json.dumps(error_response).encode())
+            return {"status": "error", "message": str(e)}
+
+    def verify_payment(self, tx_id):
+        # Confirms a payment to this merchant from its Merkle inclusion proof,
+        # without downloading the block or the chain
+        response = self._bank_request({"action": "get_tx_proof", "tx_id": tx_id})
+        if response.get("status") != "success":
+            return response
+        verified = verify_tx_proof(response) and response["tx"]["merchant_id"] == self.merchant_id
+        return {
+            "status": "success" if verified else "failure",
+            "verified": verified,
+            "block_index": response["block"]["index"],
+            "block_hash": response["block"]["hash"]
+        }
+
+    def serve_user_connection(self, client_socket, addr):
+        # Users keep their connection open and may send several payments
+        # without waiting; each frame is queued for the worker pool
+        connection = _UserConnection(client_socket, addr)
+        client_socket.settimeout(USER_IDLE_TIMEOUT)
+        try:
+            while True:
+                frame = read_frame(client_socket)
+                if frame is None:
+                    break
+                request_id, body = frame
+                body, handshake_reply = connection.session.receive(request_id, body)
+                if handshake_reply is not None:
+                    with connection.write_lock:
+                        write_frame(client_socket, request_id, handshake_reply)
+                    continue
+                received = time.monotonic()
+                connection.started()
+                try:
+                    self.requests.put_nowait((connection, request_id, body, received))
+                except queue.Full:
+                    self.rejected += 1
+                    self.metrics.increment("rejected_requests")
+                    self._reply(connection, request_id, overloaded_response(self.retry_after_ms()),
+                                received, received)
+        except (ProtocolError, OSError) as e:
+            print(f"[MERCHANT] Connection from {addr} dropped: {e}")
+        finally:
+            # Let the workers answer what the user already sent
+            connection.wait_idle()
+            client_socket.close()
+
+    def retry_after_ms(self):
+        # A full queue drains in about the time a request takes now
+        samples = sorted(self.latencies)
+        estimate = int(samples[len(samples) // 2] * 1000) if samples else RETRY_AFTER_MIN_MS
+        return min(max(estimate, RETRY_AFTER_MIN_MS), RETRY_AFTER_MAX_MS)
+
+    def _reply(self, connection, request_id, response, received, started):
+        try:
+            with connection.write_lock:
+                write_frame(connection.sock, request_id, connection.session.send(request_id, encode_json(response)))
+        except OSError as e:
+            print(f"[MERCHANT] Could not reply to {connection.addr}: {e}")
+        finally:
+            connection.finished()
+        elapsed = time.monotonic() - received
+        self.latencies.append(elapsed)
+        print(f"[MERCHANT] Request {request_id} from {connection.addr[0]}: {response.get('status')} in "
+              f"{elapsed * 1000:.1f} ms ({(started - received) * 1000:.1f} ms queued)")
+
+    def _worker(self):
+        while True:
+            connection, request_id, body, received = self.requests.get()
+            started = time.monotonic()
+            self.metrics.start()
+            self.metrics.observe("queue_wait", started - received, "success", finished=False)
+            action = "forward_transaction"
+            try:
+                request = json.loads(body)
+                if "action" in request:
+                    # Control requests such as get_metrics carry an action;
+                    # payments do not
+                    action, response = self.handle_control(request)
+                elif not connection.session.encrypted:
+                    response = {"status": "error", "message": "Payments must be sent over an encrypted session"}
+                else:
+                    deadline = deadline_from(request, received, DEFAULT_PAYMENT_TIMEOUT)
+                    if expired(deadline):
+                        # The user gave up while it was queued
+                        response = expired_response()
+                    else:
+                        response = self.handle_user_transaction(body, deadline)
+            except Exception as e:
+                response = {"status": "error", "message": str(e)}
+            self.metrics.observe(action, time.monotonic() - started, response.get("status"))
+            self._reply(connection, request_id, response, received, started)
+
+    def handle_control(self, request):
+        if request.get("action") == "get_metrics":
+            if request.get("format") == "prometheus":
+                return "get_metrics", {"status": "success", "text": self.metrics.prometheus()}
+            return "get_metrics", dict(self.metrics.snapshot(), latency=self.latency_stats(), status="success")
+        return "unknown", {"status": "error", "message": "Unknown action"}
+
+    def start_workers(self, workers=MERCHANT_WORKERS):
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"merchant-worker-{i}", daemon=True).start()
+
+    def latency_stats(self):
+        # Percentiles over the most recent requests, in milliseconds
+        samples = sorted(self.latencies)
+        if not samples:
+            return {"requests": 0, "rejected": self.rejected}
+        def percentile(p):
+            return round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 2)
+        return {
+            "requests": len(samples),
+            "rejected": self.rejected,
+            "queued": self.requests.qsize(),
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "max_ms": round(samples[-1] * 1000, 2)
+        }
 
     def start_server(self):
         print(f"[MERCHANT] Starting merchant server on {MERCHANT_HOST}:{MERCHANT_PORT}...")
+        warning = unauthenticated_warning(MERCHANT_HOST)
+        if warning:
+            print("[MERCHANT] Warning:", warning)
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             server_socket.bind((MERCHANT_HOST, MERCHANT_PORT))
             server_socket.listen()
+            try:
+                self.bank_pool.warm_up()
+            except OSError as e:
+                print("[MERCHANT] Could not pre-open bank connections:", str(e))
+            self.start_workers()
+            try:
+                serve_metrics(self.metrics, MERCHANT_HOST, MERCHANT_METRICS_PORT)
+            except OSError as e:
+                print("[MERCHANT] Metrics endpoint not started:", str(e))
             print("[MERCHANT] Waiting for user transactions...")
 
             while True:
                 client_socket, addr = server_socket.accept()
-                print(f"[MERCHANT] Received transaction request from {addr}")
-                self.handle_user_transaction(client_socket)
-                client_socket.close()
+                print(f"[MERCHANT] User connected from {addr}")
+                threading.Thread(target=self.serve_user_connection, args=(client_socket, addr), daemon=True).start()
 
 
 # ---------- Main ----------
@@ -151,7 +602,8 @@ def main():
     ifsc_code = input("Enter IFSC Code: ")
     balance = float(input("Enter Initial Balance: "))
 
-    merchant = Merchant(name, password, ifsc_code, balance)
+    # --headless writes the QR code to disk without opening a viewer
+    merchant = Merchant(name, password, ifsc_code, balance, headless="--headless" in sys.argv[1:])
     merchant.register_with_bank()
     
     if merchant.merchant_id:
@@ -0,0 +1,73 @@
+# merkle.py
+#
+# Block hashing and Merkle trees for the bank's blockchain.
+#
+# Each block commits to its transactions through a Merkle root, so a single
+# payment can be proven with about log2(n) sibling hashes instead of the
+# whole block or chain. Leaves and inner nodes are hashed with different
+# prefixes so an inner node can never pass for a transaction. An odd node at
+# the end of a level is carried up unchanged.
+
+import json
+import hashlib
+
+EMPTY_ROOT = '0' * 64
+
+
+def tx_leaf_hash(tx):
+    encoded = json.dumps(tx, sort_keys=True, separators=(",", ":")).encode()
+    return hashlib.sha256(b"\x00" + encoded).hexdigest()
+
+
+def _node_hash(left, right):
+    return hashlib.sha256(b"\x01" + bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def _next_level(level):
+    parents = [_node_hash(level[i], level[i + 1]) for i in range(0, len(level) - 1, 2)]
+    if len(level) % 2:
+        parents.append(level[-1])
+    return parents
+
+
+def merkle_root(leaves):
+    if not leaves:
+        return EMPTY_ROOT
+    level = list(leaves)
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves, index):
+    # Sibling hashes from the leaf up, each tagged with the side it sits on
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        sibling = index ^ 1
+        if sibling < len(level):
+            proof.append([level[sibling], "L" if sibling < index else "R"])
+        level = _next_level(level)
+        index //= 2
+    return proof
+
+
+def verify_proof(leaf, proof, root):
+    current = leaf
+    for sibling, side in proof:
+        current = _node_hash(sibling, current) if side == "L" else _node_hash(current, sibling)
+    return current == root
+
+
+def compute_block_hash(index, prev_hash, merkle_root_hash, timestamp):
+    return hashlib.sha256(f"{index}{prev_hash}{merkle_root_hash}{timestamp}".encode()).hexdigest()
+
+
+def verify_tx_proof(response):
+    # Checks a get_tx_proof response on its own: the transaction hashes up to
+    # the Merkle root, and the root is part of the block's hash
+    header = response["block"]
+    if not verify_proof(tx_leaf_hash(response["tx"]), response["proof"], header["merkle_root"]):
+        return False
+    return compute_block_hash(header["index"], header["prev_hash"], header["merkle_root"],
+                              header["timestamp"]) == header["hash"]
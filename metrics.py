@@ -0,0 +1,175 @@
+# metrics.py
+#
+# Counters, gauges and latency histograms for the bank and merchant servers.
+#
+# Recording is cheap enough for the hot path: a histogram observation is one
+# bisect over a short list of bucket bounds and a few integer increments
+# under a lock, and gauges such as chain length are not tracked at all but
+# read through a callback when metrics are collected.
+#
+# Metrics are returned as a dict (the get_metrics action) or rendered in the
+# Prometheus text format, which serve_metrics() exposes over HTTP at
+# /metrics.
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds; the last bucket (+Inf) catches everything else
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._requests = {}     # (action, status) -> count
+        self._latency = {}      # action -> Histogram
+        self._counters = {}     # name -> count
+        self._gauges = {}       # name -> (callback, help)
+        self.in_flight = 0
+
+    # ----- Recording -----
+
+    def start(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def observe(self, action, seconds, status, finished=True):
+        # finished=False records a timing that was not bracketed by start()
+        with self._lock:
+            if finished:
+                self.in_flight -= 1
+            key = (action, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._latency.get(action)
+            if histogram is None:
+                histogram = self._latency[action] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def gauge(self, name, callback, help_text=""):
+        self._gauges[name] = (callback, help_text)
+
+    # ----- Collection -----
+
+    def _collect(self):
+        with self._lock:
+            requests = dict(self._requests)
+            latency = {action: (list(h.counts), h.sum, h.count, h.quantile(0.5), h.quantile(0.95), h.quantile(0.99))
+                       for action, h in self._latency.items()}
+            counters = dict(self._counters)
+            in_flight = self.in_flight
+        gauges = {}
+        for name, (callback, _) in self._gauges.items():
+            try:
+                gauges[name] = callback()
+            except Exception:
+                gauges[name] = None
+        gauges["in_flight_requests"] = in_flight
+        return requests, latency, counters, gauges
+
+    def snapshot(self):
+        requests, latency, counters, gauges = self._collect()
+        actions = {}
+        for (action, status), count in requests.items():
+            entry = actions.setdefault(action, {"count": 0, "by_status": {}})
+            entry["count"] += count
+            entry["by_status"][status] = count
+        for action, (_, total, count, p50, p95, p99) in latency.items():
+            actions.setdefault(action, {"count": 0, "by_status": {}}).update({
+                "mean_ms": round(total / count * 1000, 3) if count else None,
+                "p50_ms": _ms(p50), "p95_ms": _ms(p95), "p99_ms": _ms(p99)
+            })
+        return {"actions": actions, "counters": counters, "gauges": gauges}
+
+    def prometheus(self):
+        requests, latency, counters, gauges = self._collect()
+        p = self.prefix
+        lines = [f"# TYPE {p}_requests_total counter"]
+        for (action, status), count in sorted(requests.items()):
+            lines.append(f'{p}_requests_total{{action="{_label(action)}",status="{_label(status)}"}} {count}')
+        lines.append(f"# TYPE {p}_request_seconds histogram")
+        for action, (counts, total, count, _, _, _) in sorted(latency.items()):
+            action = _label(action)
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{p}_request_seconds_bucket{{action="{action}",le="{le}"}} {cumulative}')
+            lines.append(f'{p}_request_seconds_sum{{action="{action}"}} {total}')
+            lines.append(f'{p}_request_seconds_count{{action="{action}"}} {count}')
+        for name, value in sorted(counters.items()):
+            lines.append(f"# TYPE {p}_{name} counter")
+            lines.append(f"{p}_{name} {value}")
+        for name, value in sorted(gauges.items()):
+            if value is None:
+                continue
+            help_text = self._gauges.get(name, (None, ""))[1]
+            if help_text:
+                lines.append(f"# HELP {p}_{name} {help_text}")
+            lines.append(f"# TYPE {p}_{name} gauge")
+            lines.append(f"{p}_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _label(value):
+    # A label value as the text format quotes it
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _ms(seconds):
+    if seconds is None:
+        return None
+    return "inf" if seconds == float("inf") else seconds * 1000
+
+
+def serve_metrics(metrics, host, port):
+    # Prometheus scrape endpoint on its own port and thread
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,259 @@
+# protocol.py
+#
+# Wire protocol shared by the bank, merchant and user.
+#
+# Every message travels as a frame:
+#   4-byte big-endian body length | 4-byte big-endian request id | body
+#
+# The request id is chosen by the client and echoed back by the server, so one
+# persistent connection can carry many pipelined requests whose responses may
+# come back in any order.
+#
+# Large responses may be streamed as several frames with the same request id.
+# Every frame but the last carries "more": true, and the list fields named in
+# STREAMED_FIELDS are split across the frames.
+
+import socket
+import asyncio
+import struct
+import json
+import threading
+import itertools
+import collections
+import collections.abc
+
+HEADER = struct.Struct(">II")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# A streamed frame holds at most STREAM_CHUNK_SIZE items and, unless a single
+# item is larger, at most STREAM_CHUNK_BYTES of them. Blocks vary in size
+# with their transactions, so the byte bound is what keeps frames under
+# MAX_FRAME_SIZE.
+STREAMED_FIELDS = ("chain", "blocks", "settlements")
+STREAM_CHUNK_SIZE = 200
+STREAM_CHUNK_BYTES = 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# ---------- Framing ----------
+
+def pack_frame(request_id, body):
+    if len(body) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(body)} bytes exceeds limit")
+    return HEADER.pack(len(body), request_id) + body
+
+
+def recv_exact(sock, size):
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = sock.recv(min(remaining, 65536))
+        if not chunk:
+            if remaining == size:
+                return None
+            raise ProtocolError("Connection closed mid-frame")
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frame(sock):
+    # Returns (request_id, body), or None when the peer closed cleanly
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    length, request_id = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds limit")
+    body = recv_exact(sock, length) if length else b""
+    if body is None:
+        raise ProtocolError("Connection closed mid-frame")
+    return request_id, body
+
+
+def write_frame(sock, request_id, body):
+    sock.sendall(pack_frame(request_id, body))
+
+
+async def read_frame_async(reader, body_timeout=None, idle_timeout=None):
+    # Same as read_frame for asyncio streams. Waiting idle_timeout for a frame
+    # to start raises asyncio.TimeoutError, and nothing is consumed, so the
+    # caller may wait again; body_timeout guards stalled peers.
+    try:
+        header = await asyncio.wait_for(reader.readexactly(HEADER.size), idle_timeout)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ProtocolError("Connection closed mid-frame")
+    length, request_id = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds limit")
+    try:
+        body = await asyncio.wait_for(reader.readexactly(length), body_timeout)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Connection closed mid-frame")
+    except asyncio.TimeoutError:
+        raise ProtocolError("Timed out mid-frame")
+    return request_id, body
+
+
+def encode_json(obj):
+    return json.dumps(obj).encode()
+
+
+def decode_json(body):
+    return json.loads(body.decode())
+
+
+def response_bodies(response, chunk_size=STREAM_CHUNK_SIZE, chunk_bytes=STREAM_CHUNK_BYTES):
+    # Encodes a response as frame bodies: a list holding the single body of
+    # an ordinary response, or a generator that encodes a long streamed list
+    # chunk by chunk so no frame has to hold the whole thing
+    # Streamed fields may be any sequence, such as a lazy view of the chain
+    field = next((f for f in STREAMED_FIELDS if isinstance(response.get(f), collections.abc.Sequence)), None)
+    if field is None:
+        return [encode_json(response)]
+    if len(response[field]) <= chunk_size:
+        items = [encode_json(item) for item in response[field]]
+        if sum(len(item) for item in items) <= chunk_bytes:
+            return [_chunk_body(response, field, items)]
+    return _iter_chunks(response, field, chunk_size, chunk_bytes)
+
+
+def _chunk_body(response, field, items, more=None):
+    # The response with `field` holding the already encoded items
+    envelope = {k: v for k, v in response.items() if k != field}
+    if more is not None:
+        envelope["more"] = more
+    head = encode_json(envelope)[:-1]
+    if envelope:
+        head += b", "
+    return head + encode_json(field) + b": [" + b", ".join(items) + b"]}"
+
+
+def _iter_chunks(response, field, chunk_size, chunk_bytes):
+    items = response[field]
+    chunk, size = [], 0
+    for offset in range(0, len(items), chunk_size):
+        for item in items[offset:offset + chunk_size]:
+            body = encode_json(item)
+            if chunk and (len(chunk) >= chunk_size or size + len(body) > chunk_bytes):
+                yield _chunk_body(response, field, chunk, more=True)
+                chunk, size = [], 0
+            chunk.append(body)
+            size += len(body)
+    yield _chunk_body(response, field, chunk, more=False)
+
+
+def merge_stream(responses):
+    # Joins the frames of a streamed response back into a single response
+    merged = None
+    for response in responses:
+        if merged is None:
+            merged = dict(response)
+            continue
+        for field in STREAMED_FIELDS:
+            if field in response:
+                merged[field] = merged[field] + response[field]
+        merged.update((k, v) for k, v in response.items() if k not in STREAMED_FIELDS)
+    merged.pop("more", None)
+    return merged
+
+
+# ---------- Client Connection ----------
+
+class Connection:
+    # Persistent client connection. request() sends one frame and waits for its
+    # reply; pipeline() writes a batch of frames before reading any responses.
+    def __init__(self, host, port, timeout=None):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._ids = itertools.count(1)
+        self._early = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def _next_id(self):
+        return next(self._ids) & 0xFFFFFFFF
+
+    # Hooks for encrypted connections (securechannel.SecureConnection); frame
+    # bodies are sealed in the order they are written and opened in the order
+    # they are read
+    def _seal(self, request_id, body):
+        return body
+
+    def _open(self, request_id, body):
+        return body
+
+    def _recv_for(self, request_id):
+        # Responses may arrive out of order; park the ones meant for others
+        while not self._early.get(request_id):
+            frame = read_frame(self.sock)
+            if frame is None:
+                raise ConnectionError("Server closed the connection")
+            self._early[frame[0]].append(self._open(*frame))
+        body = self._early[request_id].popleft()
+        if not self._early[request_id]:
+            del self._early[request_id]
+        return body
+
+    def _iter_frames(self, request_id):
+        while True:
+            response = decode_json(self._recv_for(request_id))
+            yield response
+            if not response.get("more"):
+                return
+
+    def request_raw(self, body):
+        with self._lock:
+            try:
+                request_id = self._next_id()
+                write_frame(self.sock, request_id, self._seal(request_id, body))
+                return self._recv_for(request_id)
+            except Exception:
+                self.close()
+                raise
+
+    def request(self, obj):
+        return merge_stream(self.request_stream(obj))
+
+    def request_stream(self, obj):
+        # Yields each frame of a possibly streamed response as it arrives
+        with self._lock:
+            try:
+                request_id = self._next_id()
+                write_frame(self.sock, request_id, self._seal(request_id, encode_json(obj)))
+                yield from self._iter_frames(request_id)
+            except BaseException:
+                # Includes the caller abandoning the stream part way through
+                self.close()
+                raise
+
+    def pipeline(self, objs):
+        with self._lock:
+            try:
+                ids = [self._next_id() for _ in objs]
+                self.sock.sendall(b"".join(pack_frame(i, self._seal(i, encode_json(o))) for i, o in zip(ids, objs)))
+                return [merge_stream(self._iter_frames(i)) for i in ids]
+            except Exception:
+                self.close()
+                raise
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,137 @@
+# qrcodes.py
+#
+# Headless VMID and QR code generation for merchants.
+#
+# The QR code for a merchant depends only on its merchant_id (and the
+# permutation key), so it is written to disk once and reused:
+#   <QR_DIR>/<merchant_id>.vmid   the VMID, as text
+#   <QR_DIR>/<merchant_id>.png
+#   <QR_DIR>/<merchant_id>.svg
+# Files are written under a temporary name and renamed into place, so a
+# half-written image is never picked up from the cache.
+#
+# Bulk generation for many merchants runs across processes:
+#   python qrcodes.py merchant_ids.txt [--out DIR] [--formats png,svg] [--workers N]
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import qrcode
+import qrcode.image.svg
+
+QR_DIR = 'merchant_qr'
+QR_FORMATS = ("png", "svg")
+PERMUTATION_KEY = 5
+BULK_CHUNK_SIZE = 64
+
+
+def simple_permutation_encrypt(key, plaintext):
+    # Same cipher as Merchant.register_with_bank
+    return ''.join(chr((ord(char) + key) % 256) for char in plaintext)
+
+
+def qr_paths(merchant_id, directory=QR_DIR, formats=QR_FORMATS):
+    return {fmt: os.path.join(directory, f"{merchant_id}.{fmt}") for fmt in formats}
+
+
+def _write_atomically(path, write):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def render_qr(vmid, path, fmt):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=10,
+        border=4,
+    )
+    qr.add_data(vmid)
+    qr.make(fit=True)
+    if fmt == "svg":
+        image = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+        _write_atomically(path, image.save)
+    else:
+        image = qr.make_image(fill_color="black", back_color="white")
+        _write_atomically(path, lambda tmp_path: image.save(tmp_path, format="PNG"))
+
+
+def _read_cached_vmid(merchant_id, directory):
+    try:
+        with open(os.path.join(directory, f"{merchant_id}.vmid")) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def ensure_qr(merchant_id, vmid=None, key=PERMUTATION_KEY, directory=QR_DIR, formats=QR_FORMATS):
+    # Returns (vmid, {format: path}, cached). Nothing is rebuilt when the
+    # VMID and every requested image are already on disk.
+    os.makedirs(directory, exist_ok=True)
+    paths = qr_paths(merchant_id, directory, formats)
+    cached_vmid = _read_cached_vmid(merchant_id, directory)
+    if vmid is None:
+        vmid = cached_vmid or simple_permutation_encrypt(key, merchant_id)
+    if cached_vmid == vmid and all(os.path.exists(path) for path in paths.values()):
+        return vmid, paths, True
+
+    for fmt, path in paths.items():
+        render_qr(vmid, path, fmt)
+    def write_vmid(tmp_path):
+        with open(tmp_path, "w") as f:
+            f.write(vmid)
+    _write_atomically(os.path.join(directory, f"{merchant_id}.vmid"), write_vmid)
+    return vmid, paths, False
+
+
+def _bulk_job(job):
+    merchant_ids, key, directory, formats = job
+    built = 0
+    for merchant_id in merchant_ids:
+        if not ensure_qr(merchant_id, key=key, directory=directory, formats=formats)[2]:
+            built += 1
+    return len(merchant_ids), built
+
+
+def generate_bulk(merchant_ids, key=PERMUTATION_KEY, directory=QR_DIR, formats=QR_FORMATS,
+                  workers=None, chunk_size=BULK_CHUNK_SIZE):
+    # Builds VMIDs and QR images for many merchants across processes, in
+    # chunks so each task carries many merchants. Returns (done, built).
+    os.makedirs(directory, exist_ok=True)
+    jobs = [(merchant_ids[i:i + chunk_size], key, directory, tuple(formats))
+            for i in range(0, len(merchant_ids), chunk_size)]
+    done = built = 0
+    with ProcessPoolExecutor(workers) as pool:
+        for job_done, job_built in pool.map(_bulk_job, jobs):
+            done += job_done
+            built += job_built
+    return done, built
+
+
+def main():
+    args = sys.argv[1:]
+    options = {"--out": QR_DIR, "--formats": ",".join(QR_FORMATS), "--workers": None}
+    for option in options:
+        if option in args:
+            position = args.index(option)
+            options[option] = args[position + 1]
+            del args[position:position + 2]
+    if len(args) != 1:
+        print("Usage: python qrcodes.py merchant_ids.txt [--out DIR] [--formats png,svg] [--workers N]")
+        sys.exit(1)
+
+    with open(args[0]) as f:
+        merchant_ids = [line.strip() for line in f if line.strip()]
+    workers = int(options["--workers"]) if options["--workers"] else None
+    start = time.time()
+    done, built = generate_bulk(merchant_ids, directory=options["--out"],
+                                formats=options["--formats"].split(","), workers=workers)
+    print(f"[QR] {done} merchants in {time.time() - start:.1f}s: {built} built, "
+          f"{done - built} already cached, written to {options['--out']}")
+
+
+if __name__ == "__main__":
+    main()
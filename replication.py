@@ -0,0 +1,238 @@
+# replication.py
+#
+# Read replicas of the bank.
+#
+# A follower keeps its own in-memory copy of the accounts and the chain by
+# tailing the primary's write-ahead log over a replicate stream. The log
+# records are after-images (see apply_wal_record in bank.py), so the follower
+# applies exactly what recovery would.
+#
+# The primary only ever sends durable state:
+#   - a new follower (or one the log has moved past) is bootstrapped from
+#     the latest snapshot on disk, in pages: accounts, the blocks up to the
+#     snapshot's height, then pending payments;
+#   - then every log record after the snapshot, read back from the segment
+#     files until the follower has caught up;
+#   - then records as the log flusher makes them durable, through a bounded
+#     buffer (subscriptions.py). A follower that falls behind is caught up
+#     from the files again.
+# A follower that reconnects sends its last applied position and chain tip,
+# and resumes from there while the log still holds the records after it.
+#
+# Frames carry the primary's durable position, so the follower knows how far
+# behind it is. Idle streams get a heartbeat every REPLICATION_HEARTBEAT
+# seconds.
+
+import time
+import json
+import threading
+
+from protocol import ProtocolError, encode_json
+from securechannel import SecureConnection
+from snapshot import load_latest_snapshot
+from subscriptions import Subscriber
+
+REPLICATION_HEARTBEAT = 1.0
+REPLICATION_PAGE = 1000          # log records or accounts per frame
+REPLICATION_BLOCK_PAGE = 50      # blocks per frame while bootstrapping
+REPLICATION_TIMEOUT = 10         # a silent primary is treated as gone
+RECONNECT_DELAY = 1.0
+
+
+# ---------- Primary ----------
+
+class ReplicationStream(Subscriber):
+    # position is the next log position to send
+    heartbeat_interval = REPLICATION_HEARTBEAT
+
+    def __init__(self, feed, wal, blockchain, after_lsn=None, chain_height=None, chain_tip=None):
+        super().__init__(feed, None)
+        self.wal = wal
+        self.blockchain = blockchain
+        self._bootstrap = None
+        self._backlog = None
+        self._carry = []
+        self.resumed = self._can_resume(after_lsn, chain_height, chain_tip)
+        if self.resumed:
+            self.position = after_lsn + 1
+        else:
+            covered_lsn, state = load_latest_snapshot(wal.directory)
+            self.position = covered_lsn + 1
+            self._bootstrap = self._bootstrap_frames(covered_lsn, state)
+
+    def _can_resume(self, after_lsn, chain_height, chain_tip):
+        # The follower must hold a prefix of this chain, and the log must
+        # still have every record after its position
+        if after_lsn is None or chain_height is None:
+            return False
+        if not self.wal.oldest_lsn() - 1 <= after_lsn <= self.wal.durable_lsn:
+            return False
+        if chain_height > len(self.blockchain):
+            return False
+        return chain_height == 0 or self.blockchain.header(chain_height - 1)['hash'] == chain_tip
+
+    def _bootstrap_frames(self, covered_lsn, state):
+        state = state or {"users": {}, "merchants": {}, "pending": [], "chain_height": 0, "chain_tip": '0'*64}
+        yield {"bootstrap": {"lsn": covered_lsn, "chain_height": state["chain_height"],
+                             "chain_tip": state["chain_tip"]}}
+        for kind in ("users", "merchants"):
+            accounts = list(state[kind].items())
+            for offset in range(0, len(accounts), REPLICATION_PAGE):
+                yield {kind: dict(accounts[offset:offset + REPLICATION_PAGE])}
+        for start in range(0, state["chain_height"], REPLICATION_BLOCK_PAGE):
+            end = min(start + REPLICATION_BLOCK_PAGE, state["chain_height"])
+            yield {"blocks": list(self.blockchain[start:end])}
+        # After the blocks, so payments sealed since are recognised
+        for offset in range(0, len(state["pending"]), REPLICATION_PAGE):
+            yield {"pending": state["pending"][offset:offset + REPLICATION_PAGE]}
+
+    def next_frame(self, heartbeat=False):
+        if self._bootstrap is not None:
+            frame = next(self._bootstrap, None)
+            if frame is not None:
+                return encode_json(dict(frame, status="success", more=True))
+            self._bootstrap = None
+        durable = self.wal.durable_lsn
+        bodies = self._collect(durable)
+        if not bodies and not heartbeat:
+            return None
+        head = encode_json({"status": "success", "durable_lsn": durable, "sent_at": time.time(), "more": True})
+        return head[:-1] + b', "records": [' + b",".join(bodies) + b"]}"
+
+    def _collect(self, durable):
+        # Up to REPLICATION_PAGE record bodies starting at position: live
+        # records when they follow on from it, otherwise read back from the
+        # log files
+        start = self.position
+        live = self._carry
+        for first_lsn, bodies in self.take():
+            live.extend((first_lsn + i, body) for i, body in enumerate(bodies))
+        live = [(lsn, body) for lsn, body in live if lsn >= start]
+        if self._backlog is None and live and live[0][0] == start:
+            records, self._carry = live[:REPLICATION_PAGE], live[REPLICATION_PAGE:]
+            self.position = records[-1][0] + 1
+            return [body for _, body in records]
+
+        self._carry = []
+        if start > durable:
+            return []
+        if self._backlog is None:
+            self._backlog = self.wal.replay(start - 1)
+        bodies = []
+        for record in self._backlog:
+            bodies.append(json.dumps(record, separators=(",", ":")).encode())
+            self.position = record["lsn"] + 1
+            if record["lsn"] >= durable or len(bodies) >= REPLICATION_PAGE:
+                break
+        if not bodies or self.position > durable:
+            # Caught up with the files; later records arrive live
+            self._backlog = None
+        return bodies
+
+
+# ---------- Follower ----------
+
+class Follower:
+    # Applies a primary's replicate stream to this process:
+    #   reset(bootstrap)  drop everything and start from a snapshot
+    #   load(frame)       one page of accounts, pending payments or blocks
+    #   apply(record)     one log record
+    #   chain_tip()       (height, hash of the last block) for resuming
+    def __init__(self, host, port, reset, load, apply, chain_tip):
+        self.host = host
+        self.port = port
+        self.reset = reset
+        self.load = load
+        self.apply = apply
+        self.chain_tip = chain_tip
+        self.applied_lsn = None
+        self.ready = False          # False until the first bootstrap is loaded
+        self.connected = False
+        self._stopped = False
+
+        # Replication state and counters
+        self.primary_durable_lsn = None
+        self.caught_up_at = None    # when applied_lsn last reached the primary's durable position
+        self.last_frame_at = None
+        self.records_applied = 0
+        self.bootstraps = 0
+        self.reconnects = 0
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="bank-follower", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stopped = True
+
+    def run(self):
+        while not self._stopped:
+            try:
+                with SecureConnection(self.host, self.port, timeout=REPLICATION_TIMEOUT) as conn:
+                    self.connected = True
+                    print(f"[BANK][FOLLOWER] Replicating from {self.host}:{self.port}")
+                    for frame in conn.request_stream(self._request()):
+                        if frame.get("status") != "success":
+                            print("[BANK][FOLLOWER] Primary refused to replicate:", frame.get("message"))
+                            break
+                        self._handle(frame)
+                        if self._stopped:
+                            break
+            except (OSError, ProtocolError) as e:
+                print(f"[BANK][FOLLOWER] Lost the primary: {e}")
+            finally:
+                self.connected = False
+            if not self._stopped:
+                self.reconnects += 1
+                time.sleep(RECONNECT_DELAY)
+
+    def _request(self):
+        request = {"action": "replicate"}
+        if self.applied_lsn is not None:
+            height, tip = self.chain_tip()
+            request.update(after_lsn=self.applied_lsn, chain_height=height, chain_tip=tip)
+        return request
+
+    def _handle(self, frame):
+        now = time.monotonic()
+        self.last_frame_at = now
+        if "bootstrap" in frame:
+            self.ready = False
+            self.reset(frame["bootstrap"])
+            self.applied_lsn = frame["bootstrap"]["lsn"]
+            self.bootstraps += 1
+            return
+        if "records" not in frame:
+            self.load(frame)
+            return
+        for record in frame["records"]:
+            self.apply(record)
+            self.applied_lsn = record["lsn"]
+        self.records_applied += len(frame["records"])
+        self.primary_durable_lsn = frame["durable_lsn"]
+        if self.applied_lsn >= self.primary_durable_lsn:
+            self.caught_up_at = now
+        self.ready = True
+
+    def status(self):
+        now = time.monotonic()
+        behind = None
+        if self.primary_durable_lsn is not None and self.applied_lsn is not None:
+            behind = max(self.primary_durable_lsn - self.applied_lsn, 0)
+        return {
+            "role": "follower",
+            "primary": f"{self.host}:{self.port}",
+            "connected": self.connected,
+            "ready": self.ready,
+            "applied_lsn": self.applied_lsn,
+            "primary_durable_lsn": self.primary_durable_lsn,
+            "lag_records": behind,
+            # Upper bound on how stale reads are: time since this follower
+            # last held everything the primary had made durable
+            "lag_seconds": round(now - self.caught_up_at, 3) if self.caught_up_at is not None else None,
+            "last_frame_seconds": round(now - self.last_frame_at, 3) if self.last_frame_at is not None else None,
+            "records_applied": self.records_applied,
+            "bootstraps": self.bootstraps,
+            "reconnects": self.reconnects
+        }
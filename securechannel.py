@@ -0,0 +1,229 @@
+# securechannel.py
+#
+# Per-connection authenticated encryption for the user -> merchant and
+# merchant -> bank hops.
+#
+# A client opens a persistent connection and sends one plaintext handshake
+# frame carrying an ephemeral X25519 public key; the server answers with its
+# own. Both sides derive two AES-256-GCM keys from the shared secret with
+# HKDF, one per direction, and keep them for the life of the connection. Every
+# later frame body is sealed:
+#   1-byte marker | 4-byte key epoch | 8-byte counter | ciphertext + 16-byte tag
+# The epoch and counter form the nonce, and the request id of the frame is
+# authenticated with it, so a frame cannot be replayed, reordered or moved to
+# another request. Frames travel in order on a connection, so the receiver
+# expects exactly the next counter.
+#
+# A sender rotates its key after ROTATE_AFTER_MESSAGES frames or
+# ROTATE_AFTER_SECONDS, by hashing the old key forward and bumping the epoch;
+# the receiver follows when it sees the new epoch. Rotation needs no round
+# trip and old keys are forgotten.
+#
+# When PAYMENT_SESSION_KEY is set on both ends it is mixed into the key
+# derivation, so only peers that know it can complete a session. Without it
+# the exchange is unauthenticated and a man in the middle can read the
+# traffic, so a server reachable off loopback should always have it.
+
+import os
+import time
+import struct
+import ipaddress
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from protocol import Connection, ProtocolError, decode_json, encode_json
+
+SEALED_MARKER = 0xE5
+SEALED_HEADER = struct.Struct(">BIQ")
+AAD = struct.Struct(">I")
+KEY_BYTES = 32
+ROTATE_AFTER_MESSAGES = 1 << 20
+ROTATE_AFTER_SECONDS = 600
+PROTOCOL_VERSION = 1
+
+SESSION_KEY = os.environ.get("PAYMENT_SESSION_KEY")
+
+
+def _hkdf(key_material, length, info, salt=None):
+    return HKDF(algorithm=hashes.SHA256(), length=length, salt=salt, info=info).derive(key_material)
+
+
+def _raw_public(private_key):
+    return private_key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+
+def _session_keys(private_key, peer_public, client_public, server_public):
+    shared = private_key.exchange(X25519PublicKey.from_public_bytes(peer_public))
+    salt = SESSION_KEY.encode() if SESSION_KEY else None
+    keys = _hkdf(shared, 2 * KEY_BYTES, b"payment-gateway session v1" + client_public + server_public, salt)
+    # (client -> server, server -> client)
+    return keys[:KEY_BYTES], keys[KEY_BYTES:]
+
+
+def unauthenticated_warning(host):
+    # A warning for a server listening on host, or None when sessions there
+    # are authenticated (or only reachable over loopback)
+    if SESSION_KEY:
+        return None
+    try:
+        if host == "localhost" or ipaddress.ip_address(host).is_loopback:
+            return None
+    except ValueError:
+        pass
+    return (f"PAYMENT_SESSION_KEY is not set, so sessions on {host} are not authenticated "
+            "and can be intercepted; set it on every host")
+
+
+def is_sealed(body):
+    return body[:1] == bytes((SEALED_MARKER,))
+
+
+class _Direction:
+    # Key, epoch and counter for one direction of a connection
+    __slots__ = ("key", "cipher", "epoch", "counter", "epoch_started")
+
+    def __init__(self, key):
+        self.key = key
+        self.cipher = AESGCM(key)
+        self.epoch = 0
+        self.counter = 0
+        self.epoch_started = time.monotonic()
+
+    def rotate(self):
+        self.key = _hkdf(self.key, KEY_BYTES, b"payment-gateway rotate")
+        self.cipher = AESGCM(self.key)
+        self.epoch += 1
+        self.counter = 0
+        self.epoch_started = time.monotonic()
+
+
+class SecureChannel:
+    # Seals outgoing and opens incoming frame bodies. Callers seal frames in
+    # the order they are written and open them in the order they are read.
+    def __init__(self, send_key, recv_key, rotate_after_messages=ROTATE_AFTER_MESSAGES,
+                 rotate_after_seconds=ROTATE_AFTER_SECONDS):
+        self._send = _Direction(send_key)
+        self._recv = _Direction(recv_key)
+        self.rotate_after_messages = rotate_after_messages
+        self.rotate_after_seconds = rotate_after_seconds
+
+        # Counters
+        self.sealed = 0
+        self.opened = 0
+        self.rotations = 0
+
+    def seal(self, request_id, body):
+        send = self._send
+        if (send.counter >= self.rotate_after_messages
+                or time.monotonic() - send.epoch_started >= self.rotate_after_seconds):
+            send.rotate()
+            self.rotations += 1
+        header = SEALED_HEADER.pack(SEALED_MARKER, send.epoch, send.counter)
+        ciphertext = send.cipher.encrypt(header[1:], body, AAD.pack(request_id))
+        send.counter += 1
+        self.sealed += 1
+        return header + ciphertext
+
+    def open(self, request_id, body):
+        if len(body) < SEALED_HEADER.size or not is_sealed(body):
+            raise ProtocolError("Expected an encrypted frame")
+        _, epoch, counter = SEALED_HEADER.unpack_from(body)
+        recv = self._recv
+        if epoch == recv.epoch + 1:
+            recv.rotate()
+        if epoch != recv.epoch or counter != recv.counter:
+            raise ProtocolError("Encrypted frame out of sequence")
+        try:
+            plaintext = recv.cipher.decrypt(body[1:SEALED_HEADER.size], body[SEALED_HEADER.size:],
+                                            AAD.pack(request_id))
+        except InvalidTag:
+            raise ProtocolError("Encrypted frame failed authentication")
+        recv.counter += 1
+        self.opened += 1
+        return plaintext
+
+
+# ---------- Client ----------
+
+class SecureConnection(Connection):
+    # Connection that agrees on session keys once, when it is opened, and
+    # seals every request after that
+    def __init__(self, host, port, timeout=None):
+        super().__init__(host, port, timeout)
+        self.channel = None
+        try:
+            private_key = X25519PrivateKey.generate()
+            client_public = _raw_public(private_key)
+            response = self.request({"action": "handshake", "version": PROTOCOL_VERSION,
+                                     "public_key": client_public.hex()})
+            if response.get("status") != "success":
+                raise ProtocolError(f"Handshake refused: {response.get('message')}")
+            server_public = bytes.fromhex(response["public_key"])
+            send_key, recv_key = _session_keys(private_key, server_public, client_public, server_public)
+        except Exception:
+            self.close()
+            raise
+        self.channel = SecureChannel(send_key, recv_key)
+
+    def _seal(self, request_id, body):
+        return body if self.channel is None else self.channel.seal(request_id, body)
+
+    def _open(self, request_id, body):
+        return body if self.channel is None else self.channel.open(request_id, body)
+
+
+# ---------- Server ----------
+
+class ServerSession:
+    # Server side of one connection. A client may start with a handshake and
+    # is encrypted from then on; a client that never sends one stays
+    # plaintext, and servers refuse payments from it.
+    def __init__(self):
+        self.channel = None
+        self.frames = 0
+
+    def receive(self, request_id, body):
+        # Returns (request body, None), or (None, reply body) when the frame
+        # was a handshake that is answered here
+        self.frames += 1
+        if self.channel is not None:
+            return self.channel.open(request_id, body), None
+        if is_sealed(body):
+            raise ProtocolError("Encrypted frame before a handshake")
+        if b'"handshake"' not in body:
+            return body, None
+        try:
+            request = decode_json(body)
+        except ValueError:
+            return body, None
+        if not isinstance(request, dict) or request.get("action") != "handshake":
+            return body, None
+        return None, encode_json(self._handshake(request))
+
+    def _handshake(self, request):
+        # Only the first frame may open a session, so every reply is either
+        # plaintext or sealed for the whole connection
+        if self.frames != 1:
+            raise ProtocolError("Handshake must be the first frame")
+        if request.get("version") != PROTOCOL_VERSION:
+            return {"status": "error", "message": f"Unsupported handshake version {request.get('version')}"}
+        try:
+            client_public = bytes.fromhex(request["public_key"])
+            private_key = X25519PrivateKey.generate()
+            server_public = _raw_public(private_key)
+            recv_key, send_key = _session_keys(private_key, client_public, client_public, server_public)
+        except (KeyError, TypeError, ValueError) as e:
+            raise ProtocolError(f"Bad handshake: {e}")
+        self.channel = SecureChannel(send_key, recv_key)
+        return {"status": "success", "version": PROTOCOL_VERSION, "public_key": server_public.hex()}
+
+    def send(self, request_id, body):
+        return body if self.channel is None else self.channel.seal(request_id, body)
+
+    @property
+    def encrypted(self):
+        return self.channel is not None
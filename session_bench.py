@@ -0,0 +1,123 @@
+# session_bench.py
+#
+# Measures what per-connection encryption (securechannel.py) adds to a
+# payment.
+#
+#   1. Crypto alone: sealing and opening a payment-sized frame, and the one
+#      handshake each connection pays when it is opened.
+#   2. Over loopback, against a bank in its own process: pings on a
+#      plaintext and on an encrypted connection, so the difference is the
+#      added latency of one hop, and payments on the encrypted one (the
+#      bank refuses them in plaintext). A payment crosses two encrypted hops
+#      (user -> merchant -> bank).
+#
+# Run with:
+#   python session_bench.py [--requests N]
+
+import sys
+import time
+import shutil
+import tempfile
+
+from protocol import Connection, encode_json, decode_json
+from securechannel import (SecureChannel, SecureConnection, ServerSession, X25519PrivateKey,
+                           PROTOCOL_VERSION, _raw_public, _session_keys)
+from loadgen import HOST, spawn, free_port, wait_for_port
+
+DEFAULT_REQUESTS = 5000
+PIN = "1234"
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    def at(p):
+        return samples[min(int(len(samples) * p), len(samples) - 1)] * 1e6
+    return at(0.50), at(0.99)
+
+
+def bench_crypto(count):
+    body = encode_json({"encrypted_merchant_id": "x" * 16, "mmid": "m" * 64, "pin": PIN,
+                        "amount": 125.5, "idempotency_key": "k" * 32})
+    key = bytes(32)
+    sender, receiver = SecureChannel(key, key), SecureChannel(key, key)
+    start = time.perf_counter()
+    for i in range(count):
+        receiver.open(i, sender.seal(i, body))
+    per_message = (time.perf_counter() - start) / count
+
+    # Both sides of one handshake: what a connection pays once, when it is opened
+    rounds = min(count, 1000)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        private_key = X25519PrivateKey.generate()
+        client_public = _raw_public(private_key)
+        request = encode_json({"action": "handshake", "version": PROTOCOL_VERSION,
+                               "public_key": client_public.hex()})
+        reply = decode_json(ServerSession().receive(1, request)[1])
+        server_public = bytes.fromhex(reply["public_key"])
+        _session_keys(private_key, server_public, client_public, server_public)
+    handshake = (time.perf_counter() - start) / rounds
+    print(f"[BENCH] seal + open of a {len(body)}-byte payment: {per_message * 1e6:.1f} us")
+    print(f"[BENCH] handshake, both sides (X25519 + HKDF): {handshake * 1e6:.1f} us")
+
+
+def round_trips(connection, request, count):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = connection.request(request)
+        samples.append(time.perf_counter() - start)
+        if response.get("status") != "success":
+            raise RuntimeError(response.get("message"))
+    return samples
+
+
+def bench_loopback(count):
+    workdir = tempfile.mkdtemp(prefix="session-bench-")
+    port = free_port()
+    bank = spawn("--serve-bank", port, workdir, 0)
+    try:
+        wait_for_port(port)
+        with SecureConnection(HOST, port) as setup:
+            mmid = setup.request({"action": "register_user", "name": "bench", "password": "pw",
+                                  "ifsc_code": "BENCH001", "balance": 1e12, "pin_code": PIN,
+                                  "phone_number": "7000000000"})["mmid"]
+            merchant_id = setup.request({"action": "register_merchant", "name": "bench", "password": "pw",
+                                         "ifsc_code": "BENCH001", "balance": 0.0})["merchant_id"]
+        payment = {"action": "validate_transaction", "mmid": mmid, "pin": PIN, "amount": 1,
+                   "encrypted_merchant_id": merchant_id}
+
+        # The bank only takes payments over an encrypted session, so the
+        # plaintext baseline is a ping
+        with Connection(HOST, port) as plain, SecureConnection(HOST, port) as secure:
+            # Warm up both connections (and the bank's PIN session cache)
+            round_trips(plain, {"action": "ping"}, 50)
+            round_trips(secure, {"action": "ping"}, 50)
+            round_trips(secure, payment, 50)
+            plain_p50, plain_p99 = percentiles(round_trips(plain, {"action": "ping"}, count))
+            secure_p50, secure_p99 = percentiles(round_trips(secure, {"action": "ping"}, count))
+            payment_p50, payment_p99 = percentiles(round_trips(secure, payment, count))
+        print(f"[BENCH] {'ping':20} plaintext p50 {plain_p50:7.1f} us  p99 {plain_p99:7.1f} us | "
+              f"encrypted p50 {secure_p50:7.1f} us  p99 {secure_p99:7.1f} us | "
+              f"added p50 {secure_p50 - plain_p50:+.1f} us")
+        print(f"[BENCH] {'validate_transaction':20} encrypted p50 {payment_p50:7.1f} us  p99 {payment_p99:7.1f} us")
+
+        start = time.perf_counter()
+        for _ in range(100):
+            SecureConnection(HOST, port).close()
+        print(f"[BENCH] opening an encrypted connection: {(time.perf_counter() - start) * 10:.2f} ms")
+    finally:
+        bank.terminate()
+        bank.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    args = sys.argv[1:]
+    count = int(args[args.index("--requests") + 1]) if "--requests" in args else DEFAULT_REQUESTS
+    bench_crypto(count * 10)
+    bench_loopback(count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+# settlement.py
+#
+# End-of-day settlement and reconciliation.
+#
+# The sealed transactions are read straight out of transactions.dat as a
+# NumPy memmap (blockstore.TX_DTYPE), SETTLEMENT_CHUNK records at a time, so
+# the chain is never decoded into dicts. Each chunk is grouped by MMID and by
+# merchant ID with one sort per key: argsort, then add.reduceat over the runs
+# of equal keys. The groups are then added into totals aligned with the
+# bank's accounts (sorted uint64 keys, the same 8 bytes as in the file).
+#
+# One pass gives two sets of totals:
+#   - the day's settlement: per merchant, what it is owed for the payments
+#     sealed that (UTC) day; per user, what they paid;
+#   - every payment ever made, which reconciliation checks against the
+#     account balances:
+#       user      opening_balance - paid (sealed, pending, held) == balance
+#       merchant  opening_balance + received (sealed, pending)   == balance
+#
+# Payments of accounts this bank does not hold (the other side of a
+# cross-shard payment, on a shard) are counted apart. The bank runs the job
+# with the get_settlement action; `python settlement.py [--day YYYY-MM-DD]`
+# asks it for one and prints the summary.
+
+import os
+import sys
+import json
+import datetime
+
+import numpy as np
+
+from blockstore import TX_DTYPE, FILE_HEADER, TRANSACTIONS_FILE
+
+BANK_HOST = '192.168.1.7'
+BANK_PORT = 9999
+
+# Records per chunk (64 bytes each)
+SETTLEMENT_CHUNK = 1 << 21
+
+# Balances are sums of floats added in another order; they may differ from
+# the totals here by rounding
+BALANCE_TOLERANCE = 1e-6
+
+# Mismatched accounts listed in a report; the rest are only counted
+MAX_REPORTED_MISMATCHES = 100
+
+
+def day_bounds(day=None):
+    # (start, end, "YYYY-MM-DD") of a UTC day, as epoch seconds; today when
+    # day is None
+    if day is None:
+        date = datetime.datetime.now(datetime.timezone.utc).date()
+    else:
+        date = datetime.date.fromisoformat(day)
+    start = datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc).timestamp()
+    return start, start + 86400, date.isoformat()
+
+
+def ids_to_keys(ids):
+    # Hex account IDs as uint64 keys
+    return np.frombuffer(bytes.fromhex("".join(ids)), dtype="<u8")
+
+
+def read_transactions(directory, start, end):
+    # Sealed transactions start..end of a block store, chunk by chunk, as
+    # TX_DTYPE arrays backed by the file
+    if end <= start:
+        return
+    records = np.memmap(os.path.join(directory, TRANSACTIONS_FILE), dtype=TX_DTYPE, mode="r",
+                        offset=FILE_HEADER.size, shape=(end,))
+    for offset in range(start, end, SETTLEMENT_CHUNK):
+        yield records[offset:min(offset + SETTLEMENT_CHUNK, end)]
+
+
+def transactions_array(transactions):
+    # Transaction dicts (pending, held) as a TX_DTYPE array
+    records = np.zeros(len(transactions), dtype=TX_DTYPE)
+    if transactions:
+        records["mmid"] = ids_to_keys([tx["mmid"] for tx in transactions]).view("V8")
+        records["merchant_id"] = ids_to_keys([tx["merchant_id"] for tx in transactions]).view("V8")
+        records["amount"] = [float(tx["amount"]) for tx in transactions]
+        records["timestamp"] = [tx["timestamp"] for tx in transactions]
+    return records
+
+
+def group(keys, amounts):
+    # (distinct keys in order, sum of amounts, count) per key
+    if not len(keys):
+        return keys, np.zeros(0), np.zeros(0, dtype=np.int64)
+    order = np.argsort(keys)
+    keys = keys[order]
+    first = np.empty(len(keys), dtype=bool)
+    first[0] = True
+    np.not_equal(keys[1:], keys[:-1], out=first[1:])
+    starts = np.flatnonzero(first)
+    return keys[starts], np.add.reduceat(amounts[order], starts), np.diff(np.append(starts, len(keys)))
+
+
+class Accounts:
+    # One kind of account as columns sorted by key: ids, keys, balances and
+    # opening balances (NaN where unknown)
+    def __init__(self, database, ids=None):
+        ids = list(database) if ids is None else ids
+        keys = ids_to_keys(ids)
+        order = np.argsort(keys)
+        self.ids = [ids[i] for i in order]
+        self.keys = keys[order]
+        self.balances = np.zeros(len(ids))
+        self.opening = np.array([_or_nan(database[i].get('opening_balance')) for i in ids], dtype=float)
+
+    def read_balances(self, database):
+        self.balances = np.array([database[i]['balance'] for i in self.ids], dtype=float)
+
+    def subset(self, database, positions):
+        return Accounts(database, [self.ids[i] for i in positions])
+
+
+def _or_nan(value):
+    return float("nan") if value is None else value
+
+
+class AccountTotals:
+    # Payment count and amount per account; payments of other accounts are
+    # counted apart
+    def __init__(self, keys):
+        self.keys = keys
+        self.amount = np.zeros(len(keys))
+        self.count = np.zeros(len(keys), dtype=np.int64)
+        self.other_amount = 0.0
+        self.other_count = 0
+
+    def add(self, keys, amounts):
+        keys, sums, counts = group(keys, amounts)
+        if not len(keys):
+            return
+        if len(self.keys):
+            at = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+            found = self.keys[at] == keys
+        else:
+            at = np.zeros(len(keys), dtype=np.intp)
+            found = np.zeros(len(keys), dtype=bool)
+        # Keys are distinct, so no position is added to twice
+        self.amount[at[found]] += sums[found]
+        self.count[at[found]] += counts[found]
+        self.other_amount += float(sums[~found].sum())
+        self.other_count += int(counts[~found].sum())
+
+    def rows(self, ids, key):
+        paid = np.flatnonzero(self.count)
+        return [{key: ids[i], "transactions": int(self.count[i]), "amount": float(self.amount[i])} for i in paid]
+
+
+class Settlement:
+    def __init__(self, start, end, users, merchants):
+        self.start = start
+        self.end = end
+        self.users = users
+        self.merchants = merchants
+        # Every sealed payment, and the day's
+        self.paid = AccountTotals(users.keys)
+        self.received = AccountTotals(merchants.keys)
+        self.day_paid = AccountTotals(users.keys)
+        self.day_received = AccountTotals(merchants.keys)
+
+    def add_sealed(self, directory, start, end):
+        for records in read_transactions(directory, start, end):
+            mmids = np.ascontiguousarray(records["mmid"]).view("<u8")
+            merchant_ids = np.ascontiguousarray(records["merchant_id"]).view("<u8")
+            amounts = np.ascontiguousarray(records["amount"])
+            timestamps = records["timestamp"]
+            self.paid.add(mmids, amounts)
+            self.received.add(merchant_ids, amounts)
+            # Blocks are not sealed in timestamp order, so the day is a mask
+            # rather than a range
+            today = (timestamps >= self.start) & (timestamps < self.end)
+            if today.any():
+                self.day_paid.add(mmids[today], amounts[today])
+                self.day_received.add(merchant_ids[today], amounts[today])
+
+    def expected(self, pending, held):
+        # Balances implied by the sealed payments, the pending ones (not yet
+        # in a block) and the held ones (debited by a prepared cross-shard
+        # payment)
+        paid = AccountTotals(self.users.keys)
+        received = AccountTotals(self.merchants.keys)
+        pending = transactions_array(pending)
+        held = transactions_array(held)
+        paid.add(np.concatenate([pending["mmid"], held["mmid"]]).view("<u8"),
+                 np.concatenate([pending["amount"], held["amount"]]))
+        received.add(pending["merchant_id"].view("<u8"), pending["amount"])
+        return (self.users.opening - self.paid.amount - paid.amount,
+                self.merchants.opening + self.received.amount + received.amount)
+
+    def mismatches(self, expected_users, expected_merchants):
+        # Positions of the users and merchants whose balance is off.
+        # Accounts without an opening balance cannot be checked.
+        def off(balances, expected):
+            wrong = ~np.isclose(balances, expected, rtol=1e-12, atol=BALANCE_TOLERANCE)
+            return np.flatnonzero(wrong & ~np.isnan(expected))
+        return off(self.users.balances, expected_users), off(self.merchants.balances, expected_merchants)
+
+    def reconciliation(self, mismatches, mismatch_count):
+        unverified = int(np.isnan(self.users.opening).sum() + np.isnan(self.merchants.opening).sum())
+        return {
+            "users_checked": len(self.users.ids) - int(np.isnan(self.users.opening).sum()),
+            "merchants_checked": len(self.merchants.ids) - int(np.isnan(self.merchants.opening).sum()),
+            "unverified": unverified,
+            "opening_total": float(np.nansum(self.users.opening) + np.nansum(self.merchants.opening)),
+            "balance_total": float(self.users.balances.sum() + self.merchants.balances.sum()),
+            "mismatch_count": mismatch_count,
+            "mismatches": mismatches,
+            "balanced": mismatch_count == 0
+        }
+
+    def restrict(self, database_users, database_merchants, user_positions, merchant_positions):
+        # A settlement over just these accounts, starting from their totals
+        # so far, for checking them again
+        check = Settlement(self.start, self.end, self.users.subset(database_users, user_positions),
+                           self.merchants.subset(database_merchants, merchant_positions))
+        check.paid.amount += self.paid.amount[user_positions]
+        check.received.amount += self.received.amount[merchant_positions]
+        return check
+
+    def report(self, day, by="merchant"):
+        # The day's totals, with a settlement line for each merchant paid
+        # that day (or, by="user", each user who paid). Payments are counted
+        # by the bank that holds the paying user, so shards that each hold
+        # one side of a payment count it once between them.
+        if by == "user":
+            settlements = self.day_paid.rows(self.users.ids, "mmid")
+        else:
+            settlements = self.day_received.rows(self.merchants.ids, "merchant_id")
+        return {
+            "day": day,
+            "start_time": self.start,
+            "end_time": self.end,
+            "sealed_transactions": int(self.paid.count.sum()),
+            "transactions": int(self.day_paid.count.sum()),
+            "amount": float(self.day_paid.amount.sum()),
+            "merchants": int(np.count_nonzero(self.day_received.count)),
+            "users": int(np.count_nonzero(self.day_paid.count)),
+            "settlements": settlements,
+            # Sealed payments with a user or merchant this bank does not hold;
+            # outside a shard there should be none
+            "other_accounts": {
+                "transactions": self.paid.other_count + self.received.other_count,
+                "amount": self.paid.other_amount + self.received.other_amount,
+                "day_transactions": self.day_paid.other_count + self.day_received.other_count,
+                "day_amount": self.day_paid.other_amount + self.day_received.other_amount
+            }
+        }
+
+
+def mismatch_rows(kind, accounts, expected, positions):
+    return [{"kind": kind, "id": accounts.ids[i], "balance": float(accounts.balances[i]),
+             "expected": float(expected[i])} for i in positions[:MAX_REPORTED_MISMATCHES]]
+
+
+# ---------- Client ----------
+
+def main():
+    # python settlement.py [--day YYYY-MM-DD] [--by merchant|user] [--host H] [--port P] [--out FILE]
+    from protocol import Connection
+
+    args = sys.argv[1:]
+    request = {"action": "get_settlement"}
+    if "--day" in args:
+        request["day"] = args[args.index("--day") + 1]
+    if "--by" in args:
+        request["by"] = args[args.index("--by") + 1]
+    host = args[args.index("--host") + 1] if "--host" in args else BANK_HOST
+    port = int(args[args.index("--port") + 1]) if "--port" in args else BANK_PORT
+    with Connection(host, port) as conn:
+        report = conn.request(request)
+    if report.get("status") != "success":
+        print("Settlement failed:", report.get("message"))
+        sys.exit(1)
+    print(f"Settlement for {report['day']}: {report['transactions']} payments, {report['amount']:.2f} in total, "
+          f"{report['merchants']} merchants, {report['users']} users")
+    reconciliation = report["reconciliation"]
+    print(f"Reconciliation: {reconciliation['users_checked']} users and {reconciliation['merchants_checked']} "
+          f"merchants checked, {reconciliation['mismatch_count']} mismatches ({report['elapsed_ms']} ms)")
+    for row in reconciliation["mismatches"]:
+        print(f"  {row['kind']} {row['id']}: balance {row['balance']}, expected {row['expected']}")
+    out = args[args.index("--out") + 1] if "--out" in args else f"settlement-{report['day']}.json"
+    with open(out, "w") as f:
+        json.dump(report, f, indent=1)
+    print("Report written to", out)
+    sys.exit(0 if reconciliation["balanced"] else 2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# settlement_bench.py
+#
+# Measures the end-of-day settlement job (settlement.py) on a large chain.
+#
+# Writes a transactions.dat of N random payments (U users, M merchants,
+# spread over DAYS days) in a temporary directory, then times one settlement
+# pass over it: the day's totals per merchant and per user, and the all-time
+# totals that reconciliation checks. For comparison, it also times decoding
+# a sample of the same transactions into dicts, the way the chain is read
+# one block at a time, and extrapolates that to N.
+#
+# Run with:
+#   python settlement_bench.py [--transactions N] [--users U] [--merchants M] [--days DAYS]
+# 20M transactions take about 1.3 GB of disk.
+
+import os
+import sys
+import mmap
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+from blockstore import FILE_HEADER, TRANSACTIONS_FILE, TRANSACTIONS_MAGIC, TX_DTYPE, TX_RECORD
+from settlement import Settlement, Accounts, day_bounds
+
+DEFAULTS = {"transactions": 20_000_000, "users": 1_000_000, "merchants": 100_000, "days": 30}
+DICT_SAMPLE = 200_000
+
+
+def write_transactions(directory, count, users, merchants, first_day, days, rng):
+    # Same layout as BlockStore.append writes, in chunks
+    user_keys = Accounts(users).keys
+    merchant_keys = Accounts(merchants).keys
+    with open(os.path.join(directory, TRANSACTIONS_FILE), "wb") as f:
+        f.write(FILE_HEADER.pack(TRANSACTIONS_MAGIC, count))
+        for offset in range(0, count, 1 << 21):
+            n = min(1 << 21, count - offset)
+            records = np.zeros(n, dtype=TX_DTYPE)
+            records["tx_id"] = np.frombuffer(rng.bytes(32 * n), dtype="V32")
+            records["mmid"] = user_keys[rng.integers(0, len(user_keys), n)].view("V8")
+            records["merchant_id"] = merchant_keys[rng.integers(0, len(merchant_keys), n)].view("V8")
+            records["amount"] = rng.integers(1, 10000, n) / 100
+            records["timestamp"] = np.sort(first_day + rng.random(n) * days * 86400)
+            records.tofile(f)
+
+
+def main():
+    args = sys.argv[1:]
+    config = dict(DEFAULTS)
+    for key in DEFAULTS:
+        if f"--{key}" in args:
+            config[key] = int(args[args.index(f"--{key}") + 1])
+    rng = np.random.default_rng(1)
+    start, end, day = day_bounds()
+    first_day = start - (config["days"] - 1) * 86400
+
+    users = {rng.bytes(8).hex(): {"balance": 0.0, "opening_balance": 0.0} for _ in range(config["users"])}
+    merchants = {rng.bytes(8).hex(): {"balance": 0.0, "opening_balance": 0.0} for _ in range(config["merchants"])}
+    directory = tempfile.mkdtemp(prefix="settlement-bench-")
+    try:
+        print(f"Writing {config['transactions']} transactions ({config['users']} users, "
+              f"{config['merchants']} merchants, {config['days']} days)...")
+        write_transactions(directory, config["transactions"], users, merchants, first_day, config["days"], rng)
+
+        started = time.perf_counter()
+        run = Settlement(start, end, Accounts(users), Accounts(merchants))
+        accounts_time = time.perf_counter() - started
+        run.add_sealed(directory, 0, config["transactions"])
+        elapsed = time.perf_counter() - started
+        report = run.report(day)
+        print(f"Settlement: {elapsed:.2f} s ({config['transactions'] / elapsed / 1e6:.1f}M transactions/s, "
+              f"{accounts_time:.2f} s of it loading accounts)")
+        print(f"  {day}: {report['transactions']} payments, {report['amount']:.2f} in total, "
+              f"{report['merchants']} merchants, {report['users']} users")
+
+        # The same totals from transaction dicts, decoded as
+        # BlockStore.transaction does, for a sample
+        sample = min(DICT_SAMPLE, config["transactions"])
+        with open(os.path.join(directory, TRANSACTIONS_FILE), "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        started = time.perf_counter()
+        paid, received, day_received = {}, {}, {}
+        for number in range(sample):
+            tx_id, mmid, merchant_id, amount, timestamp = TX_RECORD.unpack_from(
+                mm, FILE_HEADER.size + number * TX_RECORD.size)
+            tx = {"tx_id": tx_id.hex(), "mmid": mmid.hex(), "merchant_id": merchant_id.hex(),
+                  "amount": amount, "timestamp": timestamp}
+            paid[tx["mmid"]] = paid.get(tx["mmid"], 0.0) + tx["amount"]
+            received[tx["merchant_id"]] = received.get(tx["merchant_id"], 0.0) + tx["amount"]
+            if start <= tx["timestamp"] < end:
+                day_received[tx["merchant_id"]] = day_received.get(tx["merchant_id"], 0.0) + tx["amount"]
+        per_tx = (time.perf_counter() - started) / sample
+        mm.close()
+        print(f"Decoding into dicts: {per_tx * 1e6:.2f} us per transaction, about "
+              f"{per_tx * config['transactions']:.1f} s for all {config['transactions']}")
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,487 @@
+# shards.py
+#
+# Sharded bank: python bank.py --shards N
+#
+# Accounts are partitioned over N shard processes by a hash of the MMID or
+# merchant ID (shard_of). Each shard is an ordinary bank process with its own
+# write-ahead log, snapshots and chain segment, and only hands out account IDs
+# that hash to it. A router process in front of them takes the clients'
+# connections and forwards each request to the shard that owns the accounts.
+#
+# A payment between a user and a merchant on different shards is committed
+# with two-phase commit, the router acting as coordinator:
+#   1. prepare: the user's shard checks the PIN and holds the amount (the
+#      balance is debited); the merchant's shard checks the merchant. Both
+#      journal the prepared payment before voting yes.
+#   2. the router journals its commit decision in its own log; that is the
+#      commit point. It then sends commit to both shards, which record the
+#      transaction in their chain segments (the merchant's shard credits the
+#      merchant), and journals that the payment is done.
+# Any no vote or failure before the decision aborts both sides; the user's
+# hold is refunded. A prepared payment the router has no commit decision for
+# is aborted (presumed abort). A resolver thread finishes payments left half
+# done by a crash or an unreachable shard, on startup and every
+# RESOLVE_INTERVAL seconds.
+#
+# Global order: the router timestamps every payment it forwards from one
+# strictly increasing clock, and shards use that timestamp in the
+# transaction. Ordering all shards' transactions by (timestamp, tx_id) is the
+# merged ledger that get_merged_ledger serves. It only returns transactions
+# up to a horizon before which every shard has sealed everything, so pages
+# never change once served.
+#
+# Deadlines: a request's timeout_ms is passed on to the shards with what is
+# left of it, and bounds the wait for their replies. A cross-shard payment
+# whose deadline passes before the commit decision is aborted.
+
+import os
+import sys
+import time
+import math
+import heapq
+import socket
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from wal import WriteAheadLog
+from merchant import BankConnectionPool
+from deadlines import deadline_from, remaining, expired, with_deadline, expired_response
+
+# Shard processes started by the router listen on consecutive ports
+SHARD_HOST = '127.0.0.1'
+SHARD_BASE_PORT = 10000
+SHARD_METRICS_BASE_PORT = 9110
+SHARD_START_TIMEOUT = 30
+
+# Router side: pooled connections per shard, and threads for calls that go
+# to several shards at once
+SHARD_POOL_SIZE = 32
+SHARD_CALL_THREADS = 64
+SHARD_CALL_TIMEOUT = 30          # for requests without a deadline
+RESOLVE_INTERVAL = 5
+MAX_MERGED_PAGE = 1000
+
+
+def shard_of(key, count):
+    # Stable across processes and restarts, unlike hash()
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big") % count
+
+
+# ---------- Shard Processes ----------
+
+def start_shards(count, data_dir, extra_args=()):
+    # Starts count shard processes of bank.py on this host and waits until
+    # all of them accept connections. Returns the processes and addresses.
+    bank_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bank.py")
+    processes, addresses = [], []
+    for index in range(count):
+        port = SHARD_BASE_PORT + index
+        processes.append(subprocess.Popen([
+            sys.executable, bank_py, "--shard", f"{index}/{count}", "--host", SHARD_HOST,
+            "--port", str(port), "--data", os.path.join(data_dir, f"shard-{index}"), *extra_args
+        ]))
+        addresses.append((SHARD_HOST, port))
+    deadline = time.monotonic() + SHARD_START_TIMEOUT
+    for process, address in zip(processes, addresses):
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"Shard on port {address[1]} exited with code {process.returncode}")
+            try:
+                socket.create_connection(address, timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Shard on port {address[1]} did not start")
+                time.sleep(0.1)
+    return processes, addresses
+
+
+# ---------- Router ----------
+
+class GlobalClock:
+    # Timestamps for payments, strictly increasing across the whole bank.
+    # Timestamps handed out and not yet finished are "in flight": the merged
+    # ledger stops short of the oldest of them.
+    def __init__(self):
+        self._last = 0.0
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def begin(self):
+        with self._lock:
+            self._last = max(time.time(), math.nextafter(self._last, math.inf))
+            self._in_flight.add(self._last)
+            return self._last
+
+    def hold(self, timestamp):
+        with self._lock:
+            self._in_flight.add(timestamp)
+
+    def end(self, timestamp):
+        with self._lock:
+            self._in_flight.discard(timestamp)
+
+    def horizon(self):
+        # Every payment stamped before this has finished at the router
+        with self._lock:
+            return min(self._in_flight) if self._in_flight else time.time()
+
+
+class ShardRouter:
+    def __init__(self, addresses, directory):
+        self.addresses = addresses
+        self.pools = [BankConnectionPool(host, port, size=SHARD_POOL_SIZE) for host, port in addresses]
+        self.clock = GlobalClock()
+        # Calls to one shard; never submit more work, so they cannot deadlock
+        # behind the batches that wait on them
+        self._calls = ThreadPoolExecutor(SHARD_CALL_THREADS, thread_name_prefix="shard-call")
+        self._batches = ThreadPoolExecutor(SHARD_CALL_THREADS, thread_name_prefix="shard-batch")
+        self._next_shard = 0
+        self._lock = threading.Lock()
+
+        # Cross-shard payments being prepared, and those decided to commit
+        # whose shards have not all confirmed: tx_id -> (lsn, shards, timestamp)
+        self._active = set()
+        self.in_doubt = {}
+
+        # Counters
+        self.cross_shard_commits = 0
+        self.cross_shard_aborts = 0
+        self.resolved = 0
+
+        # The commit decisions; replaying them restores in_doubt
+        self.decisions = WriteAheadLog(directory, apply=self._apply_decision)
+
+    def _apply_decision(self, record):
+        if record["type"] == "commit":
+            self.in_doubt[record["tx_id"]] = (record["lsn"], record["shards"], record["timestamp"])
+        elif record["type"] == "done":
+            self.in_doubt.pop(record["tx_id"], None)
+
+    def shard_of(self, key):
+        return shard_of(key, len(self.pools))
+
+    # ----- Calls to shards -----
+
+    def call(self, index, request, deadline=None):
+        # Failures come back as error responses, like the bank's own
+        try:
+            timeout = SHARD_CALL_TIMEOUT if deadline is None else remaining(deadline)
+            return self.pools[index].request(with_deadline(request, deadline), timeout)
+        except socket.timeout:
+            return {"status": "error", "message": f"Deadline exceeded waiting for shard {index}"}
+        except Exception as e:
+            return {"status": "error", "message": f"Shard {index} unavailable: {e}"}
+
+    def call_many(self, calls, deadline=None):
+        # [(shard, request)] sent in parallel; replies in the same order
+        futures = [self._calls.submit(self.call, index, request, deadline) for index, request in calls]
+        return [future.result() for future in futures]
+
+    def fan_out(self, request, deadline=None):
+        return self.call_many([(index, request) for index in range(len(self.pools))], deadline)
+
+    # ----- Payments -----
+
+    def pay(self, data, deadline=None):
+        # One validate_transaction. Within one shard it is forwarded as is,
+        # with the router's timestamp.
+        try:
+            mmid = data['mmid']
+            merchant_id = data['encrypted_merchant_id']  # Simulated decryption, as in the bank
+            user_shard, merchant_shard = self.shard_of(mmid), self.shard_of(merchant_id)
+            amount = float(data['amount'])
+        except KeyError as e:
+            return {"status": "error", "message": f"Missing field: {str(e)}"}
+        except (TypeError, ValueError, AttributeError) as e:
+            return {"status": "error", "message": str(e)}
+
+        timestamp = self.clock.begin()
+        try:
+            if user_shard == merchant_shard:
+                return self.call(user_shard, dict(data, timestamp=timestamp), deadline)
+            return self._pay_across(data, mmid, merchant_id, amount, timestamp, user_shard, merchant_shard, deadline)
+        finally:
+            self.clock.end(timestamp)
+
+    def _pay_across(self, data, mmid, merchant_id, amount, timestamp, user_shard, merchant_shard, deadline):
+        tx_id = hashlib.sha256(f"{mmid}{merchant_id}{timestamp}{amount}".encode()).hexdigest()
+        tx = {"tx_id": tx_id, "mmid": mmid, "merchant_id": merchant_id, "amount": amount, "timestamp": timestamp}
+        shards = [user_shard, merchant_shard]
+        with self._lock:
+            self._active.add(tx_id)
+        try:
+            debit, credit = self.call_many([
+                (user_shard, {"action": "prepare_payment", "side": "debit", "tx": tx, "pin": data.get('pin')}),
+                (merchant_shard, {"action": "prepare_payment", "side": "credit", "tx": tx})
+            ], deadline)
+            late = expired(deadline)
+            if late or debit.get("status") != "success" or credit.get("status") != "success":
+                # Aborts are sent without the deadline: they must get through
+                self.call_many([(index, {"action": "abort_payment", "tx_id": tx_id}) for index in shards])
+                with self._lock:
+                    self.cross_shard_aborts += 1
+                if late:
+                    return expired_response()
+                return debit if debit.get("status") != "success" else credit
+
+            # The commit point: from here on the payment happens, even if a
+            # shard or this router fails before it is told
+            lsn = self.decisions.log({"type": "commit", "tx_id": tx_id, "shards": shards, "timestamp": timestamp})
+            with self._lock:
+                self.in_doubt[tx_id] = (lsn, shards, timestamp)
+                self.cross_shard_commits += 1
+            self._finish(tx_id, shards)
+            return {
+                "status": "success",
+                "message": f"Transaction of {amount} successful",
+                "remaining_balance": debit["remaining_balance"],
+                "tx_id": tx_id
+            }
+        finally:
+            with self._lock:
+                self._active.discard(tx_id)
+
+    def _finish(self, tx_id, shards):
+        # Phase two. A shard that does not confirm is retried by the resolver.
+        replies = self.call_many([(index, {"action": "commit_payment", "tx_id": tx_id}) for index in shards])
+        if all(reply.get("status") == "success" for reply in replies):
+            with self._lock:
+                self.in_doubt.pop(tx_id, None)
+            self.decisions.append({"type": "done", "tx_id": tx_id})
+            return True
+        return False
+
+    def pay_batch(self, items, pay_single, received=None):
+        # validate_transactions: the payments within one shard go to it as
+        # one batch, each with its own timestamp; cross-shard payments go
+        # through pay_single one by one. Results keep the request order.
+        # Each payment keeps its own timeout_ms; the shard batch waits as
+        # long as the payment with the most time left.
+        results = [None] * len(items)
+        groups = {}
+        crossing = []
+        for i, item in enumerate(items):
+            try:
+                user_shard = self.shard_of(item['mmid'])
+                merchant_shard = self.shard_of(item['encrypted_merchant_id'])
+            except KeyError as e:
+                results[i] = {"status": "error", "message": f"Missing field: {str(e)}"}
+                continue
+            except (TypeError, AttributeError) as e:
+                results[i] = {"status": "error", "message": str(e)}
+                continue
+            if user_shard == merchant_shard:
+                groups.setdefault(user_shard, []).append(i)
+            else:
+                crossing.append(i)
+
+        def run_group(index, positions):
+            deadlines = [deadline_from(items[i], received) for i in positions]
+            deadline = None if None in deadlines else max(deadlines)
+            stamps = [self.clock.begin() for _ in positions]
+            try:
+                reply = self.call(index, {"action": "validate_transactions", "transactions": [
+                    with_deadline(dict(items[i], timestamp=stamp), item_deadline)
+                    for i, stamp, item_deadline in zip(positions, stamps, deadlines)]}, deadline)
+            finally:
+                for stamp in stamps:
+                    self.clock.end(stamp)
+            for n, i in enumerate(positions):
+                results[i] = reply["results"][n] if reply.get("status") == "success" else reply
+
+        def run_single(i):
+            results[i] = pay_single(items[i])
+
+        futures = [self._batches.submit(run_group, index, positions) for index, positions in groups.items()]
+        futures += [self._batches.submit(run_single, i) for i in crossing]
+        for future in futures:
+            future.result()
+        return {"status": "success", "results": results}
+
+    # ----- Recovery -----
+
+    def resolve(self):
+        # Finishes what crashes and unreachable shards left half done:
+        # decided payments are committed again, and payments prepared on a
+        # shard without a decision are aborted
+        with self._lock:
+            in_doubt = dict(self.in_doubt)
+        for tx_id, (lsn, shards, timestamp) in in_doubt.items():
+            self.clock.hold(timestamp)
+            try:
+                if self._finish(tx_id, shards):
+                    with self._lock:
+                        self.resolved += 1
+                    print(f"[BANK][ROUTER] Committed in-doubt payment {tx_id}")
+            finally:
+                self.clock.end(timestamp)
+
+        for index, reply in enumerate(self.fan_out({"action": "list_prepared"})):
+            for entry in reply.get("prepared", []):
+                tx_id = entry["tx_id"]
+                with self._lock:
+                    if tx_id in self._active or tx_id in self.in_doubt:
+                        continue
+                if self.call(index, {"action": "abort_payment", "tx_id": tx_id}).get("status") == "success":
+                    with self._lock:
+                        self.resolved += 1
+                    print(f"[BANK][ROUTER] Aborted undecided payment {tx_id} on shard {index}")
+
+        # Decisions older than every in-doubt payment are no longer needed
+        with self._lock:
+            oldest = min((lsn for lsn, _, _ in self.in_doubt.values()), default=None)
+        covered = self.decisions.rotate() - 1 if oldest is None else oldest - 1
+        self.decisions.prune(covered)
+
+    def start_resolver(self, interval=RESOLVE_INTERVAL):
+        def run():
+            while True:
+                try:
+                    self.resolve()
+                except Exception as e:
+                    print("[BANK][ROUTER] Resolving payments failed:", str(e))
+                time.sleep(interval)
+
+        thread = threading.Thread(target=run, name="shard-resolver", daemon=True)
+        thread.start()
+        return thread
+
+    # ----- Queries -----
+
+    def merged_ledger(self, data):
+        # Sealed transactions of all shards in global order, after the
+        # timestamp cursor "after". A cross-shard payment is sealed on both
+        # of its shards and listed once.
+        try:
+            after = float(data.get('after', 0))
+            limit = min(max(int(data.get('limit', 100)), 0), MAX_MERGED_PAGE)
+        except (TypeError, ValueError) as e:
+            return {"status": "error", "message": str(e)}
+
+        # Taken before asking the shards: anything stamped before it has
+        # reached its shard by the time they answer
+        bound = self.clock.horizon()
+        replies = self.fan_out({"action": "get_transactions_in_range", "start_time": after,
+                                "end_time": bound, "limit": limit + 1})
+        segments = []
+        for index, reply in enumerate(replies):
+            if reply.get("status") != "success":
+                return reply
+            if reply.get("sealed_before") is not None:
+                bound = min(bound, reply["sealed_before"])
+            transactions = reply["transactions"]
+            if transactions and reply["total"] > len(transactions):
+                # This shard has more; later ones can only be ordered once read
+                bound = min(bound, math.nextafter(transactions[-1]["timestamp"], math.inf))
+            segments.append([dict(tx, shard=index) for tx in transactions])
+
+        merged = []
+        for tx in heapq.merge(*segments, key=lambda tx: (tx["timestamp"], tx["tx_id"])):
+            if tx["timestamp"] <= after or tx["timestamp"] >= bound:
+                continue
+            del tx["block_index"]
+            if merged and merged[-1]["tx_id"] == tx["tx_id"]:
+                merged[-1]["shards"].append(tx.pop("shard"))
+                continue
+            tx["shards"] = [tx.pop("shard")]
+            merged.append(tx)
+        merged = merged[:limit]
+        return {
+            "status": "success",
+            "transactions": merged,
+            "next": merged[-1]["timestamp"] if merged else after,
+            "complete_until": bound if len(merged) < limit else merged[-1]["timestamp"]
+        }
+
+    def find_transaction(self, request):
+        # get_transaction / get_tx_proof: whichever shard holds it
+        # A cross-shard payment may be sealed on one shard and pending on the other
+        replies = self.fan_out(request)
+        ranked = sorted(replies, key=lambda reply: (reply.get("status") != "success",
+                                                    reply.get("state") == "pending",
+                                                    reply.get("status") != "pending"))
+        if ranked[0].get("status") in ("success", "pending"):
+            return ranked[0]
+        errors = [reply for reply in replies if reply.get("status") == "error"]
+        return errors[0] if errors else replies[0]
+
+    def settlement(self, request, deadline=None):
+        # Each shard settles and reconciles the accounts it holds; the
+        # report is their sum
+        replies = self.fan_out(request, deadline)
+        failed = next((reply for reply in replies if reply.get("status") != "success"), None)
+        if failed is not None:
+            return failed
+        report = dict(replies[0], shards=len(replies), elapsed_ms=max(reply["elapsed_ms"] for reply in replies))
+        # Each payment is counted only by the shard holding its user, so the
+        # totals simply add up
+        for field in ("merchants", "users", "sealed_transactions", "transactions", "amount"):
+            report[field] = sum(reply[field] for reply in replies)
+        report["settlements"] = sorted((row for reply in replies for row in reply["settlements"]),
+                                       key=lambda row: row.get("merchant_id") or row.get("mmid"))
+        reconciliation = dict(replies[0]["reconciliation"])
+        for field in ("users_checked", "merchants_checked", "unverified", "opening_total", "balance_total",
+                      "mismatch_count"):
+            reconciliation[field] = sum(reply["reconciliation"][field] for reply in replies)
+        reconciliation["mismatches"] = [row for reply in replies for row in reply["reconciliation"]["mismatches"]]
+        reconciliation["balanced"] = all(reply["reconciliation"]["balanced"] for reply in replies)
+        report["reconciliation"] = reconciliation
+        del report["other_accounts"]
+        return report
+
+    def stats(self):
+        with self._lock:
+            return {
+                "shards": [f"{host}:{port}" for host, port in self.addresses],
+                "cross_shard_commits": self.cross_shard_commits,
+                "cross_shard_aborts": self.cross_shard_aborts,
+                "in_doubt": len(self.in_doubt),
+                "resolved": self.resolved
+            }
+
+    def dispatch(self, request, deadline=None):
+        action = request.get("action")
+        if action == "subscribe_blocks":
+            return {"status": "error", "message": "Subscribe on a shard's own address (see get_shards)"}
+        if request.get("shard") is not None:
+            # Addressed to one shard, e.g. get_blocks on its chain segment
+            try:
+                index = int(request["shard"])
+                if not 0 <= index < len(self.pools):
+                    raise ValueError(f"No shard {index}")
+            except (TypeError, ValueError) as e:
+                return {"status": "error", "message": str(e)}
+            forwarded = dict(request)
+            del forwarded["shard"]
+            return self.call(index, forwarded, deadline)
+
+        if action in ("register_user", "register_merchant"):
+            # The shard picks an ID that hashes to itself
+            with self._lock:
+                index = self._next_shard
+                self._next_shard = (index + 1) % len(self.pools)
+            return self.call(index, request, deadline)
+        elif action == "get_statement":
+            key = request.get('mmid') if request.get('mmid') is not None else request.get('merchant_id')
+            if not isinstance(key, str):
+                return {"status": "error", "message": "Missing field: 'mmid' or 'merchant_id'"}
+            return self.call(self.shard_of(key), request, deadline)
+        elif action in ("get_transaction", "get_tx_proof"):
+            return self.find_transaction(request)
+        elif action == "get_merged_ledger":
+            return self.merged_ledger(request)
+        elif action == "verify_chain":
+            replies = self.fan_out(request)
+            ok = all(reply.get("status") == "success" for reply in replies)
+            return {"status": "success" if ok else "failure", "shards": replies}
+        elif action == "get_settlement":
+            return self.settlement(request, deadline)
+        elif action == "get_shards":
+            return dict(self.stats(), status="success")
+        elif action in ("get_blocks", "get_blockchain", "get_transactions_in_range"):
+            return {"status": "error", "message": "Each shard has its own chain segment: pass 'shard' "
+                                                  f"(0-{len(self.pools) - 1}), or use get_merged_ledger"}
+        return {"status": "error", "message": "Unknown action"}
@@ -0,0 +1,93 @@
+# snapshot.py
+#
+# Checksummed snapshots of the bank's accounts.
+#
+# A snapshot file is a header followed by a zlib-compressed JSON body:
+#   8-byte magic | 8-byte covered LSN | 8-byte body length | 4-byte CRC32
+# "Covered LSN" is the last write-ahead log record whose effects the snapshot
+# is guaranteed to contain, so recovery loads it and replays only later
+# records.
+#
+# Blocks are not copied into every snapshot. They live in the block store
+# (blockstore.py), and each snapshot records the chain height and tip hash it
+# covers.
+
+import os
+import json
+import zlib
+import struct
+
+from wal import fsync_directory
+
+SNAPSHOT_MAGIC = b"BANKSNP1"
+SNAPSHOT_HEADER = struct.Struct(">8sQQI")
+SNAPSHOT_PREFIX = "snapshot-"
+SNAPSHOT_SUFFIX = ".snap"
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def snapshot_path(directory, covered_lsn):
+    return os.path.join(directory, f"{SNAPSHOT_PREFIX}{covered_lsn:016d}{SNAPSHOT_SUFFIX}")
+
+
+def list_snapshots(directory):
+    # (covered_lsn, path) pairs, newest first
+    if not os.path.isdir(directory):
+        return []
+    found = []
+    for name in os.listdir(directory):
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX):
+            lsn = int(name[len(SNAPSHOT_PREFIX):-len(SNAPSHOT_SUFFIX)])
+            found.append((lsn, os.path.join(directory, name)))
+    return sorted(found, reverse=True)
+
+
+def write_snapshot(directory, covered_lsn, state):
+    body = zlib.compress(json.dumps(state, separators=(",", ":")).encode())
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, covered_lsn, len(body), zlib.crc32(body))
+    path = snapshot_path(directory, covered_lsn)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header + body)
+        f.flush()
+        os.fsync(f.fileno())
+    # The rename makes the snapshot visible only once it is complete
+    os.replace(tmp_path, path)
+    fsync_directory(directory)
+    return path
+
+
+def read_snapshot(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise SnapshotError(f"{path} is truncated")
+    magic, covered_lsn, length, crc = SNAPSHOT_HEADER.unpack_from(data)
+    body = data[SNAPSHOT_HEADER.size:]
+    if magic != SNAPSHOT_MAGIC or len(body) != length or zlib.crc32(body) != crc:
+        raise SnapshotError(f"{path} failed its checksum")
+    return covered_lsn, json.loads(zlib.decompress(body))
+
+
+def load_latest_snapshot(directory):
+    # Returns (covered_lsn, state) for the newest valid snapshot, or (0, None)
+    for lsn, path in list_snapshots(directory):
+        try:
+            return read_snapshot(path)
+        except (OSError, ValueError, zlib.error, SnapshotError) as e:
+            print(f"[SNAPSHOT] Skipping {os.path.basename(path)}: {e}")
+    return 0, None
+
+
+def prune_snapshots(directory, keep):
+    # Deletes all but the newest `keep` snapshots; returns the covered LSN of
+    # the oldest one kept
+    snapshots = list_snapshots(directory)
+    for lsn, path in snapshots[keep:]:
+        os.remove(path)
+    kept = snapshots[:keep]
+    return kept[-1][0] if kept else 0
+
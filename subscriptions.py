@@ -0,0 +1,102 @@
+# subscriptions.py
+#
+# Fan-out of new items (sealed blocks, durable log records) to clients that
+# keep a stream open: subscribe_blocks clients and read-replica followers.
+#
+# publish() runs on the thread that produced the item (the block sequencer,
+# the log flusher), so it must never wait for a subscriber. Each subscriber
+# gets a bounded buffer; publishing appends to it and wakes the
+# subscriber's sender. A subscriber that falls max_buffer items behind has
+# its buffer dropped and is marked as lagging. It loses nothing by this:
+# its next_frame() reads the missed items back from storage (the chain, the
+# log), starting at its position, and then goes back to live items.
+
+import threading
+import collections
+
+SUBSCRIBER_BUFFER = 256
+
+
+class Subscriber:
+    # One open stream. Subclasses define next_frame(heartbeat), which
+    # returns the next frame body to send, or None when there is nothing new
+    # and no heartbeat is due. It must not block. A heartbeat is due after
+    # heartbeat_interval idle seconds.
+    heartbeat_interval = 10
+
+    def __init__(self, feed, position, notify=None):
+        self.feed = feed
+        self.position = position      # next item to send (block index, log position)
+        self.notify = notify          # extra wake-up, e.g. for an asyncio loop
+        self.ready = threading.Event()
+        self._buffer = collections.deque()
+        self._lock = threading.Lock()
+        self.lagged = 0
+
+    def push(self, item):
+        # Returns True when the buffer overflowed
+        with self._lock:
+            overflowed = len(self._buffer) >= self.feed.max_buffer
+            if overflowed:
+                self._buffer.clear()
+                self.lagged += 1
+            self._buffer.append(item)
+        self.ready.set()
+        if self.notify is not None:
+            self.notify()
+        return overflowed
+
+    def take(self):
+        # All buffered items, oldest first
+        with self._lock:
+            items = list(self._buffer)
+            self._buffer.clear()
+        return items
+
+    def next_frame(self, heartbeat=False):
+        raise NotImplementedError
+
+    def close(self):
+        self.feed.remove(self)
+
+
+class Feed:
+    def __init__(self, max_buffer=SUBSCRIBER_BUFFER):
+        self.max_buffer = max_buffer
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+        # Counters
+        self.published = 0
+        self.subscriptions = 0
+        self.overflows = 0
+
+    def add(self, subscriber):
+        with self._lock:
+            self._subscribers.add(subscriber)
+            self.subscriptions += 1
+        return subscriber
+
+    def remove(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, item):
+        with self._lock:
+            if not self._subscribers:
+                return
+            subscribers = list(self._subscribers)
+            self.published += 1
+        overflows = sum(subscriber.push(item) for subscriber in subscribers)
+        if overflows:
+            with self._lock:
+                self.overflows += overflows
+
+    def stats(self):
+        with self._lock:
+            return {
+                "subscribers": len(self._subscribers),
+                "subscriptions": self.subscriptions,
+                "published": self.published,
+                "overflows": self.overflows
+            }
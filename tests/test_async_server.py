@@ -0,0 +1,50 @@
+# The asyncio bank server closes connections left idle.
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bank
+from protocol import Connection
+
+
+def start_server(port):
+    server = bank.AsyncBankServer("127.0.0.1", port)
+    threading.Thread(target=asyncio.run, args=(server.serve_forever(),), daemon=True).start()
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_idle_connection_is_closed(monkeypatch):
+    monkeypatch.setattr(bank, "CLIENT_TIMEOUT", 0.5)
+    port = free_port()
+    start_server(port)
+
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as idle:
+        started = time.monotonic()
+        assert idle.recv(1) == b""
+        assert time.monotonic() - started < 3
+
+    # A connection in use stays open past the timeout
+    with Connection("127.0.0.1", port, timeout=5) as conn:
+        for _ in range(4):
+            assert conn.request({"action": "ping"})["status"] == "success"
+            time.sleep(0.3)
@@ -0,0 +1,55 @@
+# The merchant's bank connection pool reuses healthy connections and
+# replaces the ones the bank has closed.
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bank
+import merchant
+
+
+def start_server(port):
+    server = bank.AsyncBankServer("127.0.0.1", port)
+    threading.Thread(target=asyncio.run, args=(server.serve_forever(),), daemon=True).start()
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_closed_connection_is_not_a_hit(monkeypatch):
+    monkeypatch.setattr(bank, "CLIENT_TIMEOUT", 0.5)
+    port = free_port()
+    start_server(port)
+    pool = merchant.BankConnectionPool("127.0.0.1", port, size=1, warm=0)
+    try:
+        assert pool.request({"action": "ping"})["status"] == "success"
+        assert pool.request({"action": "ping"})["status"] == "success"
+        stats = pool.stats()
+        assert (stats["hits"], stats["misses"], stats["reconnects"]) == (1, 1, 0)
+
+        # The bank drops the idle connection; the next request opens a new one
+        time.sleep(1.5)
+        assert pool.request({"action": "ping"})["status"] == "success"
+        stats = pool.stats()
+        assert (stats["hits"], stats["misses"], stats["reconnects"]) == (1, 2, 1)
+        assert stats["open"] == 1
+    finally:
+        pool.close()
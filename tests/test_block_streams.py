@@ -0,0 +1,50 @@
+# Chain queries over blocks filled to BLOCK_MAX_TRANSACTIONS stay within the
+# frame size limit.
+
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bank
+from protocol import MAX_FRAME_SIZE, pack_frame, encode_json, merge_stream
+
+BLOCKS = 220
+
+
+def seal_full_blocks(count):
+    for b in range(count):
+        bank.block_sequencer.add_batch([
+            (bank.new_transaction(f"{b:032x}{t:032x}", "a" * 16, "b" * 16, 1.0, time.time()), None)
+            for t in range(bank.BLOCK_MAX_TRANSACTIONS)])
+
+
+def frames(request):
+    bodies = list(bank.handle_frame(encode_json(request)))
+    for body in bodies:
+        assert len(body) <= MAX_FRAME_SIZE
+        pack_frame(1, body)
+    return [json.loads(body) for body in bodies]
+
+
+def test_full_blocks_stream_in_frames_under_the_limit():
+    start = len(bank.blockchain)
+    seal_full_blocks(BLOCKS)
+    assert bank.blockchain.header(-1)['tx_count'] == bank.BLOCK_MAX_TRANSACTIONS
+
+    chain = merge_stream(frames({"action": "get_blockchain"}))["chain"]
+    assert len(chain) == start + BLOCKS
+
+    # Pages of get_blocks are cut by transactions; following "next" still
+    # returns every block once
+    fetched, position = [], start
+    while True:
+        page = merge_stream(frames({"action": "get_blocks", "start": position}))
+        assert sum(block["tx_count"] for block in page["blocks"]) <= bank.MAX_PAGE_TRANSACTIONS
+        fetched += page["blocks"]
+        position = page["next"]
+        if position >= page["height"]:
+            break
+    assert [block["index"] for block in fetched] == list(range(start, start + BLOCKS))
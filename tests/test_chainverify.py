@@ -0,0 +1,74 @@
+# Chain verification: a full audit in spawned worker processes and the
+# incremental check against checkpoints both catch a tampered block.
+
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import chainverify
+from merkle import tx_leaf_hash, merkle_root, compute_block_hash
+
+
+def make_chain(count):
+    chain = []
+    prev_hash = chainverify.GENESIS_HASH
+    for index in range(count):
+        transactions = [{"tx_id": f"{index:032x}{t:032x}", "mmid": "a" * 16, "merchant_id": "b" * 16,
+                         "amount": 1.0, "timestamp": float(index)} for t in range(3)]
+        root = merkle_root([tx_leaf_hash(tx) for tx in transactions])
+        block = {"index": index, "timestamp": float(index), "prev_hash": prev_hash, "merkle_root": root,
+                 "tx_count": len(transactions), "transactions": transactions,
+                 "hash": compute_block_hash(index, prev_hash, root, float(index))}
+        chain.append(block)
+        prev_hash = block["hash"]
+    return chain
+
+
+def test_full_audit_in_workers():
+    chain = make_chain(50)
+    assert chainverify.full_audit(chain, workers=2, chunk_size=10) == (None, None)
+
+    chain[37]["transactions"][1]["amount"] = 1000.0
+    bad_index, error = chainverify.full_audit(chain, workers=2, chunk_size=10)
+    assert bad_index == 37 and "Merkle root" in error
+
+
+def test_full_audit_while_another_thread_holds_a_lock():
+    # The bank audits from a request thread while other threads hold locks
+    chain = make_chain(20)
+    lock = threading.Lock()
+    held = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with lock:
+            held.set()
+            release.wait(30)
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    held.wait()
+    try:
+        assert chainverify.full_audit(chain, workers=2, chunk_size=5) == (None, None)
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_incremental_check_uses_checkpoints():
+    chain = make_chain(25)
+    checkpoints = chainverify.CheckpointStore(interval=10)
+    result = chainverify.verify_chain(chain, checkpoints)
+    assert result["status"] == "success" and result["verified_blocks"] == 25
+    assert result["checkpoint"] == 19
+
+    # Only the blocks past the latest checkpoint are re-hashed
+    result = chainverify.verify_chain(chain, checkpoints)
+    assert result["verified_blocks"] == 5
+
+    # A rewritten checkpointed block no longer matches its recorded hash
+    chain[9]["hash"] = "f" * 64
+    result = chainverify.verify_chain(chain, checkpoints)
+    assert result["status"] == "failure" and result["index"] == 9
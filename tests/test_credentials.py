@@ -0,0 +1,40 @@
+# Salted scrypt secrets and the verified-session cache.
+
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from credentials import CredentialHasher, check_secret, hash_secret, is_hashed
+
+
+def test_hashed_secret_checks_only_the_right_secret():
+    stored = hash_secret("1234")
+    assert is_hashed(stored) and "1234" not in stored
+    assert check_secret("1234", stored)
+    assert not check_secret("1235", stored)
+    assert hash_secret("1234") != stored  # salted
+
+
+def test_plaintext_stored_secret_never_matches():
+    assert not check_secret("1234", "1234")
+
+
+def test_session_cache_and_kdf_run_count():
+    hasher = CredentialHasher(workers=2, session_ttl=60, max_sessions=100)
+    try:
+        stored = hasher.hash("1234")
+        assert hasher.verify("acct", "1234", stored)
+        assert hasher.verify("acct", "1234", stored)
+        assert not hasher.verify("acct", "0000", stored)
+        stats = hasher.stats()
+        assert stats["session_hits"] == 1 and stats["kdf_runs"] == 2
+
+        # Concurrent misses are all counted
+        others = [(f"user{i}", "1234", stored) for i in range(16)]
+        with ThreadPoolExecutor(8) as pool:
+            assert all(pool.map(lambda check: hasher.verify(*check), others))
+        assert hasher.stats()["kdf_runs"] == 2 + len(others)
+    finally:
+        hasher.start().shutdown()
@@ -0,0 +1,53 @@
+# Retried payments: the idempotency cache, and the bank answering a retry.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bank
+from idempotency import IdempotencyCache
+
+
+def test_cache_returns_the_first_response_and_rejects_a_different_payment():
+    cache = IdempotencyCache(ttl=60, max_entries=10)
+    assert cache.claim("k", ("m", "5")) is None
+    cache.complete("k", {"status": "success"})
+    assert cache.claim("k", ("m", "5")) == {"status": "success"}
+    assert cache.claim("k", ("m", "6"))["status"] == "error"
+
+
+def test_cache_expires_and_evicts_oldest():
+    cache = IdempotencyCache(ttl=0.05, max_entries=2)
+    for key in "abc":
+        cache.claim(key, None)
+        cache.complete(key, {"status": "success", "key": key})
+    assert cache.stats()["evictions"] == 1
+    assert cache.claim("a", None) is None
+    time.sleep(0.1)
+    assert cache.claim("c", None) is None
+
+
+def test_released_key_can_be_retried():
+    cache = IdempotencyCache(ttl=60, max_entries=10)
+    cache.claim("k", None)
+    cache.release("k")
+    assert cache.claim("k", None) is None
+
+
+def test_bank_retry_charges_once_and_checks_the_pin():
+    user = bank.handle_user_registration({"name": "idem", "password": "pw", "ifsc_code": "X",
+                                          "balance": 100.0, "pin_code": "1234", "phone_number": "5550001"})
+    merchant = bank.handle_merchant_registration({"name": "idem", "password": "pw", "ifsc_code": "X",
+                                                  "balance": 0.0})
+    payment = {"mmid": user["mmid"], "pin": "1234", "amount": 10,
+               "encrypted_merchant_id": merchant["merchant_id"], "idempotency_key": "pay-1"}
+    first = bank.handle_transaction_validation(dict(payment))
+    assert first["status"] == "success"
+    assert bank.handle_transaction_validation(dict(payment)) == first
+    assert bank.user_database[user["mmid"]]["balance"] == 90.0
+
+    wrong_pin = bank.handle_transaction_validation(dict(payment, pin="0000"))
+    assert wrong_pin["status"] != "success"
+    assert bank.user_database[user["mmid"]]["balance"] == 90.0
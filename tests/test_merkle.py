@@ -0,0 +1,90 @@
+# Merkle roots and inclusion proofs for the bank's blocks.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from merkle import (EMPTY_ROOT, tx_leaf_hash, merkle_root, merkle_proof, verify_proof,
+                    compute_block_hash, verify_tx_proof)
+
+
+def transactions(count):
+    return [{"tx_id": f"{i:064x}", "mmid": "a" * 16, "merchant_id": "b" * 16,
+             "amount": float(i + 1), "timestamp": 1000.0 + i} for i in range(count)]
+
+
+def test_every_leaf_proves_against_the_root():
+    # Odd sizes carry a node up unchanged at some level
+    for count in (1, 2, 3, 5, 8, 13):
+        leaves = [tx_leaf_hash(tx) for tx in transactions(count)]
+        root = merkle_root(leaves)
+        for index, leaf in enumerate(leaves):
+            proof = merkle_proof(leaves, index)
+            assert len(proof) <= count.bit_length()
+            assert verify_proof(leaf, proof, root)
+
+
+def test_root_of_nothing_and_of_one_leaf():
+    assert merkle_root([]) == EMPTY_ROOT
+    leaf = tx_leaf_hash(transactions(1)[0])
+    assert merkle_root([leaf]) == leaf
+    assert merkle_proof([leaf], 0) == []
+
+
+def test_wrong_leaf_or_proof_is_rejected():
+    leaves = [tx_leaf_hash(tx) for tx in transactions(6)]
+    root = merkle_root(leaves)
+    proof = merkle_proof(leaves, 2)
+    assert not verify_proof(leaves[3], proof, root)
+    assert not verify_proof(leaves[2], proof[:-1], root)
+    flipped = [[sibling, "R" if side == "L" else "L"] for sibling, side in proof]
+    assert not verify_proof(leaves[2], flipped, root)
+
+
+def test_inner_node_cannot_pass_for_a_transaction():
+    leaves = [tx_leaf_hash(tx) for tx in transactions(4)]
+    root = merkle_root(leaves)
+    # The parent of leaves 0 and 1, offered as a leaf with the upper proof
+    parent_proof = merkle_proof(leaves, 0)[1:]
+    parent = merkle_root(leaves[:2])
+    assert verify_proof(parent, parent_proof, root)
+    assert tx_leaf_hash(leaves[:2]) != parent
+
+
+def make_proof_response(txs, position):
+    leaves = [tx_leaf_hash(tx) for tx in txs]
+    root = merkle_root(leaves)
+    header = {"index": 7, "timestamp": 1234.5, "prev_hash": "c" * 64, "merkle_root": root,
+              "tx_count": len(txs)}
+    header["hash"] = compute_block_hash(7, header["prev_hash"], root, header["timestamp"])
+    return {"status": "success", "tx": txs[position], "block": header, "proof": merkle_proof(leaves, position)}
+
+
+def test_tx_proof_response():
+    txs = transactions(9)
+    response = make_proof_response(txs, 4)
+    assert verify_tx_proof(response)
+
+    # A changed amount no longer hashes to the root
+    response["tx"] = dict(response["tx"], amount=999.0)
+    assert not verify_tx_proof(response)
+
+    # A root that is not part of the block's hash is refused
+    response = make_proof_response(txs, 4)
+    other = make_proof_response(transactions(3), 0)
+    response["block"] = dict(response["block"], hash=other["block"]["hash"])
+    assert not verify_tx_proof(response)
+
+
+def test_bank_proves_a_sealed_payment():
+    import bank
+    txs = [bank.new_transaction(f"{i:032x}{'e' * 32}", "a" * 16, "b" * 16, 2.0, 5000.0 + i) for i in range(7)]
+    bank.block_sequencer.add_batch([(tx, None) for tx in txs])
+    assert bank.handle_get_tx_proof({"tx_id": txs[5]["tx_id"]})["status"] == "pending"
+
+    bank.block_sequencer.flush()
+    response = bank.handle_get_tx_proof({"tx_id": txs[5]["tx_id"]})
+    assert response["status"] == "success" and response["tx"] == txs[5]
+    assert verify_tx_proof(response)
+    assert bank.handle_get_tx_proof({"tx_id": "f" * 64})["status"] == "failure"
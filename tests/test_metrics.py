@@ -0,0 +1,28 @@
+# Client-chosen action strings never become metric labels of their own.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bank
+from metrics import Metrics
+from protocol import encode_json
+
+
+def test_unknown_actions_share_one_label():
+    before = set(bank.metrics.snapshot()["actions"])
+    for i in range(5):
+        bank.handle_frame(encode_json({"action": f'junk{i}"}} 1\n', "timeout_ms": 0}))
+    bank.handle_frame(encode_json({"action": ["not", "a", "string"]}))
+    bank.handle_frame(encode_json({"action": "register_user"}), encrypted=False)
+    assert set(bank.metrics.snapshot()["actions"]) - before <= {"unknown", "register_user"}
+    assert "junk" not in bank.metrics.prometheus()
+
+
+def test_prometheus_escapes_label_values():
+    metrics = Metrics("test")
+    metrics.observe('a"b\\c\nd', 0.001, "success", finished=False)
+    text = metrics.prometheus()
+    assert 'action="a\\"b\\\\c\\nd"' in text
+    assert all(line.startswith(("#", "test_")) for line in text.splitlines())
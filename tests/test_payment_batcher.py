@@ -0,0 +1,92 @@
+# The merchant's PaymentBatcher coalesces concurrent payments into one
+# validate_transactions call and hands each caller its own result.
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from merchant import PaymentBatcher
+
+
+class Bank:
+    # Records what the batcher sends and answers every payment by its amount
+    def __init__(self, status="success"):
+        self.status = status
+        self.requests = []
+
+    def send(self, request, timeout):
+        self.requests.append(request)
+        if self.status != "success":
+            return {"status": self.status, "message": "Bank unavailable"}
+        if request["action"] == "validate_transaction":
+            return {"status": "success", "amount": request["amount"]}
+        return {"status": "success", "results": [{"status": "success", "amount": tx["amount"]}
+                                                 for tx in request["transactions"]]}
+
+
+def pay(amount):
+    return {"action": "validate_transaction", "mmid": "a" * 16, "amount": amount}
+
+
+def submit_all(batcher, payments):
+    responses = [None] * len(payments)
+
+    def run(i):
+        responses[i] = batcher.submit(*payments[i])
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(payments))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return responses
+
+
+def test_concurrent_payments_share_one_call():
+    bank = Bank()
+    batcher = PaymentBatcher(bank.send, window=0.2, max_size=100)
+    responses = submit_all(batcher, [(pay(i),) for i in range(10)])
+    assert [r["amount"] for r in responses] == list(range(10))
+    assert len(bank.requests) == 1 and bank.requests[0]["action"] == "validate_transactions"
+    assert all("action" not in tx for tx in bank.requests[0]["transactions"])
+    assert (batcher.batches, batcher.payments) == (1, 10)
+
+
+def test_lone_payment_is_sent_as_is():
+    bank = Bank()
+    batcher = PaymentBatcher(bank.send, window=0.01)
+    assert batcher.submit(pay(5))["amount"] == 5
+    assert bank.requests == [pay(5)]
+
+
+def test_full_batch_is_sent_before_the_window():
+    bank = Bank()
+    batcher = PaymentBatcher(bank.send, window=30, max_size=4)
+    started = time.monotonic()
+    responses = submit_all(batcher, [(pay(i),) for i in range(4)])
+    assert time.monotonic() - started < 5
+    assert [r["amount"] for r in responses] == [0, 1, 2, 3]
+    assert len(bank.requests) == 1
+
+
+def test_expired_payment_is_not_sent():
+    bank = Bank()
+    batcher = PaymentBatcher(bank.send, window=0.2)
+    responses = submit_all(batcher, [(pay(1), time.monotonic() + 0.05), (pay(2), time.monotonic() + 10)])
+    statuses = sorted(r["status"] for r in responses)
+    # The short deadline expires while waiting, either in the batch or for it
+    assert statuses[-1] == "success"
+    assert statuses[0] in ("error", "expired")
+    sent = [tx["amount"] for r in bank.requests for tx in r.get("transactions", [r])]
+    assert sent == [2]
+    assert 0 < bank.requests[0]["timeout_ms"] <= 10000
+
+
+def test_bank_failure_reaches_every_caller():
+    bank = Bank(status="overloaded")
+    batcher = PaymentBatcher(bank.send, window=0.2)
+    responses = submit_all(batcher, [(pay(i),) for i in range(3)])
+    assert [r["status"] for r in responses] == ["overloaded"] * 3
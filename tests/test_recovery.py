@@ -0,0 +1,52 @@
+# Restarting the bank from its write-ahead log. Each run of the bank is a
+# separate process, since its state lives in module globals.
+
+import os
+import sys
+import json
+import textwrap
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_bank(directory, script):
+    # Opens the bank on `directory`, runs `script` and returns what it
+    # printed as JSON on its last line. The credential workers are stopped
+    # first, as they would otherwise hold the output pipe open.
+    code = textwrap.dedent("""
+        import os, sys, json, time
+        import bank
+        bank.credential_hasher.start()
+        bank.open_wal(sys.argv[1])
+    """) + textwrap.dedent(script) + "\nbank.credential_hasher.start().shutdown()\nsys.stdout.flush()\nos._exit(0)\n"
+    result = subprocess.run([sys.executable, "-c", code, directory], cwd=REPO,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_restart_with_pending_payments_seals_them(tmp_path):
+    directory = str(tmp_path)
+    # Payments are journaled, then the bank stops before sealing a block
+    first = run_bank(directory, """
+        m = bank.handle_merchant_registration({"name": "m", "password": "p", "ifsc_code": "X", "balance": 0})
+        for i in range(3):
+            u = bank.handle_user_registration({"name": f"u{i}", "password": "p", "ifsc_code": "X",
+                                               "balance": 50.0, "pin_code": "1", "phone_number": str(i)})
+            r = bank.validate_payment({"mmid": u["mmid"], "pin": "1", "amount": 7,
+                                       "encrypted_merchant_id": m["merchant_id"]})
+            assert r["status"] == "success", r
+        print(json.dumps({"pending": len(bank.block_sequencer.pending), "blocks": len(bank.blockchain)}))
+    """)
+    assert first == {"pending": 3, "blocks": 0}
+
+    # After the restart the recovered payments are sealed on time
+    second = run_bank(directory, """
+        recovered = len(bank.block_sequencer.pending)
+        bank.block_sequencer.start()
+        time.sleep(bank.BLOCK_INTERVAL * 3)
+        print(json.dumps({"recovered": recovered, "pending": len(bank.block_sequencer.pending),
+                          "sealed": bank.blockchain.tx_count()}))
+    """)
+    assert second == {"recovered": 3, "pending": 0, "sealed": 3}
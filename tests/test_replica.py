@@ -0,0 +1,25 @@
+# A follower that bootstraps again starts from a clean slate.
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bank
+
+
+def seal(count, tag):
+    for b in range(count):
+        bank.add_block([bank.new_transaction(f"{tag}{b:063x}", "c" * 16, "d" * 16, 1.0, time.time())])
+
+
+def test_rebootstrap_forgets_old_checkpoints():
+    seal(3, "a")
+    bank.checkpoint_store.add(len(bank.blockchain) - 1, bank.blockchain.header(-1)['hash'])
+    assert bank.verify_chain()["status"] == "success"
+
+    bank.replica_reset({"lsn": 0, "chain_height": 0})
+    assert bank.checkpoint_store.latest() is None
+    seal(5, "b")
+    assert bank.verify_chain()["status"] == "success"
@@ -0,0 +1,92 @@
+# Sealed frames open only once, in order, for their own request, and keys
+# rotate without a new handshake.
+
+import os
+import sys
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import ProtocolError, encode_json, decode_json
+from securechannel import (SecureChannel, ServerSession, is_sealed, SEALED_HEADER, PROTOCOL_VERSION,
+                           _raw_public, _session_keys)
+
+
+def channel_pair(**kwargs):
+    a_to_b, b_to_a = os.urandom(32), os.urandom(32)
+    return SecureChannel(a_to_b, b_to_a, **kwargs), SecureChannel(b_to_a, a_to_b, **kwargs)
+
+
+def test_seal_and_open():
+    client, server = channel_pair()
+    sealed = client.seal(1, b'{"action": "ping"}')
+    assert is_sealed(sealed) and b"ping" not in sealed
+    assert server.open(1, sealed) == b'{"action": "ping"}'
+    assert server.open(2, client.seal(2, b"second")) == b"second"
+    assert server.seal(1, b"reply") != client.seal(1, b"reply")
+
+
+def test_replayed_or_reordered_frame_is_rejected():
+    client, server = channel_pair()
+    first, second = client.seal(1, b"one"), client.seal(2, b"two")
+    with pytest.raises(ProtocolError):
+        server.open(2, second)
+    server.open(1, first)
+    with pytest.raises(ProtocolError):
+        server.open(1, first)
+
+
+def test_tampered_frame_is_rejected():
+    client, server = channel_pair()
+    sealed = bytearray(client.seal(1, b"pay 10"))
+    sealed[-1] ^= 1
+    with pytest.raises(ProtocolError):
+        server.open(1, bytes(sealed))
+
+    # The request id is authenticated, so a frame cannot move to another request
+    client, server = channel_pair()
+    with pytest.raises(ProtocolError):
+        server.open(2, client.seal(1, b"pay 10"))
+
+    with pytest.raises(ProtocolError):
+        channel_pair()[1].open(1, b'{"action": "ping"}')
+
+
+def test_keys_rotate_after_messages():
+    client, server = channel_pair(rotate_after_messages=3)
+    for i in range(10):
+        sealed = client.seal(i, b"frame %d" % i)
+        assert server.open(i, sealed) == b"frame %d" % i
+    assert client.rotations == 3
+    _, epoch, counter = SEALED_HEADER.unpack_from(sealed)
+    assert (epoch, counter) == (3, 0)
+
+
+def test_server_session_handshake():
+    session = ServerSession()
+    private_key = X25519PrivateKey.generate()
+    client_public = _raw_public(private_key)
+    request, reply = session.receive(1, encode_json({"action": "handshake", "version": PROTOCOL_VERSION,
+                                                     "public_key": client_public.hex()}))
+    assert request is None and session.encrypted
+    server_public = bytes.fromhex(decode_json(reply)["public_key"])
+    send_key, recv_key = _session_keys(private_key, server_public, client_public, server_public)
+    client = SecureChannel(send_key, recv_key)
+
+    body, _ = session.receive(2, client.seal(2, b'{"action": "ping"}'))
+    assert body == b'{"action": "ping"}'
+    assert client.open(2, session.send(2, b"pong")) == b"pong"
+
+    # Once encrypted, plaintext is refused
+    with pytest.raises(ProtocolError):
+        session.receive(3, b'{"action": "ping"}')
+
+
+def test_handshake_must_come_first():
+    session = ServerSession()
+    assert session.receive(1, b'{"action": "ping"}') == (b'{"action": "ping"}', None)
+    with pytest.raises(ProtocolError):
+        session.receive(2, encode_json({"action": "handshake", "version": 1, "public_key": "00" * 32}))
+    assert not session.encrypted
@@ -0,0 +1,107 @@
+# End-of-day settlement over a block store, and its reconciliation.
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from blockstore import BlockStore
+from settlement import Accounts, Settlement, day_bounds
+
+START, END, DAY = day_bounds("2026-01-02")
+USERS = ["%016x" % (i + 1) for i in range(4)]
+MERCHANTS = ["%016x" % (0xf0 + i) for i in range(2)]
+
+
+def write_chain(directory, payments):
+    # payments are (mmid, merchant_id, amount, timestamp), one block each
+    store = BlockStore(directory)
+    for i, (mmid, merchant_id, amount, timestamp) in enumerate(payments):
+        store.append({"index": i, "timestamp": timestamp, "prev_hash": "00" * 32, "merkle_root": "00" * 32,
+                      "hash": "%064x" % (i + 1), "transactions": [
+                          {"tx_id": "%064x" % (i + 1), "mmid": mmid, "merchant_id": merchant_id,
+                           "amount": amount, "timestamp": timestamp}]})
+    store.flush()
+    return len(payments)
+
+
+def accounts(ids, balances, opening):
+    database = {i: {"balance": b, "opening_balance": o} for i, b, o in zip(ids, balances, opening)}
+    result = Accounts(database)
+    result.read_balances(database)
+    return database, result
+
+
+PAYMENTS = [
+    (USERS[0], MERCHANTS[0], 10.0, START - 100),   # the day before
+    (USERS[0], MERCHANTS[0], 5.0, START + 10),
+    (USERS[1], MERCHANTS[1], 7.5, START + 20),
+    (USERS[2], MERCHANTS[0], 2.5, END - 1),
+    (USERS[3], MERCHANTS[1], 1.0, END + 1),        # the day after
+]
+
+
+def test_day_totals_and_balanced_reconciliation(tmp_path):
+    count = write_chain(str(tmp_path), PAYMENTS)
+    _, users = accounts(USERS, [85.0, 92.5, 97.5, 99.0], [100.0] * 4)
+    _, merchants = accounts(MERCHANTS, [17.5, 8.5], [0.0, 0.0])
+    run = Settlement(START, END, users, merchants)
+    run.add_sealed(str(tmp_path), 0, count)
+
+    report = run.report(DAY)
+    assert report["sealed_transactions"] == 5
+    assert report["transactions"] == 3 and report["amount"] == 15.0
+    assert {row["merchant_id"]: row["amount"] for row in report["settlements"]} == {MERCHANTS[0]: 7.5,
+                                                                                   MERCHANTS[1]: 7.5}
+    by_user = run.report(DAY, by="user")["settlements"]
+    assert {row["mmid"] for row in by_user} == set(USERS[:3])
+
+    user_off, merchant_off = run.mismatches(*run.expected([], []))
+    assert len(user_off) == 0 and len(merchant_off) == 0
+
+
+def test_tampered_balance_is_a_mismatch(tmp_path):
+    count = write_chain(str(tmp_path), PAYMENTS)
+    _, users = accounts(USERS, [85.0, 92.5, 97.5, 99.0], [100.0] * 4)
+    _, merchants = accounts(MERCHANTS, [17.5, 9.5], [0.0, 0.0])
+    run = Settlement(START, END, users, merchants)
+    run.add_sealed(str(tmp_path), 0, count)
+    user_off, merchant_off = run.mismatches(*run.expected([], []))
+    assert len(user_off) == 0
+    assert [merchants.ids[i] for i in merchant_off] == [MERCHANTS[1]]
+
+
+def test_pending_payments_are_part_of_the_expected_balance(tmp_path):
+    count = write_chain(str(tmp_path), PAYMENTS[:1])
+    _, users = accounts(USERS[:1], [85.0], [100.0])
+    _, merchants = accounts(MERCHANTS[:1], [15.0], [0.0])
+    run = Settlement(START, END, users, merchants)
+    run.add_sealed(str(tmp_path), 0, count)
+    pending = [{"mmid": USERS[0], "merchant_id": MERCHANTS[0], "amount": 5.0, "timestamp": START + 1}]
+    assert all(len(off) == 0 for off in run.mismatches(*run.expected(pending, [])))
+    assert any(len(off) for off in run.mismatches(*run.expected([], [])))
+
+
+def test_shards_count_each_payment_once(tmp_path):
+    # Two shards: the first holds USERS[0] and MERCHANTS[1], the second the
+    # rest. A cross-shard payment is sealed on both; one that is half-sealed
+    # (only on the merchant's shard so far) is counted by neither yet.
+    cross = (USERS[0], MERCHANTS[0], 5.0, START + 10)
+    local = (USERS[1], MERCHANTS[0], 7.5, START + 20)
+    half = (USERS[1], MERCHANTS[1], 1.0, START + 30)
+    shards = [((USERS[0],), (MERCHANTS[1],), [cross, half]),
+              ((USERS[1],), (MERCHANTS[0],), [cross, local])]
+    totals = np.zeros(2)
+    for n, (user_ids, merchant_ids, payments) in enumerate(shards):
+        directory = os.path.join(str(tmp_path), str(n))
+        os.makedirs(directory)
+        count = write_chain(directory, payments)
+        _, users = accounts(user_ids, [0.0], [0.0])
+        _, merchants = accounts(merchant_ids, [0.0], [0.0])
+        run = Settlement(START, END, users, merchants)
+        run.add_sealed(directory, 0, count)
+        report = run.report(DAY)
+        totals += (report["transactions"], report["amount"])
+    assert list(totals) == [2, 12.5]
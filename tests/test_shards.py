@@ -0,0 +1,116 @@
+# Cross-shard payments: two shard processes with the router in this
+# process, as bank.py --shards runs them.
+
+import os
+import sys
+import signal
+import subprocess
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shards import ShardRouter
+from loadgen import free_port, wait_for_port
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARDS = 2
+
+
+@pytest.fixture
+def router(tmp_path):
+    processes, addresses = [], []
+    for index in range(SHARDS):
+        port = free_port()
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(REPO, "bank.py"), "--shard", f"{index}/{SHARDS}", "--host", "127.0.0.1",
+             "--port", str(port), "--data", str(tmp_path / f"shard-{index}")],
+            cwd=str(tmp_path), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True))
+        addresses.append(("127.0.0.1", port))
+    try:
+        for _, port in addresses:
+            wait_for_port(port)
+        router = ShardRouter(addresses, str(tmp_path / "router"))
+        yield router
+        router.decisions.close()
+        for pool in router.pools:
+            pool.close()
+    finally:
+        # Each shard's group also holds its credential workers
+        for process in processes:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+
+
+def register(router, balance=100.0):
+    # One user and one merchant on each shard, by [shard]
+    users, merchants = {}, {}
+    for i in range(SHARDS):
+        user = router.dispatch({"action": "register_user", "shard": i, "name": f"u{i}", "password": "pw", "ifsc_code": "X0000001",
+                                "balance": balance, "pin_code": "1234", "phone_number": f"70000000{i:02d}"})
+        merchant = router.dispatch({"action": "register_merchant", "shard": i, "name": f"m{i}", "password": "pw",
+                                    "ifsc_code": "X0000001", "balance": 0.0})
+        users[router.shard_of(user["mmid"])] = user["mmid"]
+        merchants[router.shard_of(merchant["merchant_id"])] = merchant["merchant_id"]
+    assert sorted(users) == sorted(merchants) == list(range(SHARDS))
+    return users, merchants
+
+
+def balance(router, **key):
+    return router.dispatch(dict(key, action="get_statement"))["balance"]
+
+
+def prepared(router):
+    return [entry for reply in router.fan_out({"action": "list_prepared"}) for entry in reply["prepared"]]
+
+
+def test_cross_shard_payment_commits_on_both_shards(router):
+    users, merchants = register(router)
+    response = router.pay({"mmid": users[0], "pin": "1234", "amount": 30, "encrypted_merchant_id": merchants[1]})
+    assert response["status"] == "success" and response["remaining_balance"] == 70.0
+    assert balance(router, mmid=users[0]) == 70.0
+    assert balance(router, merchant_id=merchants[1]) == 30.0
+    assert router.cross_shard_commits == 1 and not router.in_doubt and not prepared(router)
+
+    # The router finds the payment on its shards
+    found = router.dispatch({"action": "get_transaction", "tx_id": response["tx_id"]})
+    assert found["status"] == "success"
+
+
+def test_refused_payment_aborts_both_sides(router):
+    users, merchants = register(router)
+    for pin, amount in (("0000", 10), ("1234", 500)):
+        response = router.pay({"mmid": users[1], "pin": pin, "amount": amount, "encrypted_merchant_id": merchants[0]})
+        assert response["status"] == "failure"
+    assert router.cross_shard_aborts == 2 and router.cross_shard_commits == 0
+    assert balance(router, mmid=users[1]) == 100.0
+    assert balance(router, merchant_id=merchants[0]) == 0.0
+    assert not prepared(router)
+
+
+def test_resolver_finishes_decided_and_aborts_undecided(router):
+    users, merchants = register(router)
+
+    def prepare(tx_id, amount):
+        tx = {"tx_id": tx_id, "mmid": users[0], "merchant_id": merchants[1], "amount": amount,
+              "timestamp": router.clock.begin()}
+        replies = router.call_many([
+            (0, {"action": "prepare_payment", "side": "debit", "tx": tx, "pin": "1234"}),
+            (1, {"action": "prepare_payment", "side": "credit", "tx": tx})])
+        router.clock.end(tx["timestamp"])
+        assert [reply["status"] for reply in replies] == ["success", "success"]
+        return tx
+
+    # The router decided to commit one payment and crashed before telling
+    # the shards; the other was prepared without a decision
+    decided = prepare("a" * 64, 20)
+    lsn = router.decisions.log({"type": "commit", "tx_id": decided["tx_id"], "shards": [0, 1],
+                                "timestamp": decided["timestamp"]})
+    router.in_doubt[decided["tx_id"]] = (lsn, [0, 1], decided["timestamp"])
+    prepare("b" * 64, 15)
+    assert balance(router, mmid=users[0]) == 65.0 and len(prepared(router)) == 4
+
+    router.resolve()
+    assert not router.in_doubt and not prepared(router)
+    assert balance(router, mmid=users[0]) == 80.0
+    assert balance(router, merchant_id=merchants[1]) == 20.0
@@ -1,7 +1,8 @@
 import time
-import hashlib
-import socket
-import json
+import uuid
+
+from protocol import encode_json, decode_json
+from securechannel import SecureConnection
 
 # Configuration for the merchant's server
 MERCHANT_HOST = '192.168.1.7'
@@ -10,6 +11,16 @@ MERCHANT_PORT = 8889
 BANK_HOST = '192.168.1.7'
 BANK_PORT = 9999
 
+# A payment whose connection fails is sent again this many times, under the
+# same idempotency key so the bank never charges it twice
+PAYMENT_RETRIES = 1
+
+# How long a payment may take, retries included. The time left goes to the
+# merchant as timeout_ms, and on to the bank, which drops the payment instead
+# of charging it once nobody is waiting. An "overloaded" reply is retried
+# after its retry_after_ms while there is time left.
+PAYMENT_TIMEOUT = 10
+
 class User:
     def __init__(self, name, password, ifsc_code, balance, pin_code, phone_number):
         self.name = name
@@ -22,6 +33,11 @@ class User:
         #Bank generates the following details
         self.uid = None  
         self.mmid = None
+        # Persistent encrypted connection to the merchant, reused across
+        # payments; its session keys are agreed once, when it is opened.
+        # It is reopened to the same merchant if it drops.
+        self.merchant_address = (MERCHANT_HOST, MERCHANT_PORT)
+        self._merchant_connection = None
 
     def __repr__(self):
         return f"{self.name} - {self.ifsc_code} - {self.balance} - {self.phone_number}"
@@ -37,47 +53,67 @@ class User:
             "phone_number": self.phone_number
         }
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((bank_host, bank_port))
-                s.send(json.dumps(registration_data).encode())
-                response = s.recv(4096)
-                resp = json.loads(response.decode())
-                if resp.get("status") == "success":
-                    self.uid = resp.get("uid")
-                    self.mmid = resp.get("mmid")
-                    print("Registration successful!")
-                else:
-                    print("Registration failed:", resp.get("message"))
-                return resp
+            # The PIN and password travel over an encrypted session too
+            with SecureConnection(bank_host, bank_port) as conn:
+                resp = conn.request(registration_data)
+            if resp.get("status") == "success":
+                self.uid = resp.get("uid")
+                self.mmid = resp.get("mmid")
+                print("Registration successful!")
+            else:
+                print("Registration failed:", resp.get("message"))
+            return resp
         except Exception as e:
             print("Error during registration:", str(e))
             return {"status": "error", "message": str(e)}
+
+    def connect_to_merchant(self, merchant_host = MERCHANT_HOST, merchant_port = MERCHANT_PORT, timeout=None):
+        # Payments go to this merchant from now on
+        if self._merchant_connection is not None:
+            self._merchant_connection.close()
+        self.merchant_address = (merchant_host, merchant_port)
+        self._merchant_connection = SecureConnection(merchant_host, merchant_port, timeout)
             
-    def send_transaction(self, encrypted_merchant_id, pin, amount):
+    def send_transaction(self, encrypted_merchant_id, pin, amount, idempotency_key=None, timeout=PAYMENT_TIMEOUT):
         #Connects to the merchant and sends the transaction details.
-        def simple_permutation_encrypt(data):
-                # Simple permutation encryption: reverse the string representation of the data
-                json_data = json.dumps(data)  # Convert data to JSON string
-                encrypted_data = json_data[::-1]  # Reverse the string
-                return encrypted_data
-        
-        print("Sending transaction request to merchant at", MERCHANT_HOST, MERCHANT_PORT)
+        print("Sending transaction request to merchant at", *self.merchant_address)
+        deadline = time.monotonic() + timeout
         transaction_data = {
             "encrypted_merchant_id": encrypted_merchant_id,
             "mmid": self.mmid,
             "pin": pin,
-            "amount": amount
+            "amount": amount,
+            "idempotency_key": idempotency_key or uuid.uuid4().hex
         }
 
-        transaction_data = simple_permutation_encrypt(transaction_data)
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-                client.connect((MERCHANT_HOST, MERCHANT_PORT))
-                client.send(transaction_data.encode())
-                response = client.recv(4096)
-                return json.loads(response.decode())
-        except Exception as e:
-            return {"status": "error", "message": str(e)}
+        failures = 0
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return {"status": "error", "message": "Payment timed out; retry with idempotency key "
+                                                      f"{transaction_data['idempotency_key']} to avoid paying twice",
+                        "idempotency_key": transaction_data['idempotency_key']}
+            transaction_data["timeout_ms"] = int(left * 1000)
+            try:
+                if self._merchant_connection is None or self._merchant_connection.closed:
+                    self._merchant_connection = SecureConnection(*self.merchant_address, left)
+                self._merchant_connection.sock.settimeout(left)
+                response = decode_json(self._merchant_connection.request_raw(encode_json(transaction_data)))
+            except Exception as e:
+                if self._merchant_connection is not None:
+                    self._merchant_connection.close()
+                failures += 1
+                if failures > PAYMENT_RETRIES:
+                    return {"status": "error", "message": str(e)}
+                print("Payment not confirmed, retrying:", str(e))
+                continue
+            if response.get("status") != "overloaded":
+                return response
+            wait = response.get("retry_after_ms", 0) / 1000
+            if time.monotonic() + wait >= deadline:
+                return response
+            print(f"Merchant overloaded, retrying in {wait * 1000:.0f} ms")
+            time.sleep(wait)
         
 def main():
     print("User Registration and Transaction System")
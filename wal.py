@@ -0,0 +1,248 @@
+# wal.py
+#
+# Append-only write-ahead log for the bank.
+#
+# Records are JSON documents framed as:
+#   4-byte big-endian length | 4-byte big-endian CRC32 of the body | body
+# and stored in segment files named after the LSN (log sequence number) of
+# their first record. A torn or corrupt record ends its segment on replay.
+#
+# Commits are grouped: callers append records and then wait for them to be
+# durable, while a single flusher thread writes and fsyncs everything that
+# queued up during the previous fsync. Under load one fsync covers many
+# transactions instead of one each.
+
+import os
+import json
+import time
+import zlib
+import struct
+import threading
+
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_PREFIX = "wal-"
+SEGMENT_SUFFIX = ".log"
+
+
+class WALError(Exception):
+    pass
+
+
+def _segment_name(first_lsn):
+    return f"{SEGMENT_PREFIX}{first_lsn:016d}{SEGMENT_SUFFIX}"
+
+
+def _segment_first_lsn(path):
+    return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+
+def encode_record(record):
+    body = json.dumps(record, separators=(",", ":")).encode()
+    return RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def read_segment(path):
+    # Yields the records of one segment, stopping at the first torn or corrupt one
+    with open(path, "rb") as f:
+        data = f.read()
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        body = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+        if len(body) < length or zlib.crc32(body) != crc:
+            print(f"[WAL] Ignoring torn record at {os.path.basename(path)}:{offset}")
+            return
+        yield json.loads(body)
+        offset += RECORD_HEADER.size + length
+
+
+def fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+    def __init__(self, directory, apply=None, after_lsn=0, group_commit_window=0.0):
+        # Existing records after after_lsn (the position covered by a
+        # snapshot) are replayed through apply(record) before the log accepts
+        # new appends
+        self.directory = directory
+        # Extra time the flusher waits for more records before each fsync
+        self.group_commit_window = group_commit_window
+        # Called by the flusher as on_durable(first_lsn, bodies) after each
+        # commit, with the JSON bodies of the records that just became durable
+        self.on_durable = None
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._durable = threading.Condition(self._lock)
+        self._buffer = []
+        self._error = None
+        self._closing = False
+
+        # Counters
+        self.commits = 0
+        self.records_written = 0
+
+        last_lsn = after_lsn
+        for record in self.replay(after_lsn):
+            if apply is not None:
+                apply(record)
+            last_lsn = record["lsn"]
+        self._next_lsn = last_lsn + 1
+        self._appended_lsn = last_lsn
+        self._durable_lsn = last_lsn
+
+        # Every start writes to a fresh segment, so a torn tail left by a
+        # crash is never followed by new records in the same file
+        self._segment_lsn = self._next_lsn
+        self._file = open(os.path.join(directory, _segment_name(self._next_lsn)), "ab")
+        fsync_directory(directory)
+
+        self._flusher = threading.Thread(target=self._flush_loop, name="wal-flusher", daemon=True)
+        self._flusher.start()
+
+    @property
+    def last_lsn(self):
+        return self._appended_lsn
+
+    @property
+    def durable_lsn(self):
+        return self._durable_lsn
+
+    def segments(self):
+        names = sorted(n for n in os.listdir(self.directory)
+                       if n.startswith(SEGMENT_PREFIX) and n.endswith(SEGMENT_SUFFIX))
+        return [os.path.join(self.directory, n) for n in names]
+
+    def oldest_lsn(self):
+        # First log position still on disk; earlier records have been pruned
+        paths = self.segments()
+        return _segment_first_lsn(paths[0]) if paths else self._next_lsn
+
+    def replay(self, after_lsn=0):
+        # Records are yielded in LSN order; those at or below after_lsn are skipped
+        paths = self.segments()
+        for i, path in enumerate(paths):
+            # A segment ends where the next one starts, so whole segments
+            # below after_lsn are never read
+            if i + 1 < len(paths) and _segment_first_lsn(paths[i + 1]) <= after_lsn + 1:
+                continue
+            for record in read_segment(path):
+                if record["lsn"] > after_lsn:
+                    yield record
+
+    def rotate(self):
+        # Closes the current segment and starts a new one at the next LSN,
+        # which is returned. Every record below it is durable once this returns.
+        with self._lock:
+            boundary = self._next_lsn
+            if boundary == self._segment_lsn:
+                return boundary
+            self._buffer.append(boundary)
+            self._has_work.notify()
+            while self._segment_lsn < boundary:
+                if self._error is not None:
+                    raise WALError(f"Write-ahead log failed: {self._error}")
+                self._durable.wait()
+            return boundary
+
+    def prune(self, covered_lsn):
+        # Removes segments whose records are all at or below covered_lsn
+        paths = self.segments()
+        for path, next_path in zip(paths, paths[1:]):
+            if _segment_first_lsn(next_path) <= covered_lsn + 1:
+                os.remove(path)
+
+    def append(self, record):
+        # Queues a record and returns its LSN. The record is not durable until
+        # wait_durable(lsn) returns.
+        with self._lock:
+            if self._error is not None:
+                raise WALError(f"Write-ahead log failed: {self._error}")
+            lsn = self._next_lsn
+            self._next_lsn += 1
+            self._appended_lsn = lsn
+            self._buffer.append(encode_record(dict(record, lsn=lsn)))
+            self._has_work.notify()
+            return lsn
+
+    def wait_durable(self, lsn):
+        with self._lock:
+            while self._durable_lsn < lsn:
+                if self._error is not None:
+                    raise WALError(f"Write-ahead log failed: {self._error}")
+                self._durable.wait()
+
+    def log(self, record):
+        lsn = self.append(record)
+        self.wait_durable(lsn)
+        return lsn
+
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while not self._buffer and not self._closing:
+                    self._has_work.wait()
+                if not self._buffer:
+                    return
+            if self.group_commit_window:
+                time.sleep(self.group_commit_window)
+            with self._lock:
+                batch = self._buffer
+                self._buffer = []
+                last_lsn = self._appended_lsn
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                with self._lock:
+                    self._error = e
+                    self._durable.notify_all()
+                print(f"[WAL] Write failed: {e}")
+                return
+            records = [item for item in batch if not isinstance(item, int)]
+            with self._lock:
+                self._durable_lsn = last_lsn
+                self.commits += 1
+                self.records_written += len(records)
+                self._durable.notify_all()
+            if self.on_durable is not None and records:
+                try:
+                    self.on_durable(last_lsn - len(records) + 1,
+                                    [record[RECORD_HEADER.size:] for record in records])
+                except Exception as e:
+                    print(f"[WAL] Durable-record listener failed: {e}")
+
+    def _write_batch(self, batch):
+        # An int in the batch is a rotation marker: the records before it
+        # belong to the current segment, the ones after it to the new one
+        pending = []
+        for item in batch:
+            if isinstance(item, int):
+                self._write_out(pending)
+                pending = []
+                self._file.close()
+                self._file = open(os.path.join(self.directory, _segment_name(item)), "ab")
+                fsync_directory(self.directory)
+                with self._lock:
+                    self._segment_lsn = item
+            else:
+                pending.append(item)
+        self._write_out(pending)
+
+    def _write_out(self, records):
+        if records:
+            self._file.write(b"".join(records))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._closing = True
+            self._has_work.notify()
+        self._flusher.join()
+        self._file.close()